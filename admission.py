@@ -0,0 +1,236 @@
+"""
+Admission control for the Wishlists service
+
+RateLimiter gives every customer a token bucket: a request takes a token,
+and tokens come back at RATE_LIMIT per second up to RATE_LIMIT_BURST. A
+request that finds the bucket empty gets a 429 with the number of seconds
+until the next token in Retry-After. The customer is the owner of the
+wishlist in the path (looked up with the owner function given to
+init_app), the customer_id in the path, or the customer_id that
+GET /wishlists is filtered by. RATE_LIMIT_BURST defaults to one second of
+requests.
+
+Every request also takes a token from the bucket of its client address,
+refilled at RATE_LIMIT_CLIENT per second (RATE_LIMIT by default), so that
+a client cannot get away by naming other customers. The address is the one
+the connection comes from; behind RATE_LIMIT_TRUSTED_PROXIES proxies it is
+taken from X-Forwarded-For, that many entries from the right, since the
+entries further left are whatever the client sent.
+
+ConcurrencyLimit lets at most CONCURRENCY_LIMIT requests run in each route
+at a time. Up to CONCURRENCY_QUEUE_SIZE more wait their turn, for at most
+CONCURRENCY_QUEUE_TIMEOUT seconds; the ones that do not fit in the queue,
+or time out in it, get a 503 right away instead of piling up behind a
+saturated database.
+
+Both are off while their limit is 0, and both count per process.
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app, jsonify, request
+
+# endpoints that are never limited, so that the service can still be watched when it sheds load
+EXEMPT_ENDPOINTS = ('static', 'index', 'get_metrics', 'get_pool_stats')
+ENVIRON_KEY = 'wishlists.admission_limit'  # the ConcurrencyLimit a request holds
+# endpoints whose customer_id query parameter picks the customer's rows
+CUSTOMER_FILTER_ENDPOINTS = ('get_wishlist_list',)
+
+
+class RateLimiter(object):
+    """ Token buckets for up to size keys, the least recently used are forgotten """
+
+    def __init__(self, rate, burst, size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """ Takes a token for key, returns 0 or the seconds until a token is available """
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class ConcurrencyLimit(object):
+    """ Lets limit callers in at a time, queue_size more wait up to timeout seconds """
+
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Returns True once the caller may go in, False when it is turned away """
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        """ Lets the next waiting caller in """
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+def client_address(trusted_proxies):
+    """ Returns the address of the client, as seen by the first of trusted_proxies proxies """
+    forwarded = request.headers.get('X-Forwarded-For')
+    if trusted_proxies and forwarded:
+        route = [address.strip() for address in forwarded.split(',')]
+        return route[max(len(route) - trusted_proxies, 0)]
+    return request.remote_addr or 'unknown'
+
+
+def customer_key(owner=None):
+    """ Returns the customer a request is rate limited by or None, see Admission.init_app for owner """
+    view_args = request.view_args or {}
+    if 'wishlist_id' in view_args:
+        customer_id = owner(view_args['wishlist_id']) if owner else None
+        if customer_id is not None:
+            return 'customer:{}'.format(customer_id)
+        return 'wishlist:{}'.format(view_args['wishlist_id'])
+    if 'customer_id' in view_args:
+        return 'customer:{}'.format(view_args['customer_id'])
+    customer_id = request.args.get('customer_id')
+    if customer_id and request.endpoint in CUSTOMER_FILTER_ENDPOINTS:
+        return 'customer:' + customer_id
+    return None
+
+
+def retry_response(code, error, message, retry_after):
+    """ Returns an error response telling the client when to retry """
+    response = jsonify(status=code, error=error, message=message)
+    response.status_code = code
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+class Admission(object):
+    """ Throttles customers and sheds load for the routes of an app """
+
+    def __init__(self):
+        self.throttled = 0
+        self.shed = 0
+        self._limiters = None
+        self._limits = {}
+        self._lock = threading.Lock()
+        self.owner = None
+
+    def init_app(self, app, owner=None):
+        """
+        Checks every request of app against the limits in its config
+
+        owner(wishlist_id) returns the customer_id of a wishlist, or None,
+        so that the requests to every wishlist of a customer share a bucket.
+        """
+        self.owner = owner
+        app.config.setdefault('RATE_LIMIT', 0)
+        app.config.setdefault('RATE_LIMIT_BURST', 0)
+        app.config.setdefault('RATE_LIMIT_CLIENT', 0)
+        app.config.setdefault('RATE_LIMIT_TRUSTED_PROXIES', 0)
+        app.config.setdefault('CONCURRENCY_LIMIT', 0)
+        app.config.setdefault('CONCURRENCY_QUEUE_SIZE', 0)
+        app.config.setdefault('CONCURRENCY_QUEUE_TIMEOUT', 1.0)
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def reset(self):
+        """ Forgets the buckets and limits, so that they pick up a new config """
+        with self._lock:
+            self._limiters = None
+            self._limits = {}
+
+    def limiters(self, config):
+        """ Returns the RateLimiters of the customers and of the client addresses """
+        with self._lock:
+            if self._limiters is None:
+                rate = config['RATE_LIMIT']
+                burst = config['RATE_LIMIT_BURST'] or rate
+                client_rate = config['RATE_LIMIT_CLIENT'] or rate
+                self._limiters = (RateLimiter(rate, max(burst, 1)),
+                                  RateLimiter(client_rate, max(burst * client_rate / rate, 1)))
+            return self._limiters
+
+    def limit(self, endpoint, config):
+        with self._lock:
+            limit = self._limits.get(endpoint)
+            if limit is None:
+                limit = self._limits[endpoint] = ConcurrencyLimit(
+                    config['CONCURRENCY_LIMIT'], config['CONCURRENCY_QUEUE_SIZE'],
+                    config['CONCURRENCY_QUEUE_TIMEOUT'])
+            return limit
+
+    def admit(self):
+        """ Turns the request away when its customer or its route is over the limit """
+        config = current_app.config
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS or endpoint.startswith('flasgger'):
+            return None
+        if config['RATE_LIMIT'] > 0:
+            customers, clients = self.limiters(config)
+            address = client_address(config['RATE_LIMIT_TRUSTED_PROXIES'])
+            for limiter, key in ((clients, 'client:' + address),
+                                 (customers, customer_key(self.owner))):
+                wait = limiter.take(key) if key else 0
+                if wait:
+                    self.throttled += 1
+                    return retry_response(429, 'Too Many Requests',
+                                          'Rate limit of {} requests per second exceeded'.format(
+                                              limiter.rate), wait)
+        if config['CONCURRENCY_LIMIT'] > 0:
+            limit = self.limit(endpoint, config)
+            if not limit.acquire():
+                self.shed += 1
+                return retry_response(503, 'Service Unavailable',
+                                      'Too many requests in progress, try again later',
+                                      max(limit.timeout, 1))
+            request.environ[ENVIRON_KEY] = limit
+        return None
+
+    def release(self, error=None):
+        """ Frees the place of the request in its route """
+        limit = request.environ.pop(ENVIRON_KEY, None)
+        if limit is not None:
+            limit.release()
+
+    def stats(self):
+        """ Returns the admission counters as a dictionary """
+        with self._lock:
+            limits = dict((endpoint, {"active": limit.active, "waiting": limit.waiting})
+                          for endpoint, limit in self._limits.items())
+        return {"throttled": self.throttled, "shed": self.shed, "routes": limits}
+
+
+admission = Admission()
@@ -0,0 +1,12 @@
+"""
+Performance benchmarks for the Wishlists service
+
+These are not part of the test suite. Run them from the project root, e.g.
+  python -m benchmarks.lookups
+"""
+
+
+def percentile(values, fraction):
+    """ Returns the value below which fraction of values fall, 0.0 when there are none """
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
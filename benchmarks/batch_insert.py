@@ -0,0 +1,66 @@
+"""
+Item insert throughput: one POST per item vs the batch endpoint
+
+Drives the Flask app in process (no network) against a scratch SQLite
+database and reports items/sec for POST /wishlists/<id>/items and
+POST /wishlists/<id>/items/batch.
+
+Usage:
+  python -m benchmarks.batch_insert [--items 5000]
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+import server
+from models import Wishlist, db
+
+
+def make_items(count):
+    return [{'product_id': n, 'name': 'item %d' % n, 'description': 'benchmark item'}
+            for n in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=5000, help='items to insert')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    try:
+        server.init_db()
+        client = server.app.test_client()
+        items = make_items(args.items)
+
+        wishlist = Wishlist(customer_id=1, wishlist_name='single')
+        wishlist.save()
+        start = time.time()
+        for item in items:
+            client.post('/wishlists/{}/items'.format(wishlist.id), data=json.dumps(item),
+                        content_type='application/json')
+        single = args.items / (time.time() - start)
+
+        wishlist = Wishlist(customer_id=1, wishlist_name='batch')
+        wishlist.save()
+        start = time.time()
+        client.post('/wishlists/{}/items/batch'.format(wishlist.id), data=json.dumps(items),
+                    content_type='application/json')
+        batch = args.items / (time.time() - start)
+        db.session.remove()
+    finally:
+        os.remove(path)
+
+    print json.dumps({'items': args.items,
+                      'single_items_per_sec': single,
+                      'batch_items_per_sec': batch,
+                      'speedup': batch / single}, indent=2)
+
+
+if __name__ == '__main__':
+    main()
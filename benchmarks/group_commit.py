@@ -0,0 +1,111 @@
+"""
+Item add throughput with and without group commit
+
+Drives the Flask app in process (no network) against a scratch SQLite
+database with --clients threads that each keep adding items to their own
+wishlist with POST /wishlists/<id>/items, first with every request
+committing on its own and then with GROUP_COMMIT. Reports items/sec, the
+p50/p99 latency and, with group commit, the average batch size.
+
+WAL with synchronous=NORMAL, the service default, does not flush the log
+on every commit, so there is less to gain than with --synchronous FULL
+or on PostgreSQL, where every commit waits for the disk.
+
+Usage:
+  python -m benchmarks.group_commit [--clients 16] [--seconds 5] [--synchronous FULL]
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+
+from benchmarks import percentile
+import server
+from models import Wishlist, db, committer
+
+
+def add_items(wishlist_id, deadline, samples):
+    """ Client thread: adds items until the deadline """
+    client = server.app.test_client()
+    url = '/wishlists/{}/items'.format(wishlist_id)
+    n = 0
+    while time.time() < deadline:
+        start = time.time()
+        client.post(url, data=json.dumps({'product_id': n, 'name': 'item %d' % n,
+                                          'description': 'benchmark item'}),
+                    content_type='application/json')
+        samples.append(time.time() - start)
+        n += 1
+
+
+def run(group_commit, clients, seconds):
+    """ Runs one mode and returns its statistics """
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    server.app.config['GROUP_COMMIT'] = group_commit
+    try:
+        server.init_db()
+        wishlist_ids = []
+        for n in range(clients):
+            wishlist = Wishlist(customer_id=n, wishlist_name='client %d' % n)
+            wishlist.save()
+            wishlist_ids.append(wishlist.id)
+        db.session.remove()
+        batches, writes = committer.batches, committer.writes
+
+        samples = []
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=add_items, args=(wishlist_id, deadline, samples))
+                   for wishlist_id in wishlist_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.session.remove()
+        db.get_engine(server.app).dispose()
+    finally:
+        os.remove(path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    stats = {'items_per_sec': len(samples) / float(seconds),
+             'p50_ms': percentile(samples, 0.5) * 1000,
+             'p99_ms': percentile(samples, 0.99) * 1000}
+    if group_commit:
+        batches, writes = committer.batches - batches, committer.writes - writes
+        stats['avg_batch_size'] = float(writes) / batches if batches else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each mode')
+    parser.add_argument('--max-batch', type=int, default=64, help='GROUP_COMMIT_MAX_BATCH')
+    parser.add_argument('--max-wait', type=float, default=0.005, help='GROUP_COMMIT_MAX_WAIT')
+    parser.add_argument('--synchronous', default='NORMAL', choices=('OFF', 'NORMAL', 'FULL'),
+                        help='SQLite synchronous pragma')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)  # lock waits show up as slow queries
+    server.app.config['SQLITE_PRAGMAS'] = [
+        (name, args.synchronous if name == 'synchronous' else value)
+        for name, value in server.app.config['SQLITE_PRAGMAS']]
+    server.app.config['SQLITE_MAX_OVERFLOW'] = args.clients
+    server.app.config['GROUP_COMMIT_MAX_BATCH'] = args.max_batch
+    server.app.config['GROUP_COMMIT_MAX_WAIT'] = args.max_wait
+    results = {'clients': args.clients, 'synchronous': args.synchronous,
+               'single': run(False, args.clients, args.seconds),
+               'group_commit': run(True, args.clients, args.seconds)}
+    results['speedup'] = results['group_commit']['items_per_sec'] / \
+        results['single']['items_per_sec']
+    print json.dumps(results, indent=2)
+
+
+if __name__ == '__main__':
+    main()
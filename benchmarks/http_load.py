@@ -0,0 +1,403 @@
+"""
+HTTP load test of every wishlist endpoint
+
+Starts the service on a scratch SQLite database (or --database-uri), seeds
+it with customers x wishlists x items, and drives every route in server.py
+with a mixed workload from concurrent client processes for a fixed time.
+Reads go to the seeded data. Writes go to wishlists each client creates for
+itself, so deletes never pull data from under the readers.
+DELETE /wishlists/clear is left out since it would wipe the seeded data.
+
+Prints requests/sec and latency percentiles per route as JSON. Save one
+run with --output and pass it to a later run with --baseline to list the
+routes whose throughput or p99 got worse than --tolerance; the exit status
+is 1 when there are any.
+
+Usage:
+  python -m benchmarks.http_load [--customers 10] [--wishlists 5] [--items 20]
+                                 [--clients 8] [--seconds 10] [--read-ratio 0.9]
+                                 [--server gthread] [--output results.json]
+                                 [--baseline results.json] [--tolerance 0.2]
+"""
+import json
+import time
+import random
+import urllib2
+import argparse
+import subprocess
+import multiprocessing
+
+from benchmarks import percentile
+from benchmarks.wsgi_throughput import SERVERS, serving, urlopen
+
+# routes with fewer requests in the baseline are too noisy to compare
+MIN_REQUESTS = 20
+# times a client tries to create the wishlist or item a write needs
+ATTEMPTS = 3
+
+
+def call(base_url, method, path, body=None):
+    """ Sends one request and returns its status code and JSON body """
+    request = urllib2.Request(base_url + path, json.dumps(body) if body is not None else None,
+                              {'Content-Type': 'application/json'} if body is not None else {})
+    request.get_method = lambda: method
+    try:
+        response = urlopen(request)
+    except urllib2.HTTPError as error:
+        return error.code, None
+    data = response.read()
+    if response.info().gettype() == 'application/json' and data:
+        return response.getcode(), json.loads(data)
+    return response.getcode(), None
+
+
+def seed(base_url, customers, wishlists, items):
+    """ Creates the dataset and returns {wishlist id: [item ids]} per customer """
+    dataset = {}
+    for customer_id in range(1, customers + 1):
+        dataset[customer_id] = {}
+        for n in range(wishlists):
+            _, wishlist = call(base_url, 'POST', '/wishlists',
+                               {'customer_id': customer_id,
+                                'wishlist_name': 'wishlist {}-{}'.format(customer_id, n)})
+            ids = []
+            if items:
+                _, batch = call(base_url, 'POST', '/wishlists/{}/items/batch'.format(wishlist['id']),
+                                [{'product_id': p, 'name': 'item {}'.format(p),
+                                  'description': 'benchmark item'} for p in range(items)])
+                ids = batch['ids']
+            dataset[customer_id][wishlist['id']] = ids
+    return dataset
+
+
+class Client(object):
+    """ One simulated client: picks operations at random and times them """
+
+    # (weight, operation) of the read and write mixes
+    READS = [(1, 'index'), (10, 'get_wishlist'), (3, 'get_wishlist_expanded'),
+             (10, 'get_item'), (2, 'get_item_list'), (8, 'get_wishlist_item_list'),
+             (2, 'get_wishlist_list'), (8, 'get_wishlist_list_by_customer'),
+             (3, 'get_wishlist_list_by_keyword'), (3, 'search_wishlists'),
+             (3, 'search_items'), (3, 'get_item_description'), (2, 'get_customer_summary'),
+             (1, 'get_pool_stats'), (1, 'get_metrics')]
+    WRITES = [(2, 'create_wishlist'), (2, 'update_wishlists'), (4, 'add_item_to_wishlist'),
+              (1, 'add_items_to_wishlist'), (3, 'update_item'), (2, 'delete_item'),
+              (1, 'clear_wishlist'), (1, 'delete_wishlist')]
+
+    def __init__(self, base_url, dataset, read_ratio, rng):
+        self.base_url = base_url
+        self.read_ratio = read_ratio
+        self.rng = rng
+        self.customers = sorted(dataset)
+        self.wishlists = [(customer_id, wishlist_id, ids)
+                          for customer_id in self.customers
+                          for wishlist_id, ids in sorted(dataset[customer_id].items())]
+        self.items = [(wishlist_id, item_id)
+                      for _, wishlist_id, ids in self.wishlists for item_id in ids]
+        self.customer_id = 10 ** 6 + rng.randint(0, 10 ** 6)
+        self.own = {}    # wishlist id -> item ids of the wishlists this client wrote
+        self.samples = {}
+        self.errors = {}
+
+    def request(self, route, method, path, body=None):
+        start = time.time()
+        try:
+            code, data = call(self.base_url, method, path, body)
+        except Exception:    # connection errors count as errors too
+            code, data = None, None
+        if code is not None and code < 400:
+            self.samples.setdefault(route, []).append(time.time() - start)
+        else:
+            self.fail(route)
+        return data
+
+    def fail(self, route):
+        self.errors[route] = self.errors.get(route, 0) + 1
+
+    def run(self, deadline):
+        reads, writes = self.expand(self.READS), self.expand(self.WRITES)
+        self.create_wishlist()
+        while time.time() < deadline:
+            mix = reads if self.rng.random() < self.read_ratio else writes
+            getattr(self, self.rng.choice(mix))()
+
+    @staticmethod
+    def expand(weighted):
+        return [name for weight, name in weighted for _ in range(weight)]
+
+    def some_wishlist(self):
+        return self.rng.choice(self.wishlists)
+
+    def own_wishlist(self, route):
+        """
+        Returns one of this client's wishlists, creating one if needed
+
+        Returns None, and counts an error for route, when ATTEMPTS creates
+        in a row fail (throttled or shed, say).
+        """
+        for _ in range(ATTEMPTS):
+            if self.own:
+                return self.rng.choice(sorted(self.own))
+            self.create_wishlist()
+        self.fail(route)
+        return None
+
+    def own_item(self, route):
+        """ Returns (wishlist id, item id) of one of this client's items, or None like own_wishlist """
+        for _ in range(ATTEMPTS):
+            candidates = [(wishlist_id, item_id)
+                          for wishlist_id, ids in self.own.items() for item_id in ids]
+            if candidates:
+                return self.rng.choice(candidates)
+            self.add_item_to_wishlist()
+        self.fail(route)
+        return None
+
+    # reads
+
+    def index(self):
+        self.request('index', 'GET', '/')
+
+    def get_wishlist(self):
+        self.request('get_wishlist', 'GET', '/wishlists/{}'.format(self.some_wishlist()[1]))
+
+    def get_wishlist_expanded(self):
+        self.request('get_wishlist?expand=items', 'GET',
+                     '/wishlists/{}?expand=items'.format(self.some_wishlist()[1]))
+
+    def get_item(self):
+        self.request('get_item', 'GET', '/items/{}'.format(self.rng.choice(self.items)[1]))
+
+    def get_item_list(self):
+        self.request('get_item_list', 'GET', '/items')
+
+    def get_wishlist_item_list(self):
+        self.request('get_wishlist_item_list', 'GET',
+                     '/wishlists/{}/items'.format(self.some_wishlist()[1]))
+
+    def get_wishlist_list(self):
+        self.request('get_wishlist_list', 'GET', '/wishlists')
+
+    def get_wishlist_list_by_customer(self):
+        self.request('get_wishlist_list?customer_id', 'GET',
+                     '/wishlists?customer_id={}'.format(self.rng.choice(self.customers)))
+
+    def get_wishlist_list_by_keyword(self):
+        customer_id, _, _ = self.some_wishlist()
+        self.request('get_wishlist_list?keyword', 'GET',
+                     '/wishlists?keyword=wishlist%20{}-0'.format(customer_id))
+
+    def search_wishlists(self):
+        customer_id, _, _ = self.some_wishlist()
+        self.request('get_wishlist_list?q', 'GET',
+                     '/wishlists?q=wishlist%20{}-0'.format(customer_id))
+
+    def search_items(self):
+        self.request('get_item_list?q', 'GET', '/items?q=item%20{}'.format(self.rng.randint(0, 9)))
+
+    def get_customer_summary(self):
+        self.request('get_customer_summary', 'GET',
+                     '/customers/{}/summary'.format(self.rng.choice(self.customers)))
+
+    def get_item_description(self):
+        wishlist_id, item_id = self.rng.choice(self.items)
+        self.request('get_item_description', 'GET',
+                     '/wishlists/{}/items/{}/description'.format(wishlist_id, item_id))
+
+    def get_pool_stats(self):
+        self.request('get_pool_stats', 'GET', '/pool')
+
+    def get_metrics(self):
+        self.request('get_metrics', 'GET', '/metrics')
+
+    # writes, all to this client's own wishlists
+
+    def item_body(self):
+        return {'product_id': self.rng.randint(1, 10 ** 6), 'name': 'load item',
+                'description': 'added by the load test'}
+
+    def create_wishlist(self):
+        wishlist = self.request('create_wishlist', 'POST', '/wishlists',
+                                {'customer_id': self.customer_id, 'wishlist_name': 'load test'})
+        if wishlist:
+            self.own[wishlist['id']] = []
+
+    def update_wishlists(self):
+        wishlist_id = self.own_wishlist('update_wishlists')
+        if wishlist_id is None:
+            return
+        self.request('update_wishlists', 'PUT', '/wishlists/{}'.format(wishlist_id),
+                     {'customer_id': self.customer_id,
+                      'wishlist_name': 'load test {}'.format(self.rng.randint(0, 99))})
+
+    def add_item_to_wishlist(self):
+        wishlist_id = self.own_wishlist('add_item_to_wishlist')
+        if wishlist_id is None:
+            return
+        item = self.request('add_item_to_wishlist', 'POST',
+                            '/wishlists/{}/items'.format(wishlist_id), self.item_body())
+        if item:
+            self.own[wishlist_id].append(item['id'])
+
+    def add_items_to_wishlist(self):
+        wishlist_id = self.own_wishlist('add_items_to_wishlist')
+        if wishlist_id is None:
+            return
+        batch = self.request('add_items_to_wishlist', 'POST',
+                             '/wishlists/{}/items/batch'.format(wishlist_id),
+                             [self.item_body() for _ in range(10)])
+        if batch:
+            self.own[wishlist_id].extend(batch['ids'])
+
+    def update_item(self):
+        own = self.own_item('update_item')
+        if own is None:
+            return
+        wishlist_id, item_id = own
+        self.request('update_item', 'PUT', '/wishlists/{}/items/{}'.format(wishlist_id, item_id),
+                     dict(self.item_body(), wishlist_id=wishlist_id))
+
+    def delete_item(self):
+        own = self.own_item('delete_item')
+        if own is None:
+            return
+        wishlist_id, item_id = own
+        self.request('delete_item', 'DELETE',
+                     '/wishlists/{}/items/{}'.format(wishlist_id, item_id))
+        self.own[wishlist_id].remove(item_id)
+
+    def clear_wishlist(self):
+        wishlist_id = self.own_wishlist('clear_wishlist')
+        if wishlist_id is None:
+            return
+        self.request('clear_wishlist', 'PUT', '/wishlists/{}/clear'.format(wishlist_id))
+        self.own[wishlist_id] = []
+
+    def delete_wishlist(self):
+        if len(self.own) == 1:
+            self.create_wishlist()
+        wishlist_id = self.own_wishlist('delete_wishlist')
+        if wishlist_id is None:
+            return
+        self.request('delete_wishlist', 'DELETE', '/wishlists/{}'.format(wishlist_id))
+        del self.own[wishlist_id]
+
+
+def client(base_url, dataset, read_ratio, seed_value, deadline, results):
+    """ Client process: runs one Client until the deadline """
+    load_client = Client(base_url, dataset, read_ratio, random.Random(seed_value))
+    load_client.run(deadline)
+    results.put((load_client.samples, load_client.errors))
+
+
+def summarize(samples, errors, seconds):
+    return {
+        'requests': len(samples),
+        'requests_per_sec': len(samples) / float(seconds),
+        'errors': errors,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p90_ms': percentile(samples, 0.90) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def run(base_url, args):
+    """ Seeds the database and runs the clients, returns the results """
+    start = time.time()
+    dataset = seed(base_url, args.customers, args.wishlists, args.items)
+    seed_seconds = time.time() - start
+
+    results = multiprocessing.Queue()
+    deadline = time.time() + args.seconds
+    workers = [multiprocessing.Process(target=client, args=(base_url, dataset, args.read_ratio,
+                                                            args.seed + n, deadline, results))
+               for n in range(args.clients)]
+    for worker in workers:
+        worker.start()
+    samples, errors = {}, {}
+    for _ in workers:
+        worker_samples, worker_errors = results.get()
+        for route, values in worker_samples.items():
+            samples.setdefault(route, []).extend(values)
+        for route, count in worker_errors.items():
+            errors[route] = errors.get(route, 0) + count
+    for worker in workers:
+        worker.join()
+
+    routes = dict((route, summarize(samples.get(route, []), errors.get(route, 0), args.seconds))
+                  for route in set(samples) | set(errors))
+    return {
+        'seed_seconds': seed_seconds,
+        'routes': routes,
+        'total': summarize([value for values in samples.values() for value in values],
+                           sum(errors.values()), args.seconds),
+    }
+
+
+def compare(baseline, results, tolerance):
+    """ Lists the routes that got slower than the baseline by more than tolerance """
+    regressions = []
+    for route, before in sorted(baseline['routes'].items()):
+        after = results['routes'].get(route)
+        if after is None or before['requests'] < MIN_REQUESTS:
+            continue
+        if after['requests_per_sec'] < before['requests_per_sec'] * (1 - tolerance):
+            regressions.append({'route': route, 'metric': 'requests_per_sec',
+                                'baseline': before['requests_per_sec'],
+                                'current': after['requests_per_sec']})
+        if after['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append({'route': route, 'metric': 'p99_ms',
+                                'baseline': before['p99_ms'], 'current': after['p99_ms']})
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--customers', type=int, default=10, help='customers to seed')
+    parser.add_argument('--wishlists', type=int, default=5, help='wishlists per customer')
+    parser.add_argument('--items', type=int, default=20, help='items per wishlist')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the run')
+    parser.add_argument('--read-ratio', type=float, default=0.9,
+                        help='fraction of the requests that are reads')
+    parser.add_argument('--server', default='gthread', choices=sorted(SERVERS),
+                        help='server to run the service with')
+    parser.add_argument('--database-uri', help='database to use instead of a scratch SQLite file')
+    parser.add_argument('--port', type=int, default=5056, help='port to run the server on')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the first client')
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    command, env = SERVERS[args.server]
+    with serving(command, env, args.port, args.database_uri) as base_url:
+        results = run(base_url, args)
+    results['commit'] = git_commit()
+    results['config'] = dict((key, getattr(args, key)) for key in
+                             ('customers', 'wishlists', 'items', 'clients', 'seconds',
+                              'read_ratio', 'server'))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            results['regressions'] = compare(json.load(baseline_file), results, args.tolerance)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    if results.get('regressions'):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
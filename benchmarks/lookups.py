@@ -0,0 +1,105 @@
+"""
+Lookup latency benchmark for the find_by_* helpers
+
+Seeds a scratch SQLite database with an increasing number of rows and times
+Item.find_by_wishlist_id, Item.find_by_name, Wishlist.find_by_customer_id and
+Wishlist.find_by_wishlist_name, and the first page of Wishlist.search and
+Item.search by name prefix and by word. With the lookup and search indexes in
+place the latency should stay flat as the table grows.
+
+Usage:
+  python -m benchmarks.lookups [--sizes 10000,100000,1000000] [--repeat 200]
+"""
+import os
+import json
+import random
+import timeit
+import logging
+import argparse
+import tempfile
+
+from flask import Flask
+
+from models import Item, Wishlist, db, paginate
+
+ITEMS_PER_WISHLIST = 10
+BATCH = 10000
+
+
+def seed(total_items):
+    """ Bulk loads total_items items spread over total_items / 10 wishlists """
+    wishlists = max(total_items // ITEMS_PER_WISHLIST, 1)
+    for start in range(0, wishlists, BATCH):
+        rows = [{'customer_id': n % 1000, 'wishlist_name': 'wishlist %d' % n}
+                for n in range(start, min(start + BATCH, wishlists))]
+        db.session.execute(Wishlist.__table__.insert(), rows)
+    for start in range(0, total_items, BATCH):
+        rows = [{'wishlist_id': n // ITEMS_PER_WISHLIST + 1, 'product_id': n,
+                 'name': 'item %d' % n, 'description': 'benchmark item'}
+                for n in range(start, min(start + BATCH, total_items))]
+        db.session.execute(Item.__table__.insert(), rows)
+    db.session.commit()
+    return wishlists
+
+
+def time_lookup(func, keys, repeat):
+    """ Returns the mean latency of func(key) in microseconds """
+    keys = [random.choice(keys) for _ in range(repeat)]
+    iterator = iter(keys)
+    elapsed = timeit.timeit(lambda: list(func(next(iterator))), number=repeat)
+    return elapsed / repeat * 1e6
+
+
+def time_search(model, texts, repeat):
+    """ Returns the mean latency of a page of 100 search results in microseconds """
+    return time_lookup(lambda text: paginate(*model.search(text), limit=100)[0], texts, repeat)
+
+
+def run(size, repeat):
+    """ Benchmarks every lookup against a fresh database of the given size """
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    try:
+        with app.app_context():
+            db.init_app(app)
+            db.create_all()
+            wishlists = seed(size)
+            result = {
+                'rows': size,
+                'find_by_wishlist_id_us': time_lookup(
+                    Item.find_by_wishlist_id, range(1, wishlists + 1), repeat),
+                'find_by_name_us': time_lookup(
+                    Item.find_by_name, ['item %d' % n for n in range(size)], repeat),
+                'find_by_customer_id_us': time_lookup(
+                    Wishlist.find_by_customer_id, range(1000), repeat),
+                'find_by_wishlist_name_us': time_lookup(
+                    Wishlist.find_by_wishlist_name,
+                    ['wishlist %d' % n for n in range(wishlists)], repeat),
+                'search_prefix_us': time_search(
+                    Wishlist, ['Wishlist %d' % n for n in range(wishlists)], repeat),
+                'search_word_us': time_search(
+                    Item, [str(n) for n in range(size)], repeat),
+            }
+            db.session.remove()
+    finally:
+        os.remove(path)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated item counts')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='lookups per measurement')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    results = [run(int(size), args.repeat) for size in args.sizes.split(',')]
+    print json.dumps(results, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Micro-benchmarks of the model layer
+
+Times Item/Wishlist serialize and deserialize, the find_by_* helpers and
+jsonify of the serialized lists, on 1, 1k and 100k objects, against a
+scratch SQLite database. Each operation runs over all the objects at once,
+the best of --repeat runs is kept, and the time is reported per call and
+per object.
+
+Python 2 has no tracemalloc, so allocations are counted with the gc module
+instead: objects counts what the result of one run holds, i.e. the new
+objects gc tracks (lists, model instances...) and the dicts, strings and
+numbers reachable from them, and kb is their total size.
+
+Usage:
+  python -m benchmarks.model_ops [--sizes 1,1000,100000] [--repeat 3]
+"""
+import gc
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+from flask import jsonify
+
+import server
+from models import Item, Wishlist, db
+
+BATCH = 10000
+
+
+def seed(count):
+    """ Replaces the tables with count Wishlists of customer 1 and count Items in Wishlist 1 """
+    Wishlist.clear_db()
+    for start in range(0, count, BATCH):
+        size = min(BATCH, count - start)
+        db.session.execute(Wishlist.__table__.insert(),
+                           [{'customer_id': 1, 'wishlist_name': 'benchmark'}] * size)
+        db.session.execute(Item.__table__.insert(),
+                           [{'wishlist_id': 1, 'product_id': start + n, 'name': 'benchmark',
+                             'description': 'benchmark item'} for n in range(size)])
+    db.session.commit()
+
+
+def allocations(func):
+    """ Returns the number and size in kb of the objects one call of func keeps alive """
+    gc.collect()
+    gc.disable()
+    try:
+        before = set(id(obj) for obj in gc.get_objects())
+        result = func()
+        everything = gc.get_objects()
+        new = [obj for obj in everything
+               if id(obj) not in before and obj is not before and obj is not everything]
+        # dicts and tuples holding only strings and numbers are not tracked
+        # by gc, so walk into them from the new tracked objects
+        seen = set(id(obj) for obj in new)
+        pending = list(new)
+        size = 0
+        while pending:
+            obj = pending.pop()
+            size += sys.getsizeof(obj)
+            for ref in gc.get_referents(obj):
+                if not gc.is_tracked(ref) and id(ref) not in seen:
+                    seen.add(id(ref))
+                    pending.append(ref)
+        del result
+        return len(seen), size / 1024.0
+    finally:
+        gc.enable()
+
+
+def measure(func, count, repeat):
+    """ Times func, which handles count objects, and counts what it allocates """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    objects, kb = allocations(func)
+    return {
+        'ms': best * 1000,
+        'us_per_object': best / count * 1e6,
+        'objects': objects,
+        'kb': kb,
+    }
+
+
+def fresh(query):
+    """ Runs query in a new session, like a request would """
+    db.session.remove()
+    return query().all()
+
+
+def run(count, repeat):
+    """ Benchmarks every operation on count objects """
+    seed(count)
+    items = fresh(lambda: Item.query.order_by(Item.id).limit(count))
+    wishlists = fresh(lambda: Wishlist.query.order_by(Wishlist.id).limit(count))
+    item_dicts = [item.serialize() for item in items]
+    wishlist_dicts = [wishlist.serialize() for wishlist in wishlists]
+
+    operations = [
+        ('Item.serialize', lambda: [item.serialize() for item in items]),
+        ('Item.deserialize', lambda: [Item().deserialize(data, 1) for data in item_dicts]),
+        ('Wishlist.serialize', lambda: [wishlist.serialize() for wishlist in wishlists]),
+        ('Wishlist.deserialize', lambda: [Wishlist().deserialize(data)
+                                          for data in wishlist_dicts]),
+        ('Item.find_by_wishlist_id', lambda: fresh(lambda: Item.find_by_wishlist_id(1))),
+        ('Item.find_by_name', lambda: fresh(lambda: Item.find_by_name('benchmark'))),
+        ('Wishlist.find_by_customer_id', lambda: fresh(lambda: Wishlist.find_by_customer_id(1))),
+        ('Wishlist.find_by_wishlist_name',
+         lambda: fresh(lambda: Wishlist.find_by_wishlist_name('benchmark'))),
+        ('jsonify items', lambda: jsonify(item_dicts)),
+        ('jsonify wishlists', lambda: jsonify(wishlist_dicts)),
+    ]
+    results = {}
+    with server.app.test_request_context():
+        for name, func in operations:
+            results[name] = measure(func, count, repeat)
+    db.session.remove()
+    return {'objects': count, 'operations': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1,1000,100000', help='comma separated object counts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each operation')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    server.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    try:
+        server.init_db()
+        results = [run(int(size), args.repeat) for size in args.sizes.split(',')]
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
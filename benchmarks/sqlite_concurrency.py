@@ -0,0 +1,125 @@
+"""
+SQLite concurrency benchmark: rollback journal vs the WAL profile
+
+Runs reader processes doing indexed item lookups while a writer process
+keeps inserting items, first with SQLite's default rollback journal and
+then with the pragmas the service uses (server.app.config['SQLITE_PRAGMAS']).
+Processes are used instead of threads so the GIL doesn't hide lock waits.
+Reports reader throughput and latency percentiles and writer commits/sec
+for each mode. With WAL the readers should no longer stall behind the
+writer.
+
+Usage:
+  python -m benchmarks.sqlite_concurrency [--readers 4] [--seconds 5] [--dir db]
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from benchmarks import percentile
+from models import sqlite_pragma_listener
+import server
+
+SCHEMA = ('CREATE TABLE items (id INTEGER PRIMARY KEY, wishlist_id INTEGER NOT NULL, '
+          'product_id INTEGER NOT NULL, name VARCHAR(63) NOT NULL, description VARCHAR(100))',
+          'CREATE INDEX ix_items_wishlist_id ON items (wishlist_id)')
+INSERT = ('INSERT INTO items (wishlist_id, product_id, name, description) '
+          'VALUES (?, ?, ?, ?)')
+WISHLISTS = 1000
+
+
+def make_engine(path, pragmas):
+    return create_engine('sqlite:///' + path, poolclass=QueuePool,
+                         connect_args={'check_same_thread': False},
+                         pool_events=[(sqlite_pragma_listener(pragmas), 'connect')])
+
+
+def read(path, pragmas, deadline, results):
+    """ Reader process: times lookups until the deadline """
+    engine = make_engine(path, pragmas)
+    samples = []
+    while time.time() < deadline:
+        start = time.time()
+        with engine.connect() as conn:
+            conn.execute('SELECT * FROM items WHERE wishlist_id = ?',
+                         random.randrange(WISHLISTS)).fetchall()
+        samples.append(time.time() - start)
+    results.put(('read', samples))
+
+
+def write(path, pragmas, deadline, results):
+    """ Writer process: commits batches of inserts until the deadline """
+    engine = make_engine(path, pragmas)
+    commits = 0
+    while time.time() < deadline:
+        with engine.begin() as conn:
+            for _ in range(50):
+                conn.execute(INSERT, random.randrange(WISHLISTS), 1, 'new', 'x')
+        commits += 1
+    results.put(('write', commits))
+
+
+def run(pragmas, readers, seconds, directory):
+    """ Runs one mode and returns its statistics """
+    handle, path = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(handle)
+    engine = make_engine(path, pragmas)
+    for statement in SCHEMA:
+        engine.execute(statement)
+    engine.execute(INSERT, [(n % WISHLISTS, n, 'item', 'seed') for n in range(WISHLISTS * 10)])
+    engine.dispose()
+
+    results = multiprocessing.Queue()
+    deadline = time.time() + 0.5 + seconds
+    processes = [multiprocessing.Process(target=read, args=(path, pragmas, deadline, results))
+                 for _ in range(readers)]
+    processes.append(multiprocessing.Process(target=write, args=(path, pragmas, deadline, results)))
+    for process in processes:
+        process.start()
+    samples, commits = [], 0
+    for _ in processes:
+        kind, value = results.get()
+        if kind == 'read':
+            samples.extend(value)
+        else:
+            commits = value
+    for process in processes:
+        process.join()
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    return {
+        'reads_per_sec': len(samples) / float(seconds),
+        'read_p50_ms': percentile(samples, 0.50) * 1000,
+        'read_p99_ms': percentile(samples, 0.99) * 1000,
+        'read_max_ms': max(samples) * 1000 if samples else 0.0,
+        'commits_per_sec': commits / float(seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--readers', type=int, default=4, help='reader processes')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each run')
+    parser.add_argument('--dir', default='db',
+                        help='where to put the scratch database, use a real disk so fsyncs count')
+    args = parser.parse_args()
+    busy_timeout = [('busy_timeout', 5000)]
+    results = {
+        'rollback_journal': run(busy_timeout, args.readers, args.seconds, args.dir),
+        'wal_profile': run(server.app.config['SQLITE_PRAGMAS'], args.readers, args.seconds,
+                           args.dir),
+    }
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Throughput of the Flask development server vs gunicorn
+
+Starts the service on a scratch SQLite database with each server in turn:
+  dev      `python server.py` (the old Procfile)
+  gthread  `gunicorn -c gunicorn_config.py wsgi:app`
+  gevent   the same with GUNICORN_WORKER_CLASS=gevent
+and drives the same GET endpoints at the same concurrency against each.
+Reports requests/sec and latency percentiles for each as JSON.
+
+--slow-clients adds clients that trickle their request headers in over a
+second, like clients on a bad mobile connection. The single-threaded
+development server stalls behind each of them, gthread workers stall once
+every thread is waiting on one, and gevent workers keep going.
+
+Usage:
+  python -m benchmarks.wsgi_throughput [--clients 16] [--slow-clients 0]
+                                       [--servers dev,gthread,gevent] [--seconds 10]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import urllib2
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+
+from benchmarks import percentile
+
+PATHS = ['/wishlists/1', '/wishlists/1/items', '/wishlists?customer_id=1', '/items/1']
+
+# talk to the local server directly, even when an HTTP proxy is configured
+urlopen = urllib2.build_opener(urllib2.ProxyHandler({})).open
+
+GUNICORN = [sys.executable, '-m', 'gunicorn.app.wsgiapp', '-c', 'gunicorn_config.py', 'wsgi:app']
+# command line and extra environment of each server
+SERVERS = {
+    'dev': ([sys.executable, 'server.py'], {}),
+    'gthread': (GUNICORN, {'GUNICORN_WORKER_CLASS': 'gthread'}),
+    'gevent': (GUNICORN, {'GUNICORN_WORKER_CLASS': 'gevent'}),
+}
+
+
+def wait_until_up(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(base_url + '/wishlists').read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError('server at {} did not start'.format(base_url))
+
+
+def seed(base_url):
+    def post(path, data):
+        request = urllib2.Request(base_url + path, json.dumps(data),
+                                  {'Content-Type': 'application/json'})
+        return json.loads(urlopen(request).read())
+    wishlist = post('/wishlists', {'customer_id': 1, 'wishlist_name': 'benchmark'})
+    post('/wishlists/{}/items/batch'.format(wishlist['id']),
+         [{'product_id': n, 'name': 'item %d' % n, 'description': 'benchmark'}
+          for n in range(20)])
+
+
+def client(base_url, deadline, results):
+    """ Client process: requests the paths in turn until the deadline """
+    samples, errors, n = [], 0, 0
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            urlopen(base_url + PATHS[n % len(PATHS)]).read()
+            samples.append(time.time() - start)
+        except Exception:
+            errors += 1
+        n += 1
+    results.put((samples, errors))
+
+
+def slow_clients(port, count, deadline):
+    """
+    Client process for count slow clients
+
+    Each round opens count connections, sends the first line of a request
+    on each, waits a second, then finishes the requests and reads the
+    responses.
+    """
+    while time.time() < deadline:
+        conns = []
+        for _ in range(count):
+            try:
+                conn = socket.create_connection(('127.0.0.1', port), timeout=30)
+                conn.sendall('GET /wishlists/1 HTTP/1.1\r\n')
+                conns.append(conn)
+            except socket.error:
+                break
+        time.sleep(1)
+        for conn in conns:
+            try:
+                conn.sendall('Host: localhost\r\nConnection: close\r\n\r\n')
+            except socket.error:
+                pass
+        for conn in conns:
+            try:
+                while conn.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            conn.close()
+
+
+@contextmanager
+def serving(command, extra_env, port, database_uri=None):
+    """
+    Runs the server started by command while the block runs
+
+    Yields its base URL. Without database_uri the server gets a scratch
+    SQLite database that is removed afterwards.
+    """
+    path = None
+    if database_uri is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        database_uri = 'sqlite:///' + path
+    env = dict(os.environ, PORT=str(port), DATABASE_URI=database_uri, **extra_env)
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, env=env, stdout=devnull, stderr=devnull)
+        try:
+            base_url = 'http://127.0.0.1:{}'.format(port)
+            wait_until_up(base_url)
+            yield base_url
+        finally:
+            process.terminate()
+            process.wait()
+            for suffix in ('', '-wal', '-shm'):
+                if path and os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+
+def measure(command, extra_env, port, clients, slow_count, seconds):
+    """ Starts the server with command and measures it """
+    with serving(command, extra_env, port) as base_url:
+        seed(base_url)
+        results = multiprocessing.Queue()
+        deadline = time.time() + seconds
+        workers = [multiprocessing.Process(target=client, args=(base_url, deadline, results))
+                   for _ in range(clients)]
+        slow = [multiprocessing.Process(target=slow_clients, args=(port, slow_count, deadline))
+                ] if slow_count else []
+        for worker in workers + slow:
+            worker.start()
+        samples, errors = [], 0
+        for _ in workers:
+            worker_samples, worker_errors = results.get()
+            samples.extend(worker_samples)
+            errors += worker_errors
+        for worker in workers + slow:
+            worker.join()
+    return {
+        'requests_per_sec': len(samples) / float(seconds),
+        'errors': errors,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client processes')
+    parser.add_argument('--slow-clients', type=int, default=0,
+                        help='extra clients that send their headers slowly')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of each run')
+    parser.add_argument('--port', type=int, default=5055, help='port to run the servers on')
+    parser.add_argument('--servers', default='dev,gthread,gevent',
+                        help='comma separated servers to measure')
+    args = parser.parse_args()
+    results = {}
+    for name in args.servers.split(','):
+        command, env = SERVERS[name]
+        results[name] = measure(command, env, args.port, args.clients, args.slow_clients,
+                                args.seconds)
+    results['clients'] = args.clients
+    results['slow_clients'] = args.slow_clients
+    print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
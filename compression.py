@@ -0,0 +1,207 @@
+"""
+Response compression for the Wishlists service
+
+Compression compresses responses with gzip, or with brotli when the brotli
+package is installed and the client prefers it. Only responses of the
+COMPRESS_MIMETYPES that are at least COMPRESS_MIN_SIZE bytes long are
+compressed, at COMPRESS_LEVEL. Streamed responses are compressed with gzip
+one chunk at a time, so they still go out as they are generated.
+
+StaticAssets serves the files of the static folder from memory. Each file
+is read and compressed once, at the highest level, when the app starts.
+Stylesheets and scripts can also be requested under a fingerprinted name
+that includes a hash of their content, e.g. css/site.0123456789ab.css.
+Such a URL always returns the same bytes, so it is cached for
+STATIC_MAX_AGE seconds; the plain names are revalidated with their ETag.
+The HTML files are served with their links to stylesheets and scripts
+rewritten to the fingerprinted URLs.
+"""
+import os
+import re
+import zlib
+import hashlib
+from flask import Response, current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # zlib.compressobj() writes a gzip header and trailer
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)  # in order of preference
+# the static files kept in memory, by extension; anything else goes to Flask's static view
+ASSET_TYPES = {'.html': 'text/html', '.css': 'text/css', '.js': 'application/javascript'}
+FINGERPRINTED = ('text/css', 'application/javascript')
+
+
+def negotiate(encodings):
+    """ Returns the one of encodings the client accepts best, or None """
+    best, best_quality = None, 0
+    for encoding in encodings:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level):
+    """
+    Compresses data with gzip or br
+
+    Args:
+        data (str): the bytes to compress
+        encoding (str): gzip or br
+        level (int): the brotli quality, 1 to 11; gzip stops at 9
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    encoder = zlib.compressobj(min(level, 9), zlib.DEFLATED, GZIP_WBITS)
+    return encoder.compress(data) + encoder.flush()
+
+
+def compress_chunks(chunks, level):
+    """ Compresses an iterable of chunks with gzip, yielding one compressed chunk for each """
+    encoder = zlib.compressobj(min(level, 9), zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield encoder.flush()
+
+
+class Compression(object):
+    """ Compresses the responses of an app for the clients that accept it """
+
+    def init_app(self, app):
+        """ Compresses every response of app that qualifies """
+        app.config.setdefault('COMPRESS_MIMETYPES', (
+            'application/json', 'application/x-ndjson', 'text/html', 'text/css',
+            'application/javascript', 'text/javascript', 'text/plain'))
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        """ Compresses a response unless it is too small or of another type """
+        config = current_app.config
+        if response.status_code < 200 or response.status_code in (204, 304) or \
+                response.mimetype not in config['COMPRESS_MIMETYPES'] or \
+                'Content-Encoding' in response.headers or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.is_streamed:
+            encoding = negotiate(('gzip',))
+            if encoding is None:
+                return response
+            response.response = compress_chunks(response.response, config['COMPRESS_LEVEL'])
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            encoding = negotiate(ENCODINGS)
+            if encoding is None:
+                return response
+            response.set_data(compress(data, encoding, config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = encoding
+        # the compressed bytes differ, but they are the same representation
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+class Asset(object):
+    """ A static file, compressed ahead of time """
+
+    def __init__(self, filename, data, mimetype):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.fingerprint = hashlib.md5(data).hexdigest()[:12]
+        root, extension = os.path.splitext(filename)
+        self.fingerprinted = '{}.{}{}'.format(root, self.fingerprint, extension)
+        self.bodies = {None: data}
+        for encoding in ENCODINGS:
+            body = compress(data, encoding, 11)
+            if len(body) < len(data):
+                self.bodies[encoding] = body
+        self.encodings = tuple(encoding for encoding in ENCODINGS if encoding in self.bodies)
+
+    def response(self, max_age=None):
+        """
+        Returns the asset in the encoding the client accepts best
+
+        With max_age the response can be cached that long without being
+        revalidated, otherwise it has to be revalidated with its ETag.
+        """
+        encoding = negotiate(self.encodings)
+        response = Response(self.bodies[encoding], mimetype=self.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(self.fingerprint + ('-' + encoding if encoding else ''))
+        if max_age:
+            response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(max_age)
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+
+class StaticAssets(object):
+    """ Serves the static folder of an app from memory, precompressed and fingerprinted """
+
+    def __init__(self):
+        self._assets = {}
+        self._fingerprinted = {}
+
+    def init_app(self, app):
+        """ Loads the static files of app and takes over its static view """
+        app.config.setdefault('STATIC_MAX_AGE', 365 * 24 * 3600)
+        self.load(app.static_folder, app.static_url_path)
+        app.view_functions['static'] = self.send
+
+    def load(self, folder, url_path):
+        """ Reads and compresses the files of folder, served under url_path """
+        files = {}
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                mimetype = ASSET_TYPES.get(os.path.splitext(name)[1])
+                if mimetype:
+                    filename = os.path.relpath(path, folder).replace(os.sep, '/')
+                    with open(path, 'rb') as asset_file:
+                        files[filename] = (asset_file.read(), mimetype)
+
+        assets = dict((filename, Asset(filename, data, mimetype))
+                      for filename, (data, mimetype) in files.items()
+                      if mimetype in FINGERPRINTED)
+        # point the pages at the fingerprinted files
+        prefix = url_path.strip('/') + '/'
+        links = re.compile(r'''((?:src|href)\s*=\s*["']/?{})([^"'?#]+)'''.format(
+            re.escape(prefix)))
+
+        def fingerprinted(match):
+            asset = assets.get(match.group(2))
+            return match.group(1) + (asset.fingerprinted if asset else match.group(2))
+        for filename, (data, mimetype) in files.items():
+            if mimetype not in FINGERPRINTED:
+                assets[filename] = Asset(filename, links.sub(fingerprinted, data), mimetype)
+
+        self._assets = assets
+        self._fingerprinted = dict((asset.fingerprinted, asset) for asset in assets.values()
+                                   if asset.mimetype in FINGERPRINTED)
+
+    def send(self, filename):
+        """ View of the static files """
+        asset = self._fingerprinted.get(filename)
+        if asset is not None:
+            return asset.response(current_app.config['STATIC_MAX_AGE'])
+        asset = self._assets.get(filename)
+        if asset is not None:
+            return asset.response()
+        return current_app.send_static_file(filename)
+
+
+compression = Compression()
+static_assets = StaticAssets()
@@ -0,0 +1,152 @@
+"""
+Group commit for the Wishlists service
+
+Every commit waits for the database to flush its log to disk, so clients
+that add items one request at a time are limited by the flush latency,
+not by the work of each insert. GroupCommitter gathers the writes of
+concurrent requests for up to max_wait seconds, or until max_batch of them
+are waiting, and runs them in one transaction with one flush. A request
+waits until the transaction holding its write has committed, so it is only
+acknowledged once the write is durable.
+
+A write is a function that takes a connection and returns a result, e.g.
+the id of the row it inserted. When a batch fails, each of its writes is
+retried in a transaction of its own, so a bad write only fails its own
+request.
+"""
+import os
+import time
+import Queue
+import bisect
+import threading
+
+# upper bounds of the batch size histogram, the last bucket (+Inf) is implicit
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Write(object):
+    """ A write waiting for its batch to be committed """
+
+    def __init__(self, function):
+        self.function = function
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+    Commits the writes of concurrent requests together
+
+    Writes are run one after the other by a background thread, which is
+    started on the first write and again after a fork. A max_batch of 0
+    disables group commit.
+    """
+
+    def __init__(self, max_batch=0, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.engine = None
+        self.batches = 0
+        self.writes = 0
+        self.retries = 0
+        # [count, sum, bucket counts...], like the histograms in metrics.py
+        self.batch_sizes = [0, 0] + [0] * (len(BATCH_BUCKETS) + 1)
+        self._pid = None
+        self._queue = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_batch > 0
+
+    def configure(self, engine, max_batch, max_wait):
+        """ Commits through engine, max_batch writes at a time after waiting up to max_wait seconds """
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue()
+            thread = threading.Thread(target=self._run, name='group-commit')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            batch = [queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(queue.get_nowait())
+                except Queue.Empty:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(queue.get(timeout=timeout))
+                    except Queue.Empty:
+                        break
+            self.commit(batch)
+
+    def commit(self, batch):
+        """ Runs a batch of writes in one transaction and wakes up their requests """
+        try:
+            with self.engine.begin() as connection:
+                results = [write.function(connection) for write in batch]
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].error = error
+            else:
+                self.retries += 1
+                for write in batch:
+                    try:
+                        with self.engine.begin() as connection:
+                            write.result = write.function(connection)
+                    except Exception as error:
+                        write.error = error
+        else:
+            for write, result in zip(batch, results):
+                write.result = result
+        self.batches += 1
+        self.writes += len(batch)
+        self.batch_sizes[0] += 1
+        self.batch_sizes[1] += len(batch)
+        self.batch_sizes[2 + bisect.bisect_left(BATCH_BUCKETS, len(batch))] += 1
+        for write in batch:
+            write.done.set()
+
+    def submit(self, function):
+        """
+        Runs function(connection) in the next batch and waits for it to be committed
+
+        Returns:
+            the result of function
+        Raises:
+            the exception function raised, or the one that failed its commit
+        """
+        if self._pid != os.getpid():
+            self._start()
+        write = Write(function)
+        self._queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def stats(self):
+        """ Returns the committer counters as a dictionary """
+        return {
+            "enabled": self.enabled,
+            "max_batch": self.max_batch,
+            "max_wait": self.max_wait,
+            "batches": self.batches,
+            "writes": self.writes,
+            "retries": self.retries,
+            "avg_batch_size": float(self.writes) / self.batches if self.batches else 0.0
+            }
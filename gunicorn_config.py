@@ -0,0 +1,98 @@
+"""
+Gunicorn settings for running the Wishlists service in production
+
+Every setting can be changed through the environment:
+  PORT                          port to listen on (5000)
+  WEB_CONCURRENCY               worker processes (2)
+  GUNICORN_WORKER_CLASS         gthread (default) or gevent
+  GUNICORN_THREADS              threads per gthread worker (4)
+  GUNICORN_WORKER_CONNECTIONS   concurrent clients per gevent worker (1000)
+  GUNICORN_TIMEOUT              seconds before a silent worker is restarted (30)
+  METRICS_DIR                   where workers share their request metrics (a new
+                                temporary directory)
+  ENTITY_CACHE_SIZE             entries in each worker's entity cache (0, off,
+                                with more than one worker)
+
+gthread workers serve one request per thread. gevent workers serve every
+request in its own greenlet and switch whenever one waits on the network
+or on PostgreSQL, so thousands of slow clients don't need a thread each.
+"""
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+keepalive = 5
+
+# Import the app, and create the tables, once in the master. gevent workers
+# import it after fork instead, once the standard library has been patched,
+# so that the locks and sockets created at import are cooperative.
+preload_app = worker_class != 'gevent'
+accesslog = '-'
+
+# A worker cannot see what the others change, so its entity cache could
+# serve rows up to ENTITY_CACHE_TTL seconds old. Leave it off unless asked.
+if workers > 1:
+    os.environ.setdefault('ENTITY_CACHE_SIZE', '0')
+
+# every worker writes its metrics here so /metrics can add them all up
+if 'METRICS_DIR' not in os.environ:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='wishlists-metrics-')
+    _own_metrics_dir = True
+else:
+    _own_metrics_dir = False
+
+# snapshots left in METRICS_DIR by the workers of an earlier run are ignored
+os.environ['METRICS_STARTED'] = repr(time.time())
+
+
+def on_starting(server):
+    """ Creates and upgrades the tables once, before the gevent workers start """
+    if not preload_app:
+        # in a child process, so that the master does not import the app before
+        # gevent patches the workers; every worker creating them at once would fail
+        subprocess.check_call([sys.executable, '-c', 'import server; server.init_db()'])
+        os.environ['DB_SCHEMA_READY'] = 'true'
+
+
+def pre_fork(server, worker):
+    """ Closes the master's database connections so no worker inherits them """
+    if preload_app:
+        from models import db
+        db.session.remove()
+        db.engine.dispose()
+
+
+def post_fork(server, worker):
+    """ Starts every worker with an empty connection pool """
+    if worker_class == 'gevent':
+        # make psycopg2 yield to other greenlets while it waits on PostgreSQL
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:  # psycopg2 isn't installed when running on SQLite
+            return
+        patch_psycopg()
+    else:
+        from models import db
+        db.engine.dispose()
+
+
+def worker_exit(server, worker):
+    """ Saves the worker's last metrics so they are still counted after it exits """
+    from metrics import metrics
+    if metrics.directory:
+        metrics.dump()
+
+
+def on_exit(server):
+    """ Removes the metrics directory gunicorn created """
+    if _own_metrics_dir:
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,207 @@
+"""
+Idempotency keys for the Wishlists service
+
+A client that retries a POST after a timeout cannot tell whether the first
+attempt created the wishlist or item, so it may create it twice. When the
+request carries an Idempotency-Key header, the first successful response
+for that key, method and path is stored and a retry gets it back, with an
+Idempotent-Replayed header, instead of running the view again.
+
+A key reused with a different body is rejected with 422, and a retry that
+arrives while the first request is still running gets a 409. Responses
+are kept for IDEMPOTENCY_TTL seconds. With IDEMPOTENCY_STORE 'memory' each
+process keeps up to IDEMPOTENCY_CACHE_SIZE of them; with 'database' they
+are kept in the idempotency_keys table, shared by every worker.
+"""
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import Response, abort, current_app, make_response, request
+from sqlalchemy import exc
+
+from models import IdempotencyRecord, db
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# a running request that has not finished after this many seconds is assumed to have died
+CLAIM_TIMEOUT = 60
+
+
+class StoredResponse(object):
+    """ The response to a request, or a placeholder while it runs (status None) """
+
+    def __init__(self, fingerprint, status=None, body=None, location=None,
+                 mimetype='application/json'):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.body = body
+        self.location = location
+        self.mimetype = mimetype
+
+    @property
+    def running(self):
+        return self.status is None
+
+    def response(self):
+        """ Returns the stored response, marked as a replay """
+        response = Response(self.body, self.status, mimetype=self.mimetype)
+        if self.location:
+            response.headers['Location'] = self.location
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+
+class MemoryStore(object):
+    """ Keeps the responses of up to size keys for ttl seconds in this process """
+
+    def __init__(self, size=10000, ttl=86400):
+        self.size = size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key, fingerprint):
+        """ Returns what is stored under key, or None after reserving key for this request """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, expires = entry
+                if expires > now:
+                    return stored
+                del self._entries[key]
+            self._entries[key] = (StoredResponse(fingerprint), now + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return None
+
+    def save(self, key, stored):
+        """ Stores the response of the request that claimed key """
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = (stored, self._entries[key][1])
+
+    def release(self, key):
+        """ Forgets key, so the request can be retried """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.size,
+                    "ttl": self.ttl, "evictions": self.evictions}
+
+
+class DatabaseStore(object):
+    """ Keeps the responses in the idempotency_keys table for ttl seconds """
+    PURGE_INTERVAL = 60  # seconds between deletes of the expired rows
+
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self._purged = 0
+
+    def claim(self, key, fingerprint):
+        """ Returns what is stored under key, or None after reserving key for this request """
+        table = IdempotencyRecord.__table__
+        now = datetime.utcnow()
+        if time.time() - self._purged > self.PURGE_INTERVAL:
+            self._purged = time.time()
+            db.engine.execute(table.delete().where(
+                table.c.created_at < now - timedelta(seconds=self.ttl)))
+        try:
+            db.engine.execute(table.insert(), key=key, fingerprint=fingerprint, created_at=now)
+            return None
+        except exc.IntegrityError:
+            pass
+        row = db.engine.execute(table.select().where(table.c.key == key)).first()
+        if row is None:
+            return self.claim(key, fingerprint)  # it expired in between
+        timeout = CLAIM_TIMEOUT if row.status is None else self.ttl
+        if row.created_at < now - timedelta(seconds=timeout):
+            # take over the key, unless another retry got there first
+            taken = db.engine.execute(table.update().where(table.c.key == key).where(
+                table.c.created_at == row.created_at).values(
+                    fingerprint=fingerprint, status=None, body=None, location=None,
+                    created_at=now))
+            if taken.rowcount:
+                return None
+            return self.claim(key, fingerprint)
+        return StoredResponse(row.fingerprint, row.status, row.body, row.location)
+
+    def save(self, key, stored):
+        """ Stores the response of the request that claimed key """
+        table = IdempotencyRecord.__table__
+        db.engine.execute(table.update().where(table.c.key == key).values(
+            status=stored.status, body=stored.body, location=stored.location))
+
+    def release(self, key):
+        """ Forgets key, so the request can be retried """
+        table = IdempotencyRecord.__table__
+        db.engine.execute(table.delete().where(table.c.key == key))
+
+
+class Idempotency(object):
+    """ Replays the responses of POST requests retried with the same Idempotency-Key """
+
+    def __init__(self):
+        self.store = None
+        self.replays = 0
+
+    def init_app(self, app):
+        """ Sets the defaults of the app config """
+        app.config.setdefault('IDEMPOTENCY_STORE', 'memory')
+        app.config.setdefault('IDEMPOTENCY_CACHE_SIZE', 10000)
+        app.config.setdefault('IDEMPOTENCY_TTL', 24 * 3600)
+
+    def configure(self, app):
+        """ Sets up the store picked by IDEMPOTENCY_STORE, dropping what was stored """
+        if app.config['IDEMPOTENCY_STORE'] == 'database':
+            self.store = DatabaseStore(app.config['IDEMPOTENCY_TTL'])
+        else:
+            self.store = MemoryStore(app.config['IDEMPOTENCY_CACHE_SIZE'],
+                                     app.config['IDEMPOTENCY_TTL'])
+
+    def idempotent(self, view):
+        """ Decorates a view so that its successful responses are replayed by key """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                abort(400, '{} must be at most {} characters'.format(HEADER, MAX_KEY_LENGTH))
+            if self.store is None:
+                self.configure(current_app)
+            scope = hashlib.sha256(u'{} {} {}'.format(
+                request.method, request.path, key).encode('utf-8')).hexdigest()
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            stored = self.store.claim(scope, fingerprint)
+            if stored is not None:
+                if stored.fingerprint != fingerprint:
+                    abort(422, '{} was already used with another request body'.format(HEADER))
+                if stored.running:
+                    abort(409, 'A request with this {} is still running'.format(HEADER))
+                self.replays += 1
+                return stored.response()
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except:
+                self.store.release(scope)
+                raise
+            if 200 <= response.status_code < 300:
+                self.store.save(scope, StoredResponse(
+                    fingerprint, response.status_code, response.get_data(),
+                    response.headers.get('Location'), response.mimetype))
+            else:
+                self.store.release(scope)
+            return response
+        return wrapper
+
+
+idempotency = Idempotency()
@@ -0,0 +1,154 @@
+"""
+Queued logging for the Wishlists service
+
+Python 2.7 has no logging.handlers.QueueHandler, so this module has its
+own. QueueHandler puts records on a bounded queue and returns at once; a
+background thread formats them and writes them out with the real handlers,
+so a request never waits for stdout. When the queue is full new records
+are dropped and counted instead of blocking the request.
+
+SamplingFilter thins out high volume INFO messages, such as the lookups
+logged by every model call, before they are even queued.
+"""
+import os
+import Queue
+import logging
+import threading
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands log records to a background thread that passes them to handlers
+
+    The thread is started on the first record and again after a fork, so
+    the handler keeps working in gunicorn workers forked from a master
+    that set up logging.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # a queue inherited through fork may have been locked by a thread that is gone
+            self._queue = Queue.Queue(self.maxsize)
+            self._thread = threading.Thread(target=self._listen, name='log-queue')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _listen(self):
+        queue = self._queue
+        while True:
+            record = queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:    # keep the thread alive for the next records
+                        handler.handleError(record)
+
+    def prepare(self, record):
+        """
+        Makes a record safe to hand to another thread
+
+        The message is merged with its arguments now, while they still hold
+        the values of the call, and exception info is turned into text. The
+        rest of the formatting is left to the background thread.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def handle(self, record):
+        # no handler lock: the queue does its own locking
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def stop(self):
+        """ Writes out the queued records and stops the background thread """
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+            self._pid = None
+
+    def close(self):
+        self.stop()
+        logging.Handler.close(self)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every n INFO (and lower) records of the sampled loggers
+
+    rates maps a logger name to the fraction of records to keep, e.g.
+    {'models': 0.01}; child loggers are sampled like their parents.
+    Records are counted per message format, so the first record of each
+    message is always kept and a rare message is not lost among frequent
+    ones. Warnings and errors are always kept.
+    """
+    MAX_MESSAGES = 1000
+
+    def __init__(self, rates):
+        logging.Filter.__init__(self)
+        self.rates = dict((name, rate) for name, rate in rates.items() if rate < 1)
+        self.sampled = 0
+        self._counts = {}
+
+    def rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or not self.rates:
+            return True
+        rate = self.rate(record.name)
+        if rate is None:
+            return True
+        key = (record.name, record.msg)
+        if len(self._counts) >= self.MAX_MESSAGES and key not in self._counts:
+            self._counts.clear()    # messages that are not format strings
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if rate > 0 and count % int(round(1 / rate)) == 0:
+            return True
+        self.sampled += 1
+        return False
+
+
+def parse_rates(text):
+    """ Turns 'models=0.01,server=0.5' into {'models': 0.01, 'server': 0.5} """
+    rates = {}
+    for part in text.split(','):
+        if part.strip():
+            name, rate = part.split('=', 1)
+            rates[name.strip()] = float(rate)
+    return rates
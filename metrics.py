@@ -0,0 +1,318 @@
+"""
+Request metrics for the Wishlists service
+
+Records, per endpoint and method, how many requests were answered with
+each status code and histograms of their latency, of the time they spent
+waiting on the database and of the time spent encoding JSON. render()
+returns everything in the Prometheus text format.
+
+Each process keeps its own counters behind a lock. When METRICS_DIR is set
+(gunicorn_config.py sets it for its workers), every process also writes a
+snapshot of its counters to METRICS_DIR/<pid>.json at most once a second,
+and render() adds up the snapshots of all the processes. Snapshots written
+before METRICS_STARTED (the time the gunicorn master started) were left by
+an earlier run and are ignored.
+
+Every SQL statement is also counted against the request that ran it. In
+debug mode the count and the total database time are returned in the
+X-DB-Queries and X-DB-Time (milliseconds) headers, and statements slower
+than SLOW_QUERY_THRESHOLD seconds are logged to the wishlists.slow_queries
+logger with their parameters and the route that ran them.
+"""
+import os
+import json
+import glob
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds in seconds, the last bucket (+Inf) is implicit
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+HISTOGRAMS = (
+    ('request_duration_seconds', 'Time to answer a request'),
+    ('request_db_seconds', 'Time a request spent waiting on the database'),
+    ('request_serialization_seconds', 'Time a request spent encoding JSON'),
+)
+PREFIX = 'wishlists_'
+DUMP_INTERVAL = 1.0
+
+# timings of the request being handled by this thread
+_local = threading.local()
+
+slow_query_log = logging.getLogger('wishlists.slow_queries')
+
+
+class Metrics(object):
+    """ Counters and histograms of the requests handled by this process """
+
+    def __init__(self, directory=None, started=0.0):
+        self.directory = directory
+        self.started = started    # snapshots older than this are ignored
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        self._last_dump = 0.0
+        self._counters = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        """ Zeroes all counters """
+        with self._lock:
+            self._statuses = {}
+            self._histograms = {}
+
+    def add_counter(self, name, description, read):
+        """ Adds (or replaces) a counter kept elsewhere, read() returns its current value """
+        self._counters[name] = (description, read, None)
+
+    def add_histogram(self, name, description, buckets, read):
+        """
+        Adds (or replaces) a histogram kept elsewhere
+
+        read() returns its current [count, sum, bucket counts...], with one
+        count per upper bound in buckets and a last one for +Inf.
+        """
+        self._counters[name] = (description, read, buckets)
+
+    def observe(self, endpoint, method, status, duration, db_time, serialization_time):
+        """ Records one finished request """
+        key = (endpoint, method)
+        status_key = (endpoint, method, str(status))
+        indexes = [bisect.bisect_left(BUCKETS, value)
+                   for value in (duration, db_time, serialization_time)]
+        with self._lock:
+            self._statuses[status_key] = self._statuses.get(status_key, 0) + 1
+            histograms = self._histograms.get(key)
+            if histograms is None:
+                # per histogram: [count, sum, bucket counts...]
+                histograms = self._histograms[key] = [
+                    [0, 0.0] + [0] * (len(BUCKETS) + 1) for _ in HISTOGRAMS]
+            for histogram, value, index in zip(histograms,
+                                               (duration, db_time, serialization_time),
+                                               indexes):
+                histogram[0] += 1
+                histogram[1] += value
+                histogram[2 + index] += 1
+        if self.directory and time.time() - self._last_dump >= DUMP_INTERVAL \
+                and self._dump_lock.acquire(False):
+            try:
+                self.dump()
+            finally:
+                self._dump_lock.release()
+
+    def snapshot(self):
+        """ Returns a copy of the counters that can be stored as JSON """
+        with self._lock:
+            snapshot = {
+                'statuses': [list(key) + [count] for key, count in self._statuses.items()],
+                'histograms': [list(key) + [[list(h) for h in histograms]]
+                               for key, histograms in self._histograms.items()],
+            }
+        snapshot['counters'] = dict((name, read()) for name, (_, read, _) in self._counters.items())
+        return snapshot
+
+    def dump(self):
+        """ Writes this process' counters to METRICS_DIR """
+        self._last_dump = time.time()
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.rename(path + '.tmp', path)    # readers never see a half written file
+
+    def collect(self):
+        """ Returns the counters of all processes added together """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == own:
+                    continue
+                try:
+                    if os.path.getmtime(path) < self.started:
+                        continue    # left by a process of an earlier run
+                    with open(path) as snapshot_file:
+                        snapshots.append(json.load(snapshot_file))
+                except (IOError, OSError, ValueError):
+                    pass    # the process is writing it or has just removed it
+        statuses, histograms, counters = {}, {}, {}
+        for snapshot in snapshots:
+            for name, value in snapshot.get('counters', {}).items():
+                if isinstance(value, list):
+                    total = counters.setdefault(name, [0] * len(value))
+                    for index, count in enumerate(value):
+                        total[index] += count
+                else:
+                    counters[name] = counters.get(name, 0) + value
+            for endpoint, method, status, count in snapshot['statuses']:
+                key = (endpoint, method, status)
+                statuses[key] = statuses.get(key, 0) + count
+            for endpoint, method, values in snapshot['histograms']:
+                totals = histograms.setdefault((endpoint, method),
+                                               [[0] * len(h) for h in values])
+                for total, histogram in zip(totals, values):
+                    for index, value in enumerate(histogram):
+                        total[index] += value
+        return statuses, histograms, counters
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text exposition format """
+        statuses, histograms, counters = self.collect()
+        lines = ['# HELP {}requests_total Requests answered, by status code'.format(PREFIX),
+                 '# TYPE {}requests_total counter'.format(PREFIX)]
+        for (endpoint, method, code), count in sorted(statuses.items()):
+            lines.append('{}requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(
+                PREFIX, endpoint, method, code, count))
+
+        for position, (name, description) in enumerate(HISTOGRAMS):
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            for (endpoint, method), values in sorted(histograms.items()):
+                count, total, buckets = values[position][0], values[position][1], \
+                    values[position][2:]
+                labels = 'endpoint="{}",method="{}"'.format(endpoint, method)
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+                    cumulative += bucket
+                    lines.append('{}{}_bucket{{{},le="{}"}} {}'.format(
+                        PREFIX, name, labels, bound, cumulative))
+                lines.append('{}{}_sum{{{}}} {}'.format(PREFIX, name, labels, repr(total)))
+                lines.append('{}{}_count{{{}}} {}'.format(PREFIX, name, labels, count))
+
+        # p50/p95/p99 of the latency for dashboards without histogram_quantile
+        lines.append('# HELP {}request_latency_seconds Latency quantiles estimated from '
+                     'the request_duration_seconds buckets'.format(PREFIX))
+        lines.append('# TYPE {}request_latency_seconds summary'.format(PREFIX))
+        for (endpoint, method), values in sorted(histograms.items()):
+            count, total, buckets = values[0][0], values[0][1], values[0][2:]
+            labels = 'endpoint="{}",method="{}"'.format(endpoint, method)
+            for quantile in QUANTILES:
+                lines.append('{}request_latency_seconds{{{},quantile="{}"}} {}'.format(
+                    PREFIX, labels, quantile, repr(estimate_quantile(buckets, quantile))))
+            lines.append('{}request_latency_seconds_sum{{{}}} {}'.format(
+                PREFIX, labels, repr(total)))
+            lines.append('{}request_latency_seconds_count{{{}}} {}'.format(
+                PREFIX, labels, count))
+
+        for name, (description, _, buckets) in self._counters.items():
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, description))
+            if buckets is None:
+                lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+                lines.append('{}{} {}'.format(PREFIX, name, counters.get(name, 0)))
+                continue
+            lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            values = counters.get(name) or [0, 0] + [0] * (len(buckets) + 1)
+            cumulative = 0
+            for bound, bucket in zip(tuple(buckets) + ('+Inf',), values[2:]):
+                cumulative += bucket
+                lines.append('{}{}_bucket{{le="{}"}} {}'.format(PREFIX, name, bound, cumulative))
+            lines.append('{}{}_sum {}'.format(PREFIX, name, values[1]))
+            lines.append('{}{}_count {}'.format(PREFIX, name, values[0]))
+        return '\n'.join(lines) + '\n'
+
+    def init_app(self, app):
+        """ Times every request of app """
+        app.json_encoder = TimedJSONEncoder
+        app.before_request(start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(stop_request)
+
+    def finish_request(self, response):
+        """
+        Records the current request
+
+        Runs before the body of a streamed response is generated, so the
+        time spent streaming it is not counted.
+        """
+        start = getattr(_local, 'start', None)
+        if start is not None:
+            _local.start = None
+            self.observe(request.endpoint or 'unmatched', request.method,
+                         response.status_code, time.time() - start,
+                         _local.db_time, _local.serialization_time)
+            if current_app.debug:
+                response.headers['X-DB-Queries'] = str(_local.queries)
+                response.headers['X-DB-Time'] = '{:.3f}'.format(_local.db_time * 1000)
+        return response
+
+
+def estimate_quantile(buckets, quantile):
+    """
+    Estimates a quantile from bucket counts
+
+    Interpolates linearly inside the bucket the quantile falls in, like
+    Prometheus' histogram_quantile. Values in the +Inf bucket are reported
+    as the largest finite bound.
+    """
+    count = sum(buckets)
+    if not count:
+        return 0.0
+    rank = quantile * count
+    cumulative = 0
+    for index, bucket in enumerate(buckets):
+        if cumulative + bucket >= rank and bucket:
+            if index == len(BUCKETS):
+                return BUCKETS[-1]
+            lower = BUCKETS[index - 1] if index else 0.0
+            return lower + (BUCKETS[index] - lower) * (rank - cumulative) / bucket
+        cumulative += bucket
+    return BUCKETS[-1]
+
+
+metrics = Metrics(os.getenv('METRICS_DIR'), float(os.getenv('METRICS_STARTED', '0')))
+
+
+@contextmanager
+def serializing():
+    """ Adds the time spent in the block to the current request's serialization time """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if getattr(_local, 'start', None) is not None:
+            _local.serialization_time += time.time() - start
+
+
+class TimedJSONEncoder(JSONEncoder):
+    """ Flask's JSON encoder, adding the time spent to the request's serialization time """
+
+    def encode(self, o):
+        with serializing():
+            return super(TimedJSONEncoder, self).encode(o)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _local.query_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'start', None) is None or not has_request_context():
+        return
+    duration = time.time() - _local.query_start
+    _local.db_time += duration
+    _local.queries += 1
+    threshold = current_app.config.get('SLOW_QUERY_THRESHOLD')
+    if threshold is not None and duration >= threshold:
+        slow_query_log.warning('%.3fs in %s %s (%s): %s %r', duration, request.method,
+                               request.path, request.endpoint, statement, parameters)
+
+
+def start_request():
+    """ Starts timing the current request """
+    _local.db_time = 0.0
+    _local.queries = 0
+    _local.serialization_time = 0.0
+    _local.start = time.time()
+
+
+def stop_request(exception=None):
+    """ Stops timing the current request, even when it failed before finish_request """
+    _local.start = None
@@ -1,42 +1,571 @@
 import logging
 import os
+import re
+import time
+import functools
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, inspect, func
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import Label
+
+from group_commit import GroupCommitter
+
+
+class ConfigurableSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy that also passes SQLALCHEMY_ENGINE_OPTIONS to create_engine
+
+    Flask-SQLAlchemy 2.1 only forwards a few pool settings, which is not
+    enough to set the pool class, pre-ping or the driver connect timeout.
+    SQLite file databases get a pool of SQLITE_POOL_SIZE connections, so
+    that connections are reused instead of opened per checkout, and the
+    SQLITE_PRAGMAS are applied to every new connection. Its sessions can
+    send their reads to a read replica, see RoutingSession.
+    """
+    def apply_driver_hacks(self, app, info, options):
+        sqlite_file = info.drivername == 'sqlite' and \
+            info.database not in (None, '', ':memory:')
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if not sqlite_file:
+            options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+            return
+        if app.config.get('SQLITE_POOL_SIZE'):
+            # a connection is used by one thread at a time, so sharing is safe
+            options['poolclass'] = MonitoredQueuePool
+            options['pool_size'] = app.config['SQLITE_POOL_SIZE']
+            options['max_overflow'] = app.config.get('SQLITE_MAX_OVERFLOW', 10)
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        if app.config.get('SQLITE_PRAGMAS'):
+            options['pool_events'] = [
+                (sqlite_pragma_listener(app.config['SQLITE_PRAGMAS']), 'connect')]
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def make_engine(self, app, uri):
+        """ Creates an engine for uri set up like the primary one, e.g. for a read replica """
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        return sqlalchemy.create_engine(info, **options)
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that can send its reads to a read replica
+
+    While replica is set to an engine, queries run on it; flushes and
+    INSERT, UPDATE and DELETE statements still go to the primary. The
+    replica is picked for each request, see replicas.py.
+    """
+    replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is not None and not self._flushing and \
+                not isinstance(clause, UpdateBase):
+            return self.replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def sqlite_pragma_listener(pragmas):
+    """
+    Makes a pool connect listener that runs PRAGMA statements
+
+    Args:
+        pragmas (list): (name, value) pairs, run in order on every new
+            SQLite connection, e.g. [('journal_mode', 'WAL')]
+    """
+    statements = ['PRAGMA {}={}'.format(name, value) for name, value in pragmas]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+    return set_pragmas
+
+
+class MonitoredQueuePool(QueuePool):
+    """
+    QueuePool that measures how long checkouts wait for a connection
+
+    With pre_ping it also tests every connection with SELECT 1 when it is
+    checked out, replacing connections the server has dropped.
+    """
+    def __init__(self, creator, pre_ping=False, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self.pre_ping = pre_ping
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+        if pre_ping:
+            event.listen(self, 'checkout', ping_connection)
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)  # event listeners are carried over
+        pool.pre_ping = self.pre_ping
+        return pool
+
+    def stats(self):
+        """ Returns the live pool statistics as a dictionary """
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "checked_in": self.checkedin(),
+                "checked_out": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "max_overflow": self._max_overflow,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_time_total": self.wait_time,
+                "wait_time_max": self.max_wait_time,
+                "wait_time_avg": self.wait_time / self.checkouts if self.checkouts else 0.0
+                }
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """ Pool checkout listener that discards connections that stopped working """
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception:
+        # the pool retries the checkout with a new connection
+        raise exc.DisconnectionError()
+
+
+def pool_stats():
+    """ Returns statistics about the connection pool of the database engine """
+    pool = db.engine.pool
+    if isinstance(pool, MonitoredQueuePool):
+        return pool.stats()
+    return {"status": pool.status()}
+
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = ConfigurableSQLAlchemy()
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     def __init__(self, statement):
         print statement
 
+class EntityCache(object):
+    """
+    Thread-safe LRU cache with a time to live, keyed by primary key
+
+    Holds detached copies of model instances so that hot rows can be
+    returned without a database round trip. A size of 0 disables it.
+
+    The generation goes up with every invalidation. A value loaded from the
+    database is only put if no invalidation happened since the load began,
+    so that a row read just before a commit cannot be cached after it.
+    """
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, size, ttl):
+        """ Changes the size and time to live and empties the cache """
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self.generation += 1
+            self._entries.clear()
+
+    def get(self, key):
+        """ Returns the cached value for key, or None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires < time.time():
+                self.misses += 1
+                self.evictions += 1
+                return None
+            self._entries[key] = entry  # most recently used goes last
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        """
+        Caches value under key, evicting the least recently used entries
+
+        With a generation, value is dropped if the cache was invalidated
+        since that generation was read.
+        """
+        if self.size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Removes key from the cache """
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """ Removes every entry whose value matches predicate """
+        with self._lock:
+            self.generation += 1
+            for key, (value, _) in list(self._entries.items()):
+                if predicate(value):
+                    del self._entries[key]
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the cache counters as a dictionary """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+                }
+
+
+def cached_get(model, key):
+    """
+    Gets a model instance by primary key through the model's cache
+
+    A cache hit is merged into the current session without touching the
+    database. A miss loads the row and caches a detached copy of it.
+    Another worker's changes are only seen once the entry expires, so
+    handlers that change the instance load it with find_fresh() instead.
+    Reads routed to a replica skip the cache both ways: the cache holds
+    what the primary has, and a replica may lag behind it.
+    """
+    session = db.session()
+    if session.replica is not None:
+        return model.query.get(key)
+    identity = model.__mapper__.identity_key_from_primary_key([key])
+    if identity not in session.identity_map:
+        cached = model.cache.get(key)
+        if cached is not None:
+            return session.merge(cached, load=False)
+    generation = model.cache.generation
+    instance = model.query.get(key)
+    if instance is not None:
+        copy = model(**dict((column.key, getattr(instance, column.key))
+                            for column in model.__mapper__.column_attrs))
+        make_transient_to_detached(copy)
+        model.cache.put(key, copy, generation)
+    return instance
+
+
+def find_fresh(model, key):
+    """ Loads a model instance from the database, replacing any copy the session holds """
+    return model.query.populate_existing().get(key)
+
+
+def configure_caches(app):
+    """ Sizes the entity caches from the app config and empties them """
+    size = app.config.get('ENTITY_CACHE_SIZE', 1024)
+    ttl = app.config.get('ENTITY_CACHE_TTL', 30)
+    Item.cache.configure(size, ttl)
+    Wishlist.cache.configure(size, ttl)
+
+
+# Gathers the inserts of concurrent requests into shared transactions, see group_commit.py
+committer = GroupCommitter()
+
+
+def configure_group_commit(app):
+    """ Turns group commit on or off from the app config """
+    max_batch = app.config.get('GROUP_COMMIT_MAX_BATCH', 64) if app.config.get('GROUP_COMMIT') else 0
+    committer.configure(db.engine, max_batch, app.config.get('GROUP_COMMIT_MAX_WAIT', 0.005))
+
+
+def group_insert(instance, row, *wishlist_ids):
+    """
+    Inserts a new model instance through the group committer
+
+    The row is inserted, and the versions of the Wishlists are bumped, in
+    the next group commit. Once it is committed the instance gets its id
+    and joins the session as if it had been loaded from the database.
+    """
+    db.session.commit()  # ends the read transaction, so the new row can be loaded afterwards
+    instance.id = committer.submit(functools.partial(
+        insert_row, instance.__table__, row, wishlist_ids))
+    make_transient_to_detached(instance)
+    db.session.add(instance)
+    for wishlist_id in wishlist_ids:
+        Wishlist.cache.invalidate(wishlist_id)
+
+
+def insert_row(table, row, wishlist_ids, connection):
+    """ Inserts row into table and bumps the versions of the Wishlists, returns the new id """
+    result = connection.execute(table.insert(), row)
+    for wishlist_id in wishlist_ids:
+        connection.execute(Wishlist.touch_statement(wishlist_id))
+    return result.inserted_primary_key[0]
+
+
+def normalize(text):
+    """ Folds text for searching: lower case, with runs of whitespace as one space """
+    if text is None:
+        return None
+    return ' '.join(text.lower().split())
+
+
+def search_key(source):
+    """ Column default that fills a search key column from the source column """
+    return lambda context: normalize(context.current_parameters.get(source))
+
+
+SEARCH_INDEXES = []  # every SearchIndex, for upgrade_db()
+
+
+class SearchIndex(object):
+    """
+    Prefix and word search over the text columns of a model
+
+    Prefix searches compare the normalized copy of the source column that
+    is kept in the key column, so they are a range scan of its index. Word
+    searches go through an FTS4 table on SQLite, kept up to date by
+    triggers, and a GIN index of the columns' tsvector on PostgreSQL. Both
+    ignore case.
+
+    Matches are ranked: an exact match of the key first, then the keys that
+    start with the search, then the rows that only contain its words, and
+    by id within a rank.
+    """
+    RANK_STEP = 2 ** 32  # more than any id, so rank * RANK_STEP + id orders by rank first
+
+    def __init__(self, model, source, key, columns):
+        self.model = model
+        self.source = source
+        self.key = key
+        self.columns = columns
+        self.table = model.__tablename__
+        self.name = self.table + '_search'
+        SEARCH_INDEXES.append(self)
+        event.listen(model.__table__, 'after_create', self._created)
+        event.listen(model.__table__, 'before_drop', self._dropped)
+        event.listen(model, 'before_update', self._update_key)
+
+    def _created(self, table, connection, **kw):
+        self.create(connection, replace=True)
+
+    def _dropped(self, table, connection, **kw):
+        self.drop(connection)
+
+    def _update_key(self, mapper, connection, target):
+        setattr(target, self.key, normalize(getattr(target, self.source)))
+
+    def document(self, prefix=''):
+        """ The SQL expression of all the searched columns as one string """
+        return " || ' ' || ".join("coalesce({}{}, '')".format(prefix, column)
+                                  for column in self.columns)
+
+    def create(self, connection, replace=False):
+        """
+        Creates the word index of an existing table
+
+        Args:
+            connection: a connection or engine
+            replace (bool): drop an SQLite FTS table left over from an
+                earlier table of the same name, instead of keeping it
+        """
+        if connection.dialect.name == 'sqlite':
+            if replace:
+                self.drop(connection)
+            elif connection.dialect.has_table(connection, self.name):
+                return
+            values = dict(name=self.name, table=self.table, columns=', '.join(self.columns),
+                          new=', '.join('new.' + column for column in self.columns))
+            connection.execute(
+                'CREATE VIRTUAL TABLE {name} USING fts4('
+                'content="{table}", {columns}, tokenize=unicode61)'.format(**values))
+            # FTS4 reads the old values from the content table to unindex
+            # them, so they are removed before the row changes
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON {table} BEGIN '
+                'INSERT INTO {name}(docid, {columns}) VALUES (new.id, {new}); END'.format(**values))
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {name}_delete BEFORE DELETE ON {table} BEGIN '
+                'DELETE FROM {name} WHERE docid = old.id; END'.format(**values))
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {name}_unindex BEFORE UPDATE OF {columns} '
+                'ON {table} BEGIN DELETE FROM {name} WHERE docid = old.id; END'.format(**values))
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS {name}_reindex AFTER UPDATE OF {columns} '
+                'ON {table} BEGIN INSERT INTO {name}(docid, {columns}) '
+                'VALUES (new.id, {new}); END'.format(**values))
+            connection.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(self.name))
+        elif connection.dialect.name == 'postgresql':
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_{}_search ON {} USING gin "
+                "(to_tsvector('simple', {}))".format(self.table, self.table, self.document()))
+
+    def drop(self, connection):
+        """ Drops the SQLite FTS table, PostgreSQL drops the index with its table """
+        if connection.dialect.name == 'sqlite':
+            connection.execute('DROP TABLE IF EXISTS {}'.format(self.name))
+
+    def upgrade(self):
+        """ Fills in the missing search keys and creates the word index """
+        table = self.model.__table__
+        source, key = table.c[self.source], table.c[self.key]
+        rows = db.engine.execute(db.select([table.c.id, source]).where(
+            db.and_(key.is_(None), source.isnot(None)))).fetchall()
+        if rows:
+            logging.getLogger(__name__).info('Filling in %s.%s', self.table, self.key)
+            db.engine.execute(
+                table.update().where(table.c.id == db.bindparam('row_id')).values(
+                    {key: db.bindparam('key_value')}),
+                [{'row_id': row[0], 'key_value': normalize(row[1])} for row in rows])
+        self.create(db.engine)
+
+    def search(self, query, text):
+        """
+        Narrows a query down to the rows that match text
+
+        Args:
+            query: a query of the model
+            text (string): the start of the source column, or words found
+                anywhere in the searched columns (the last one may be cut short)
+        Returns:
+            tuple: the query, and the column to order and page it by,
+                best matches first
+        Raises:
+            DataValidationError: when there is nothing to search for
+        """
+        text = normalize(text)
+        if not text:
+            raise DataValidationError('Invalid search: nothing to search for')
+        key = getattr(self.model, self.key)
+        if db.engine.dialect.name == 'postgresql':
+            # the key index uses varchar_pattern_ops for LIKE 'prefix%'
+            escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            prefix = key.like(escaped + '%', escape='\\')
+        else:
+            # SQLite's LIKE ignores case and cannot use the index, a range can
+            prefix = db.and_(key >= text, key < text + u'\uffff')
+        matches = prefix
+        words = re.findall(r'[^\W_]+', text, re.UNICODE)
+        if words:
+            matches = db.or_(prefix, self.match_words(words))
+        rank = db.case([(key == text, 0), (prefix, 1)], else_=2)
+        order = (rank * self.RANK_STEP + self.model.id).label('search_rank')
+        return query.filter(matches), order
+
+    def match_words(self, words):
+        """
+        Returns a clause matching the rows that have all of words
+
+        The last word may be the start of a longer one. The others must be
+        whole words, which keeps the lookup cheap when they are common.
+        """
+        if db.engine.dialect.name == 'postgresql':
+            clause = db.text("to_tsvector('simple', {}) @@ to_tsquery('simple', :search_terms)"
+                             .format(self.document(self.table + '.')))
+            terms = ' & '.join(words[:-1] + [words[-1] + ':*'])
+        else:
+            clause = db.text('{}.id IN (SELECT docid FROM {name} WHERE {name} MATCH :search_terms)'
+                             .format(self.table, name=self.name))
+            terms = ' '.join(words[:-1] + [words[-1] + '*'])
+        return clause.bindparams(search_terms=terms)
+
+
 class Item(db.Model):
     """ Model for an Item """
     logger = logging.getLogger(__name__)
     app = None
+    BATCH_SIZE = 1000  # rows per multi-row INSERT in save_all()
+    FIELDS = ('id', 'wishlist_id', 'product_id', 'name', 'description')  # keys of serialize()
+    cache = EntityCache()
 
     __tablename__ = "items"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    wishlist_id = db.Column(db.Integer, db.ForeignKey('wishlists.id'), nullable=False)
+    wishlist_id = db.Column(db.Integer, db.ForeignKey('wishlists.id', ondelete='CASCADE'),
+                            nullable=False, index=True)
     product_id = db.Column(db.Integer, nullable=False)
-    name = db.Column(db.String(63), nullable=False)
+    name = db.Column(db.String(63), nullable=False, index=True)
     description = db.Column(db.String(100))
+    # normalize(name), for case-insensitive prefix searches, see SearchIndex
+    name_key = db.Column(db.String(63), default=search_key('name'))
+
+    # Covers find_by_wishlist_id() ordered by id without touching the table
+    __table_args__ = (db.Index('ix_items_wishlist_id_id', 'wishlist_id', 'id'),
+                      db.Index('ix_items_name_key', 'name_key',
+                               postgresql_ops={'name_key': 'varchar_pattern_ops'}))
 
     def __repr__(self):
         return '<Item %r>' % (self.name)
 
     def save(self):
         """ Saves an Item to the database """
+        if not self.id and committer.enabled:
+            group_insert(self, {'wishlist_id': self.wishlist_id,
+                                'product_id': self.product_id,
+                                'name': self.name,
+                                'description': self.description}, self.wishlist_id)
+            return
         if not self.id:
             db.session.add(self)
+        # an Item that moved also changes the Wishlist it came from
+        wishlist_ids = set([self.wishlist_id])
+        wishlist_ids.update(inspect(self).attrs.wishlist_id.history.deleted)
+        Wishlist.touch(*wishlist_ids)
         db.session.commit()
+        Item.cache.invalidate(self.id)
 
     def delete(self):
         """ Deletes an Item from the database """
         if self.id:
             db.session.delete(self)
+            Wishlist.touch(self.wishlist_id)
         db.session.commit()
+        Item.cache.invalidate(self.id)
 
     def serialize(self):
         """
@@ -76,14 +605,18 @@ class Item(db.Model):
         return self
 
     @staticmethod
-    def init_db(app):
-        """ Initializes the database session """
+    def init_db(app, create_tables=True):
+        """ Initializes the database session, and the tables unless create_tables is False """
         Item.logger.info('Initializing database')
         Item.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        if create_tables:
+            db.create_all()  # make our sqlalchemy tables
+            upgrade_db()     # bring tables created by older versions up to date
+        configure_caches(app)
+        configure_group_commit(app)
 
     @staticmethod
     def all():
@@ -105,7 +638,12 @@ class Item(db.Model):
             Item: item with associated id
         """
         Item.logger.info('Processing lookup for id %s ...', item_id)
-        return Item.query.get(item_id)
+        return cached_get(Item, item_id)
+
+    @staticmethod
+    def find(item_id):
+        """ Finds an Item by id in the database, skipping the cache, to change it """
+        return find_fresh(Item, item_id)
 
     @staticmethod
     def find_by_name(name):
@@ -127,43 +665,142 @@ class Item(db.Model):
         Item.logger.info('Processing wishlist_id query for %s ...', wishlist_id)
         return Item.query.filter(Item.wishlist_id == wishlist_id)
 
+    @staticmethod
+    def search(text, query=None):
+        """ Returns the Items whose name or description matches text, best matches first
+
+        Args:
+            text (string): the start of the name, or words of the name or
+                description, in any case
+            query: a query of Items to narrow down, all of them by default
+        Returns:
+            tuple: the query, and the column to order and page it by
+        """
+        Item.logger.info('Processing search for %s ...', text)
+        return Item.search_index.search(Item.query if query is None else query, text)
+
+    @staticmethod
+    def save_all(items):
+        """
+        Inserts a batch of new Items in a single transaction
+
+        Args:
+            items (list): Items that have not been saved yet
+        Returns:
+            list: the ids of the new Items, in the same order as items
+        """
+        if not items:
+            return []
+        Item.logger.info('Processing batch insert of %s Items ...', len(items))
+        table = Item.__table__
+        rows = [{'wishlist_id': item.wishlist_id,
+                 'product_id': item.product_id,
+                 'name': item.name,
+                 'name_key': normalize(item.name),
+                 'description': item.description} for item in items]
+        if db.engine.dialect.implicit_returning:
+            # PostgreSQL: multi-row INSERT ... RETURNING id
+            ids = []
+            for start in range(0, len(rows), Item.BATCH_SIZE):
+                statement = table.insert().values(rows[start:start + Item.BATCH_SIZE])
+                result = db.session.execute(statement.returning(table.c.id))
+                ids.extend(row[0] for row in result)
+        else:
+            # SQLite: one executemany. The write lock is held until commit,
+            # so the new rows are the ones with the highest ids.
+            db.session.execute(table.insert(), rows)
+            result = db.session.execute(
+                db.select([table.c.id]).order_by(table.c.id.desc()).limit(len(rows)))
+            ids = sorted(row[0] for row in result)
+        Wishlist.touch(*set(row['wishlist_id'] for row in rows))
+        db.session.commit()
+        for item, item_id in zip(items, ids):
+            item.id = item_id
+        return ids
+
+    @staticmethod
+    def delete_by_wishlist_id(wishlist_id):
+        """ Deletes all Items with the given wishlist_id in a single statement
+
+        Args:
+            wishlist_id (integer): the wishlist_id associated with a list of items
+        """
+        Item.logger.info('Processing wishlist_id delete for %s ...', wishlist_id)
+        Item.query.filter(Item.wishlist_id == wishlist_id).delete(synchronize_session=False)
+        Wishlist.touch(wishlist_id)
+        db.session.commit()
+        Item.cache.invalidate_where(lambda item: item.wishlist_id == wishlist_id)
+
 class Wishlist(db.Model):
     """ Model for a Wishlist """
     logger = logging.getLogger(__name__)
     app = None
+    FIELDS = ('id', 'customer_id', 'wishlist_name')  # keys of serialize()
+    cache = EntityCache()
 
     __tablename__ = "wishlists"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    customer_id = db.Column(db.Integer, nullable = False)
-    wishlist_name = db.Column(db.String(40))
+    customer_id = db.Column(db.Integer, nullable = False, index=True)
+    wishlist_name = db.Column(db.String(40), index=True)
+    # normalize(wishlist_name), for case-insensitive prefix searches, see SearchIndex
+    wishlist_name_key = db.Column(db.String(40), default=search_key('wishlist_name'))
+    # Bumped by every change to the wishlist or its items, see touch()
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # The database removes the items of a deleted wishlist (ON DELETE CASCADE)
+    items = db.relationship('Item', backref='wishlist', order_by='Item.id',
+                            cascade='all, delete-orphan', passive_deletes=True)
 
+    __table_args__ = (db.Index('ix_wishlists_wishlist_name_key', 'wishlist_name_key',
+                               postgresql_ops={'wishlist_name_key': 'varchar_pattern_ops'}),)
 
     def __repr__(self):
         return '<Wishlist>'
 
     def save(self):
         """ Saves a Wishlist to the database """
+        if not self.id and committer.enabled:
+            group_insert(self, {'customer_id': self.customer_id,
+                                'wishlist_name': self.wishlist_name})
+            return
         if not self.id:
             db.session.add(self)
+        else:
+            self.version = Wishlist.version + 1
+            self.updated_at = datetime.utcnow()
         db.session.commit()
+        Wishlist.cache.invalidate(self.id)
 
     def delete(self):
-        """ Deletes a Wishlist from the database """
+        """ Deletes a Wishlist and all of its Items from the database """
         if self.id:
-            db.session.delete(self)
+            # One bulk DELETE per table, in one transaction, no matter how many
+            # items there are. The explicit items delete covers SQLite, which
+            # does not enforce ON DELETE CASCADE by default.
+            Item.query.filter(Item.wishlist_id == self.id).delete(synchronize_session=False)
+            Wishlist.query.filter(Wishlist.id == self.id).delete(synchronize_session=False)
+            if self in db.session:
+                db.session.expunge(self)  # also expunges any loaded items
         db.session.commit()
+        Wishlist.cache.invalidate(self.id)
+        Item.cache.invalidate_where(lambda item: item.wishlist_id == self.id)
 
-    def serialize(self):
+    def serialize(self, include_items=False):
         """
         Serializes a Wishlist into a dictionary
+        Args:
+            include_items (bool): also serialize the Items of the Wishlist
         Returns:
             dict
         """
-        return {
+        data = {
                 "id": self.id,
                 "customer_id": self.customer_id,
                 "wishlist_name": self.wishlist_name,
                 }
+        if include_items:
+            data["items"] = [item.serialize() for item in self.items]
+        return data
 
     def deserialize(self, data):
         """
@@ -186,14 +823,18 @@ class Wishlist(db.Model):
         return self
 
     @staticmethod
-    def init_db(app):
-        """ Initializes the database session """
+    def init_db(app, create_tables=True):
+        """ Initializes the database session, and the tables unless create_tables is False """
         Wishlist.logger.info('Initializing database')
         Wishlist.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        if create_tables:
+            db.create_all()  # make our sqlalchemy tables
+            upgrade_db()     # bring tables created by older versions up to date
+        configure_caches(app)
+        configure_group_commit(app)
 
     @staticmethod
     def all():
@@ -217,7 +858,148 @@ class Wishlist(db.Model):
             Wishlist: wishlist with associated id
         """
         Wishlist.logger.info('Processing lookup for id %s ...', wishlist_id)
-        return Wishlist.query.get(wishlist_id)
+        return cached_get(Wishlist, wishlist_id)
+
+    @staticmethod
+    def find(wishlist_id):
+        """ Finds a Wishlist by id in the database, skipping the cache, to change it """
+        return find_fresh(Wishlist, wishlist_id)
+
+    @staticmethod
+    def touch(*wishlist_ids):
+        """
+        Bumps the version of Wishlists whose Items changed
+
+        The UPDATE joins the caller's transaction, so it is committed
+        together with the change to the Items.
+        """
+        for wishlist_id in wishlist_ids:
+            db.session.execute(Wishlist.touch_statement(wishlist_id))
+            Wishlist.cache.invalidate(wishlist_id)
+
+    @staticmethod
+    def touch_statement(wishlist_id):
+        """ Returns the UPDATE that bumps the version of a Wishlist """
+        table = Wishlist.__table__
+        return table.update().where(table.c.id == wishlist_id).values(
+            version=table.c.version + 1, updated_at=datetime.utcnow())
+
+    @staticmethod
+    def get_version(wishlist_id):
+        """
+        Get the version of a Wishlist without loading it
+
+        Args:
+            wishlist_id: primary key of wishlists
+
+        Returns:
+            tuple: (version, updated_at), or None when there is no such
+                Wishlist. A new Wishlist starts again at version 1, even
+                when it reuses the id of a deleted one, so the two together
+                tell its versions apart.
+        """
+        Wishlist.logger.info('Processing version lookup for id %s ...', wishlist_id)
+        return db.session.query(Wishlist.version, Wishlist.updated_at).filter(
+            Wishlist.id == wishlist_id).first()
+
+    @staticmethod
+    def get_owner(wishlist_id):
+        """
+        Get the customer_id of a Wishlist without loading it
+
+        Args:
+            wishlist_id: primary key of wishlists
+
+        Returns:
+            int: the customer_id, or None when there is no such Wishlist
+        """
+        return db.session.query(Wishlist.customer_id).filter(
+            Wishlist.id == wishlist_id).scalar()
+
+    @staticmethod
+    def get_customer_version(customer_id):
+        """
+        Get a fingerprint of all the Wishlists of a customer
+
+        Any change to one of the customer's Wishlists or their Items, and
+        any Wishlist created or deleted, changes the fingerprint. A new
+        Wishlist that reuses the id of a deleted one still changes it, as
+        the latest updated_at is part of it.
+
+        Args:
+            customer_id (integer): the customer's id
+
+        Returns:
+            string: the fingerprint
+        """
+        Wishlist.logger.info('Processing version lookup for customer_id %s ...', customer_id)
+        count, id_sum, version_sum, updated_at = db.session.query(
+            func.count(Wishlist.id), func.sum(Wishlist.id), func.sum(Wishlist.version),
+            func.max(Wishlist.updated_at, type_=db.DateTime)).filter(
+                Wishlist.customer_id == customer_id).one()
+        return '{}.{}.{}.{}'.format(count, id_sum or 0, version_sum or 0,
+                                    updated_at.isoformat() if updated_at else '')
+
+    @staticmethod
+    def get_summary(customer_id):
+        """
+        Counts the Items of every Wishlist of a customer in a single query
+
+        The Wishlists are grouped with their Items, and the number of
+        distinct products over all of them comes from a subquery of the
+        same statement, so the whole summary is one round trip.
+
+        Args:
+            customer_id (integer): the customer's id
+
+        Returns:
+            dict: the customer_id, the number of wishlists, items and
+                distinct products, and the id, wishlist_name and
+                item_count of every Wishlist
+        """
+        Wishlist.logger.info('Processing summary for customer_id %s ...', customer_id)
+        wishlists, items = Wishlist.__table__, Item.__table__
+        products = db.select([func.count(db.distinct(items.c.product_id))]).select_from(
+            items.join(wishlists, items.c.wishlist_id == wishlists.c.id)).where(
+                wishlists.c.customer_id == customer_id).correlate(None).as_scalar()
+        rows = db.session.query(
+            Wishlist.id, Wishlist.wishlist_name, func.count(Item.id), products).outerjoin(
+                Item, Item.wishlist_id == Wishlist.id).filter(
+                    Wishlist.customer_id == customer_id).group_by(
+                        Wishlist.id, Wishlist.wishlist_name).order_by(Wishlist.id).all()
+        return {
+                "customer_id": customer_id,
+                "wishlist_count": len(rows),
+                "item_count": sum(row[2] for row in rows),
+                "product_count": rows[0][3] if rows else 0,
+                "wishlists": [{"id": row[0], "wishlist_name": row[1], "item_count": row[2]}
+                              for row in rows]
+                }
+
+    @staticmethod
+    def get_with_items(wishlist_id):
+        """
+        Get a Wishlist and its Items with a single joined query
+
+        Args:
+            wishlist_id: primary key of wishlists
+
+        Returns:
+            Wishlist: wishlist with associated id, with its items loaded
+        """
+        Wishlist.logger.info('Processing lookup with items for id %s ...', wishlist_id)
+        return Wishlist.query.options(db.joinedload(Wishlist.items)).filter(
+            Wishlist.id == wishlist_id).first()
+
+    @staticmethod
+    def with_items(query):
+        """
+        Eagerly loads the Items of every Wishlist of a query
+
+        The Items of all the Wishlists are fetched with one extra query,
+        however many Wishlists there are.
+        """
+        return query.options(db.subqueryload(Wishlist.items))
 
     @staticmethod
     def get_or_404(wishlist_id):
@@ -245,6 +1027,19 @@ class Wishlist(db.Model):
         Wishlist.logger.info('Processing wishlist_name query for %s ...', wishlist_name)
         return Wishlist.query.filter(Wishlist.wishlist_name == wishlist_name)
 
+    @staticmethod
+    def search(text, query=None):
+        """ Returns the Wishlists whose wishlist_name matches text, best matches first
+
+        Args:
+            text (string): the start of the wishlist_name, or words in it, in any case
+            query: a query of Wishlists to narrow down, all of them by default
+        Returns:
+            tuple: the query, and the column to order and page it by
+        """
+        Wishlist.logger.info('Processing search for %s ...', text)
+        return Wishlist.search_index.search(Wishlist.query if query is None else query, text)
+
     @staticmethod
     def clear_db():
         """Clear database"""
@@ -255,10 +1050,161 @@ class Wishlist(db.Model):
         meta = db.metadata
         for table in reversed(meta.sorted_tables):
             db.session.execute(table.delete())
-            db.session.commit()
         #using bluemix and postgresql 
         if 'VCAP_SERVICES' in os.environ:
             db.session.execute("ALTER SEQUENCE items_id_seq RESTART with 1;")
             db.session.execute("ALTER SEQUENCE wishlists_id_seq RESTART with 1;")
-            db.session.commit()
+        db.session.commit()
+        Item.cache.clear()
+        Wishlist.cache.clear()
+
+
+Item.search_index = SearchIndex(Item, 'name', 'name_key', ('name', 'description'))
+Wishlist.search_index = SearchIndex(Wishlist, 'wishlist_name', 'wishlist_name_key',
+                                    ('wishlist_name',))
+
+
+class IdempotencyRecord(db.Model):
+    """
+    Response to a request made with an Idempotency-Key
+
+    Shared by every worker when IDEMPOTENCY_STORE is 'database', see
+    idempotency.py. A row without a status is a request still running.
+    """
+    __tablename__ = "idempotency_keys"
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of the method, path and key
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 of the request body
+    status = db.Column(db.Integer)
+    body = db.Column(db.LargeBinary)
+    location = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+def paginate(query, column, after=None, limit=None, fields=None):
+    """
+    Fetches one page of a query using keyset pagination
+
+    Rows are ordered by column and the page starts right after the value
+    in after, so the cost only depends on the page size, not on how deep
+    the client is paging.
+
+    Args:
+        query: the query to page through
+        column: a unique column to order by, normally the primary key, or
+            a labeled expression such as the order of SearchIndex.search
+        after: the column value of the last row of the previous page,
+            or None for the first page
+        limit (int): the maximum number of rows in the page
+        fields (tuple): when given, only these columns are fetched and the
+            rows are returned as plain database rows, in that order, instead
+            of model instances (see fetch_rows)
+    Returns:
+        tuple: the rows of the page, and the after value of the next page
+            or None when this is the last page
+    """
+    # an expression is not an attribute of the rows, so it is fetched with them
+    computed = isinstance(column, Label)
+    if after is not None:
+        query = query.filter(column > after)
+    query = query.order_by(column)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    if fields:
+        rows = fetch_rows(query, fields, *([column] if computed else []))
+    else:
+        rows = query.add_columns(column).all() if computed else query.all()
+    next_after = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_after = getattr(rows[-1], column.key)
+    if computed and not fields:
+        rows = [row[0] for row in rows]
+    return rows, next_after
+
+
+def fetch_rows(query, fields, *columns):
+    """
+    Runs a model query for just some of its columns, as plain database rows
+
+    Building model instances costs several times more than running the
+    query, and listings only read the rows, so this skips the ORM and
+    returns the rows from the cursor. They index like tuples in the order
+    of fields, followed by any extra columns, and also have them as
+    attributes.
+    """
+    model = query.column_descriptions[0]['type']
+    query = query.with_entities(*[getattr(model, field) for field in fields] + list(columns))
+    return db.session.execute(query.statement).fetchall()
+
+
+def stream(query, column, after=None, limit=None, chunk_size=1000, fields=None):
+    """
+    Iterates over a query without loading all of it into memory
+
+    Rows are ordered by column and fetched chunk_size at a time, with a
+    server-side cursor on PostgreSQL.
+
+    Args:
+        query: the query to iterate over
+        column: a unique column to order by, normally the primary key
+        after: only return rows whose column is greater than this
+        limit (int): the maximum number of rows, or None for all of them
+        chunk_size (int): the number of rows fetched per round trip
+        fields (tuple): when given, only these columns are fetched, as
+            tuples in that order instead of model instances
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    query = query.order_by(column)
+    if limit is not None:
+        query = query.limit(limit)
+    if fields:
+        model = query.column_descriptions[0]['type']
+        query = query.with_entities(*[getattr(model, field) for field in fields])
+    return query.yield_per(chunk_size)
+
+
+def upgrade_db():
+    """
+    Upgrades an existing database to the current models
+
+    db.create_all() only creates missing tables, so tables created by an
+    older version of the service do not get new columns or indexes. This
+    adds any column or index declared on the models that is missing from
+    the database, fills in the search keys of old rows and creates the
+    word search indexes (see SearchIndex). It works against both SQLite
+    and PostgreSQL and is safe to run repeatedly.
+    """
+    logger = logging.getLogger(__name__)
+    inspector = inspect(db.engine)
+    tables = [table for table in db.metadata.sorted_tables
+              if table.name in inspector.get_table_names()]
+    for table in tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                logger.info('Adding column %s.%s', table.name, column.name)
+                db.engine.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    table.name, CreateColumn(column).compile(dialect=db.engine.dialect)))
+
+    for table in tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info('Creating index %s', index.name)
+                index.create(db.engine)
+
+    for index in SEARCH_INDEXES:
+        if index.table in inspector.get_table_names():
+            index.upgrade()
 
+    # SQLite cannot alter constraints and does not enforce them by default,
+    # so only PostgreSQL needs the items foreign key rebuilt with the cascade
+    if db.engine.dialect.name == 'postgresql':
+        for foreign_key in inspector.get_foreign_keys('items'):
+            if foreign_key['options'].get('ondelete', '').upper() != 'CASCADE':
+                logger.info('Adding ON DELETE CASCADE to %s', foreign_key['name'])
+                db.engine.execute(
+                    'ALTER TABLE items DROP CONSTRAINT {0}, '
+                    'ADD CONSTRAINT {0} FOREIGN KEY (wishlist_id) '
+                    'REFERENCES wishlists (id) ON DELETE CASCADE'.format(foreign_key['name']))
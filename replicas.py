@@ -0,0 +1,118 @@
+"""
+Read replicas for the Wishlists service
+
+With REPLICA_URIS set, the GET and HEAD requests read from the replicas,
+taken in turn, while every other request, and every write, goes to the
+primary database. The replicas get the same pool and SQLite settings as
+the primary. Schema changes are left to the replication: create_all()
+and upgrade_db() only run on the primary.
+
+A replica lags behind the primary, so a client that just wrote would not
+always see its own change. After a successful write the response sets a
+cookie that keeps the reads of that client on the primary for
+REPLICA_STICKY_SECONDS.
+
+A read that fails on a replica with a database error is run again on the
+primary, and the replica is skipped for REPLICA_RETRY_INTERVAL seconds.
+When no replica is available the reads go to the primary.
+"""
+import math
+import time
+import logging
+import itertools
+from flask import current_app, request
+from sqlalchemy import exc
+
+from models import db
+
+COOKIE = 'wishlists_primary'  # reads stay on the primary until this time
+READ_METHODS = ('GET', 'HEAD')
+
+
+class ReadReplicas(object):
+    """ Sends the reads of an app to its read replicas """
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self.engines = []
+        self.reads = 0
+        self.fallbacks = 0
+        self._down = {}    # engine: time to try it again
+        self._turn = itertools.count()
+
+    def init_app(self, app):
+        """ Routes every request of app """
+        app.config.setdefault('REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        app.config.setdefault('REPLICA_RETRY_INTERVAL', 30)
+        app.before_request(self.route)
+        app.after_request(self.stick)
+        app.teardown_request(self.unroute)
+        app.register_error_handler(exc.DBAPIError, self.retry)
+
+    def configure(self, app):
+        """ Connects to the REPLICA_URIS of app, closing the previous replicas """
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = [db.make_engine(app, uri) for uri in app.config['REPLICA_URIS']]
+        self._down = {}
+
+    def engine(self):
+        """ Returns the engine of the next replica that is not marked down, or None """
+        for _ in self.engines:
+            engine = self.engines[next(self._turn) % len(self.engines)]
+            if self._down.get(engine, 0) <= time.time():
+                return engine
+        return None
+
+    def route(self):
+        """ Picks the database the reads of the request go to """
+        if not self.engines:
+            return
+        session = db.session()
+        session.replica = None
+        if request.method not in READ_METHODS:
+            return
+        try:
+            if float(request.cookies.get(COOKIE, 0)) > time.time():
+                return  # the client wrote recently
+        except ValueError:
+            pass
+        session.replica = self.engine()
+        if session.replica is None:
+            self.fallbacks += 1
+        else:
+            self.reads += 1
+
+    def retry(self, error):
+        """ Marks down the replica a read failed on and runs the request again on the primary """
+        session = db.session()
+        engine = getattr(session, 'replica', None)
+        if engine is None:
+            raise    # the primary failed, nothing to fall back to
+        self.logger.warning('Replica %r failed, reading from the primary: %s', engine.url, error)
+        self._down[engine] = time.time() + current_app.config['REPLICA_RETRY_INTERVAL']
+        self.fallbacks += 1
+        session.rollback()
+        session.replica = None
+        try:
+            return current_app.dispatch_request()
+        except Exception as error:
+            return current_app.handle_user_exception(error)
+
+    def stick(self, response):
+        """ Keeps the reads of a client that wrote on the primary for a while """
+        if self.engines and request.method not in READ_METHODS + ('OPTIONS',) and \
+                response.status_code < 400:
+            seconds = current_app.config['REPLICA_STICKY_SECONDS']
+            response.set_cookie(COOKIE, '{:.3f}'.format(time.time() + seconds),
+                                max_age=int(math.ceil(seconds)), httponly=True)
+        return response
+
+    def unroute(self, error=None):
+        """ Sends the reads back to the primary once the request is done """
+        if self.engines:
+            db.session().replica = None
+
+
+replicas = ReadReplicas()
@@ -1,14 +1,37 @@
 import os
 import sys
+import json
+import base64
+import hashlib
+import functools
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, \
+    stream_with_context
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
 from flasgger import Swagger
 from flask_sqlalchemy import SQLAlchemy
 
-from models import Wishlist, Item, DataValidationError
-from vcap import get_database_uri
+from models import Wishlist, Item, DataValidationError, MonitoredQueuePool, db, paginate, \
+    pool_stats, stream, committer
+from group_commit import BATCH_BUCKETS
+from vcap import get_database_uri, get_database_pool_options, get_replica_uris
+from metrics import metrics, serializing
+from compression import compression, static_assets
+from idempotency import idempotency
+from admission import admission
+from replicas import replicas
+from log_queue import QueueHandler, SamplingFilter, parse_rates
+
+# Encode list responses as compact JSON, with a faster encoder when one is installed
+try:
+    from ujson import dumps as dump_json
+except ImportError:
+    try:
+        from simplejson import dumps
+    except ImportError:
+        from json import dumps
+    dump_json = functools.partial(dumps, separators=(',', ':'))
 
 
 app = Flask(__name__)
@@ -27,12 +50,95 @@ app.config['SWAGGER'] = {
 }
 
 Swagger(app)
+metrics.init_app(app)
+compression.init_app(app)
+static_assets.init_app(app)
+idempotency.init_app(app)
+admission.init_app(app, owner=Wishlist.get_owner)
+replicas.init_app(app)
+metrics.add_counter('group_commit_batches_total', 'Transactions committed by group commit',
+                    lambda: committer.batches)
+metrics.add_histogram('group_commit_batch_size', 'Writes committed together by group commit',
+                      BATCH_BUCKETS, lambda: committer.batch_sizes)
+metrics.add_counter('idempotent_replays_total',
+                    'Responses replayed for a retried Idempotency-Key',
+                    lambda: idempotency.replays)
+metrics.add_counter('throttled_requests_total',
+                    'Requests turned away with 429 by the per customer rate limit',
+                    lambda: admission.throttled)
+metrics.add_counter('shed_requests_total',
+                    'Requests turned away with 503 by the per route concurrency limit',
+                    lambda: admission.shed)
+metrics.add_counter('replica_reads_total', 'Requests that read from a read replica',
+                    lambda: replicas.reads)
+metrics.add_counter('replica_fallbacks_total',
+                    'Reads sent to the primary because no replica was available or it failed',
+                    lambda: replicas.fallbacks)
 
 # dev config
 app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# GET requests read from these, unless the client wrote in the last
+# REPLICA_STICKY_SECONDS; an unreachable replica is skipped for REPLICA_RETRY_INTERVAL
+app.config['REPLICA_URIS'] = get_replica_uris()
+app.config['REPLICA_STICKY_SECONDS'] = float(os.getenv('REPLICA_STICKY_SECONDS', '5'))
+app.config['REPLICA_RETRY_INTERVAL'] = float(os.getenv('REPLICA_RETRY_INTERVAL', '30'))
+# SQLite profile: with WAL readers no longer block behind a writer, and
+# synchronous=NORMAL only fsyncs at checkpoints instead of on every commit
+app.config['SQLITE_PRAGMAS'] = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))),   # milliseconds
+    ('cache_size', -int(os.getenv('SQLITE_CACHE_SIZE', '65536'))),      # KiB
+    ('mmap_size', int(os.getenv('SQLITE_MMAP_SIZE', '268435456'))),     # bytes
+]
+# reuse SQLite connections so the pragmas run once per connection
+app.config['SQLITE_POOL_SIZE'] = int(os.getenv('SQLITE_POOL_SIZE', '5'))
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(get_database_pool_options(),
+                                                   poolclass=MonitoredQueuePool)
 app.config['SECRET_KEY'] = 'please, tell nobody... we are wishlist squad'
 app.config['LOGGING_LEVEL'] = logging.INFO
+# log records waiting to be written; more are dropped instead of blocking requests
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# fraction of the INFO records of each logger that is kept, e.g. the model lookups
+app.config['LOG_SAMPLE_RATES'] = parse_rates(os.getenv('LOG_SAMPLE_RATES', 'models=0.01'))
+# gzip or brotli compress responses of at least COMPRESS_MIN_SIZE bytes
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', '500'))
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', '6'))
+# Flask 0.12 indents every response outside of debug mode, and sorting the
+# keys makes the json module fall back from its C encoder to pure Python
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+app.config['JSON_SORT_KEYS'] = False
+app.config['MAX_BATCH_SIZE'] = int(os.getenv('MAX_BATCH_SIZE', '10000'))
+app.config['DEFAULT_PAGE_SIZE'] = int(os.getenv('DEFAULT_PAGE_SIZE', '100'))
+app.config['MAX_PAGE_SIZE'] = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+app.config['STREAM_CHUNK_SIZE'] = int(os.getenv('STREAM_CHUNK_SIZE', '500'))
+app.config['ENTITY_CACHE_SIZE'] = int(os.getenv('ENTITY_CACHE_SIZE', '1024'))
+app.config['ENTITY_CACHE_TTL'] = float(os.getenv('ENTITY_CACHE_TTL', '30'))
+# statements that take longer (in seconds) are logged to wishlists.slow_queries
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.getenv('SLOW_QUERY_THRESHOLD', '0.1'))
+# commit new items and wishlists of concurrent requests together, up to
+# GROUP_COMMIT_MAX_BATCH at a time after waiting up to GROUP_COMMIT_MAX_WAIT seconds
+app.config['GROUP_COMMIT'] = os.getenv('GROUP_COMMIT', 'false').lower() in ('1', 'true', 'yes')
+app.config['GROUP_COMMIT_MAX_BATCH'] = int(os.getenv('GROUP_COMMIT_MAX_BATCH', '64'))
+app.config['GROUP_COMMIT_MAX_WAIT'] = float(os.getenv('GROUP_COMMIT_MAX_WAIT', '0.005'))
+# responses to POSTs with an Idempotency-Key, replayed when the request is retried;
+# 'memory' keeps up to IDEMPOTENCY_CACHE_SIZE per process, 'database' shares them
+app.config['IDEMPOTENCY_STORE'] = os.getenv('IDEMPOTENCY_STORE', 'memory')
+app.config['IDEMPOTENCY_CACHE_SIZE'] = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+app.config['IDEMPOTENCY_TTL'] = int(os.getenv('IDEMPOTENCY_TTL', '86400'))   # seconds
+# requests per second per customer (429 past it) and requests in progress per route,
+# with up to CONCURRENCY_QUEUE_SIZE more waiting (503 past it); 0 turns a limit off
+app.config['RATE_LIMIT'] = float(os.getenv('RATE_LIMIT', '0'))
+app.config['RATE_LIMIT_BURST'] = float(os.getenv('RATE_LIMIT_BURST', '0'))
+# requests per second per client address, whatever customers it names (RATE_LIMIT when 0)
+app.config['RATE_LIMIT_CLIENT'] = float(os.getenv('RATE_LIMIT_CLIENT', '0'))
+# proxies in front of the service that append to X-Forwarded-For, see admission.py
+app.config['RATE_LIMIT_TRUSTED_PROXIES'] = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', '0'))
+app.config['CONCURRENCY_LIMIT'] = int(os.getenv('CONCURRENCY_LIMIT', '0'))
+app.config['CONCURRENCY_QUEUE_SIZE'] = int(os.getenv('CONCURRENCY_QUEUE_SIZE', '0'))
+app.config['CONCURRENCY_QUEUE_TIMEOUT'] = float(os.getenv('CONCURRENCY_QUEUE_TIMEOUT', '1'))
 
 # Pull options from environment
 DEBUG = (os.getenv('DEBUG', 'False') == 'True')
@@ -68,6 +174,13 @@ def method_not_supported(error):
     app.logger.info(message)
     return jsonify(status=405, error='Method not Allowed', message=message), 405
 
+@app.errorhandler(409)
+def conflict(error):
+    """ Handles conflicting requests with 409_CONFLICT """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=409, error='Conflict', message=message), 409
+
 @app.errorhandler(415)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -75,6 +188,13 @@ def mediatype_not_supported(error):
     app.logger.info(message)
     return jsonify(status=415, error='Unsupported media type', message=message), 415
 
+@app.errorhandler(422)
+def unprocessable_entity(error):
+    """ Handles requests that cannot be processed with 422_UNPROCESSABLE_ENTITY """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return jsonify(status=422, error='Unprocessable Entity', message=message), 422
+
 @app.errorhandler(500)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -96,12 +216,13 @@ def index():
                    status = "success"
                   ), status.HTTP_200_OK'''
 
-    return app.send_static_file('index.html')
+    return static_assets.send('index.html')
 
 ######################################################################
 # CREATE A NEW WISHLIST
 ######################################################################
 @app.route('/wishlists', methods=['POST'])
+@idempotency.idempotent
 def create_wishlist():
 
     """
@@ -113,6 +234,11 @@ def create_wishlist():
     tags:
         - Wishlist
     parameters:
+        - name: Idempotency-Key
+          in: header
+          type: string
+          description: a retry with the same key gets the first response back
+          required: false
         - name: body
           in: body
           required: true
@@ -134,6 +260,10 @@ def create_wishlist():
     responses:
       201:
         description: Successfully Created wishlist
+      409:
+        description: A request with the same Idempotency-Key is still running
+      422:
+        description: The Idempotency-Key was already used with another body
 
     """
     check_content_type('application/json')
@@ -171,6 +301,10 @@ def get_wishlist(wishlist_id):
         in: path
         type: integer
         required: true
+      - name: expand
+        in: query
+        description: pass items to include the items of the wishlist
+        type: string
 
     definitions:
         Wishlist:
@@ -203,14 +337,34 @@ def get_wishlist(wishlist_id):
             description: List of items in the wishlist
             schema:
                 $ref: '#/definitions/Wishlist'
+        304:
+                description: Wishlist has not changed since the ETag in If-None-Match
         404:
                 description: Wishlist with id wishlist_id not found
     """
 
-    wishlist = Wishlist.get(wishlist_id)
-    if not wishlist:
+    expand = check_expand()
+    version = Wishlist.get_version(wishlist_id)
+    if not version:
         raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
-    return make_response(jsonify(wishlist.serialize()), status.HTTP_200_OK)
+
+    def build():
+        if expand:
+            wishlist = Wishlist.get_with_items(wishlist_id)
+            if not wishlist:
+                raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
+            return make_response(jsonify(wishlist.serialize(include_items=True)),
+                                 status.HTTP_200_OK)
+        wishlist = Wishlist.get(wishlist_id)
+        if wishlist and wishlist.version != version[0]:
+            # cached by this worker before another worker changed it
+            Wishlist.cache.invalidate(wishlist_id)
+            db.session.refresh(wishlist)
+        if not wishlist:
+            raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
+        return make_response(jsonify(wishlist.serialize()), status.HTTP_200_OK)
+    return conditional_response('wishlist-{}-{}-{}'.format(wishlist_id, *version),
+                                version[1], build)
 
 ######################################################################
 # GET AN ITEM
@@ -267,11 +421,18 @@ def get_item_list():
         - application/json
 
     parameters:
-      - name: wishlist_id
-        in: path
-        description: the id of the wishlist
+      - name: q
+        in: query
+        description: the start of the item name, or words of its name or description, in any case; best matches come first
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of items to return
         type: integer
-        required: true
+      - name: after
+        in: query
+        description: the cursor of the next page, from the X-Next-Cursor header
+        type: string
 
     responses:
         200:
@@ -282,10 +443,10 @@ def get_item_list():
                     schema:
                         $ref: '#/definitions/Item'
     """
-    items = Item.all()
-
-    results = [item.serialize() for item in items]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    query_items, order = Item.query, Item.id
+    if request.args.get('q'):
+        query_items, order = Item.search(request.args['q'])
+    return list_response(query_items, order, fields=Item.FIELDS)
 
 ######################################################################
 # LIST ALL ITEMS FROM A WISHLIST
@@ -310,6 +471,14 @@ def get_wishlist_item_list(wishlist_id):
         description: the id of the wishlist
         type: integer
         required: true
+      - name: limit
+        in: query
+        description: the maximum number of items to return
+        type: integer
+      - name: after
+        in: query
+        description: the cursor of the next page, from the X-Next-Cursor header
+        type: string
 
     responses:
         200:
@@ -319,12 +488,17 @@ def get_wishlist_item_list(wishlist_id):
                 items:
                     schema:
                         $ref: '#/definitions/Item'
+        304:
+            description: The Items have not changed since the ETag in If-None-Match
 
     """
-    items = Item.find_by_wishlist_id(wishlist_id)
-
-    results = [item.serialize() for item in items]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    build = lambda: list_response(Item.find_by_wishlist_id(wishlist_id), Item.id,
+                                  fields=Item.FIELDS)
+    version = Wishlist.get_version(wishlist_id)
+    if not version:
+        return build()
+    return conditional_response('items-{}-{}-{}'.format(wishlist_id, *version),
+                                version[1], build)
 
 
 ######################################################################
@@ -362,30 +536,125 @@ def get_wishlist_list():
         in: query
         description: the name of the wishlist
         type: string
+      - name: q
+        in: query
+        description: the start of the name of the wishlist, or words in it, in any case; best matches come first
+        type: string
       - name: query
         in: query
         description: the id of the customer
         type: integer
+      - name: expand
+        in: query
+        description: pass items to include the items of every wishlist
+        type: string
+      - name: limit
+        in: query
+        description: the maximum number of wishlists to return
+        type: integer
+      - name: after
+        in: query
+        description: the cursor of the next page, from the X-Next-Cursor header
+        type: string
 
     responses:
         200:
             description: A Wishlist
             schema:
                 $ref: '#/definitions/Wishlist'
+        304:
+            description: The customer's Wishlists have not changed since the ETag in If-None-Match
 
     """
-    query_lists = []
     customer_id = request.args.get('customer_id')
     keyword = request.args.get('keyword')
+    search = request.args.get('q')
+    expand = check_expand()
+    if expand:
+        serialize, fields = lambda wishlist: wishlist.serialize(include_items=True), None
+    else:
+        serialize, fields = None, Wishlist.FIELDS
     if keyword:
         query_lists = Wishlist.find_by_wishlist_name(keyword)
     elif customer_id:
         query_lists = Wishlist.find_by_customer_id(customer_id)
     else:
         """ Returns all of the Wishlists """
-        query_lists = Wishlist.all()
-    results = [wishlist.serialize() for wishlist in query_lists]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+        query_lists = Wishlist.query
+    order = Wishlist.id
+    if search:
+        query_lists, order = Wishlist.search(search, query_lists)
+    if expand:
+        query_lists = Wishlist.with_items(query_lists)
+    if customer_id and not keyword and not search:
+        fingerprint = Wishlist.get_customer_version(customer_id)
+        return conditional_response(
+            'customer-{}-{}'.format(customer_id, fingerprint), None,
+            lambda: list_response(query_lists, Wishlist.id, serialize, fields))
+    return list_response(query_lists, order, serialize, fields)
+
+
+######################################################################
+# GET A CUSTOMER SUMMARY
+######################################################################
+@app.route('/customers/<int:customer_id>/summary', methods=['GET'])
+def get_customer_summary(customer_id):
+
+    """
+    Summarizes the Wishlists of a customer
+
+    This endpoint returns every Wishlist of a customer with the number of
+    items in it, and the total number of distinct products, from a single
+    aggregate query instead of one request per Wishlist
+
+    ---
+    tags:
+      - Wishlist
+    produces:
+        - application/json
+    parameters:
+      - name: customer_id
+        in: path
+        description: the id of the customer
+        type: integer
+        required: true
+
+    definitions:
+        Summary:
+            type: object
+            properties:
+                customer_id:
+                    type: integer
+                wishlist_count:
+                    type: integer
+                item_count:
+                    type: integer
+                product_count:
+                    type: integer
+                wishlists:
+                    type: array
+                    items:
+                        type: object
+                        properties:
+                            id:
+                                type: integer
+                            wishlist_name:
+                                type: string
+                            item_count:
+                                type: integer
+
+    responses:
+        200:
+            description: The customer's Wishlists with their item counts
+            schema:
+                $ref: '#/definitions/Summary'
+        304:
+            description: The customer's Wishlists have not changed since the ETag in If-None-Match
+    """
+    fingerprint = Wishlist.get_customer_version(customer_id)
+    return conditional_response(
+        'summary-{}-{}'.format(customer_id, fingerprint), None,
+        lambda: make_response(jsonify(Wishlist.get_summary(customer_id)), status.HTTP_200_OK))
 
 
 ######################################################################
@@ -415,11 +684,8 @@ def delete_wishlist(wishlist_id):
             description: returns no content
 
     """
-    wishlist = Wishlist.get(wishlist_id)
+    wishlist = Wishlist.find(wishlist_id)
     if wishlist:
-        items = Item.find_by_wishlist_id(wishlist_id)
-        for item in items:
-            item.delete()
         wishlist.delete()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
@@ -452,16 +718,14 @@ def clear_wishlist(wishlist_id):
 
     """
 
-    items = Item.find_by_wishlist_id(wishlist_id)
-    if items:
-        for item in items:
-            item.delete()
+    Item.delete_by_wishlist_id(wishlist_id)
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
 # ADD AN ITEM TO A WISHLIST
 ######################################################################
 @app.route('/wishlists/<int:wishlist_id>/items',methods=['POST'])
+@idempotency.idempotent
 def add_item_to_wishlist(wishlist_id):
     """
     Add an Item to an existing wishlist
@@ -480,6 +744,11 @@ def add_item_to_wishlist(wishlist_id):
           type: integer
           description: the id of the Wishlist to add an item
           required: true
+        - name: Idempotency-Key
+          in: header
+          type: string
+          description: a retry with the same key gets the first response back
+          required: false
         - name: body
           in: body
           required: true
@@ -491,10 +760,14 @@ def add_item_to_wishlist(wishlist_id):
         description: Successfully added Item to wishlist
       404:
         description: Wishlist with id not found
+      409:
+        description: A request with the same Idempotency-Key is still running
+      422:
+        description: The Idempotency-Key was already used with another body
 
     """
     check_content_type('application/json')
-    wishlist = Wishlist.get(wishlist_id)
+    wishlist = Wishlist.find(wishlist_id)
     if not wishlist:
         raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
     
@@ -508,12 +781,83 @@ def add_item_to_wishlist(wishlist_id):
     """
     check_wishlist_id = item.wishlist_id
 
-    location_url = url_for('get_wishlist', wishlist_id=wishlist.id, _external=True)
+    # wishlist_id, not wishlist.id, which would reload the Wishlist after the commit
+    location_url = url_for('get_wishlist', wishlist_id=wishlist_id, _external=True)
     return make_response(jsonify(message), status.HTTP_201_CREATED,
                          {
                             'Location': location_url
                          })
 
+######################################################################
+# ADD A BATCH OF ITEMS TO A WISHLIST
+######################################################################
+@app.route('/wishlists/<int:wishlist_id>/items/batch', methods=['POST'])
+def add_items_to_wishlist(wishlist_id):
+    """
+    Add a batch of Items to an existing wishlist
+    This endpoint will add all the items in the body in a single transaction.
+    The body is either a JSON array of items or newline delimited JSON
+    (application/x-ndjson) with one item per line.
+
+    ---
+    tags:
+        - Wishlist
+
+    consumes:
+        - application/json
+        - application/x-ndjson
+
+    parameters:
+        - name: wishlist_id
+          in: path
+          type: integer
+          description: the id of the Wishlist to add the items to
+          required: true
+        - name: body
+          in: body
+          required: true
+          schema:
+            type: array
+            items:
+                $ref: '#/definitions/Item'
+
+    responses:
+      201:
+        description: Successfully added the Items, returns their ids
+      400:
+        description: One of the items is invalid, nothing was added
+      404:
+        description: Wishlist with id not found
+
+    """
+    check_content_type('application/json', 'application/x-ndjson')
+    wishlist = Wishlist.find(wishlist_id)
+    if not wishlist:
+        raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
+
+    if request.headers['Content-Type'] == 'application/x-ndjson':
+        try:
+            json_post = [json.loads(line) for line in request.get_data().splitlines()
+                         if line.strip()]
+        except ValueError:
+            raise DataValidationError('Invalid batch: body contains a line that is not JSON')
+    else:
+        json_post = request.get_json()
+    if not isinstance(json_post, list):
+        raise DataValidationError('Invalid batch: body of request must be a list of items')
+    if len(json_post) > app.config['MAX_BATCH_SIZE']:
+        raise DataValidationError('Invalid batch: at most {} items are allowed'.format(
+            app.config['MAX_BATCH_SIZE']))
+
+    items = [Item().deserialize(data, wishlist_id) for data in json_post]
+    ids = Item.save_all(items)
+
+    location_url = url_for('get_wishlist_item_list', wishlist_id=wishlist_id, _external=True)
+    return make_response(jsonify(wishlist_id=wishlist_id, ids=ids), status.HTTP_201_CREATED,
+                         {
+                            'Location': location_url
+                         })
+
 ######################################################################
 # DELETE AN ITEM FROM A WISHLIST
 ######################################################################
@@ -546,7 +890,7 @@ def delete_item(wishlist_id, item_id):
         description: Wishlist has no item with given Id OR Item with Id not found
 
     """
-    item = Item.get(item_id)
+    item = Item.find(item_id)
 
     if item is None:
         raise NotFound("Wishlist id '{}' has no item with id '{}'.".format(wishlist_id, item_id))
@@ -600,7 +944,7 @@ def update_item(wishlist_id, item_id):
 
     """
     check_content_type('application/json')
-    item = Item.get(item_id)
+    item = Item.find(item_id)
     if not item:
         raise NotFound("Item with id '{}' was not found.".format(item_id))
     item.deserialize(request.get_json(), wishlist_id)
@@ -652,7 +996,7 @@ def update_wishlists(wishlist_id):
     """
 
     check_content_type('application/json')
-    wishlist = Wishlist.get(wishlist_id)
+    wishlist = Wishlist.find(wishlist_id)
     if not wishlist:
         raise NotFound("Wishlist with id '{}' was not found.".format(wishlist_id))
     wishlist.deserialize(request.get_json())
@@ -697,6 +1041,48 @@ def get_item_description(wishlist_id,item_id):
     message = {"id": item_id,"description" : item.description}
     return make_response(jsonify(message), status.HTTP_200_OK)
 
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/pool', methods=['GET'])
+def get_pool_stats():
+    """
+    Returns live statistics about the database connection pool
+
+    ---
+    tags:
+      - Monitoring
+    produces:
+        - application/json
+
+    responses:
+        200:
+            description: Pool size, checked out connections, overflow and checkout wait times
+    """
+    return make_response(jsonify(pool_stats()), status.HTTP_200_OK)
+
+######################################################################
+# REQUEST METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns request counts and latency histograms in the Prometheus text format
+
+    ---
+    tags:
+      - Monitoring
+    produces:
+        - text/plain
+
+    responses:
+        200:
+            description: Requests by endpoint and status, and histograms of their latency,
+                database time and serialization time
+    """
+    return Response(metrics.render(), status.HTTP_200_OK,
+                    mimetype='text/plain; version=0.0.4')
+
 ###########################################
 #DELETE ALL WISHLISTS AND ITEMS (for test)
 ###########################################
@@ -710,18 +1096,168 @@ def clear_db():
 # UTILITY FUNCTIONS
 ######################################################################
 
-def init_db():
-    """ Initialies the SQLAlchemy app """
+def init_db(create_tables=True):
+    """ Initialies the SQLAlchemy app, create_tables=False leaves the schema alone """
     global app
     # Item.init_db(app)
-    Wishlist.init_db(app)
-
-def check_content_type(content_type):
-    """ Checks that the media type is correct """
-    if request.headers['Content-Type'] == content_type:
+    Wishlist.init_db(app, create_tables)
+    replicas.configure(app)
+    idempotency.configure(app)
+    admission.reset()
+
+def check_content_type(*content_types):
+    """ Checks that the media type is one of the allowed ones """
+    if request.headers['Content-Type'] in content_types:
         return
     app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
-    abort(415, 'Content-Type must be {}'.format(content_type))
+    abort(415, 'Content-Type must be {}'.format(' or '.join(content_types)))
+
+def encode_cursor(value):
+    """ Turns the id of the last row of a page into an opaque cursor """
+    return base64.urlsafe_b64encode('id:{}'.format(value)).rstrip('=')
+
+def decode_cursor(cursor):
+    """ Turns a cursor from encode_cursor back into an id """
+    try:
+        prefix, value = base64.urlsafe_b64decode(
+            str(cursor) + '=' * (-len(cursor) % 4)).split(':', 1)
+        if prefix != 'id':
+            raise ValueError(cursor)
+        return int(value)
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid cursor: {}'.format(cursor))
+
+def check_expand():
+    """ Returns True when the client asked for ?expand=items """
+    expand = request.args.get('expand')
+    if expand not in (None, 'items'):
+        raise DataValidationError('Invalid expand: only items can be expanded')
+    return expand == 'items'
+
+def list_response(query, column, serialize=None, fields=None):
+    """
+    Returns one page of a query as a JSON list
+
+    The page size comes from the limit query parameter, capped at
+    MAX_PAGE_SIZE, and the page starts after the after cursor. When there
+    are more rows, the cursor of the next page is returned in the
+    X-Next-Cursor header and as a Link header with rel="next".
+
+    Clients that accept application/x-ndjson, or pass stream=true, get a
+    streamed response instead (see stream_response). Rows are turned into
+    dictionaries with serialize, which defaults to their serialize method.
+    With fields, the model's FIELDS, only those columns are read and the
+    dictionaries are built straight from the database rows, without
+    loading model instances.
+    """
+    if fields:
+        serialize = lambda row: dict(zip(fields, row))
+    elif serialize is None:
+        serialize = lambda row: row.serialize()
+    after = request.args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    ndjson = request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+    if ndjson or request.args.get('stream') == 'true':
+        if request.args.get('expand'):
+            raise DataValidationError('Invalid expand: not supported on streamed responses')
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 1:
+            raise DataValidationError('Invalid limit: must be a positive integer')
+        return stream_response(stream(query, column, after, limit,
+                                      app.config['STREAM_CHUNK_SIZE'], fields),
+                               ndjson, serialize)
+
+    limit = request.args.get('limit', app.config['DEFAULT_PAGE_SIZE'], type=int)
+    if limit < 1:
+        raise DataValidationError('Invalid limit: must be a positive integer')
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    rows, next_after = paginate(query, column, after, limit, fields)
+    data = [serialize(row) for row in rows]
+    with serializing():
+        body = dump_json(data)
+    response = Response((body, '\n'), status.HTTP_200_OK, mimetype='application/json')
+    if next_after is not None:
+        cursor = encode_cursor(next_after)
+        args = request.args.to_dict()
+        args.update(request.view_args)
+        args['after'] = cursor
+        response.headers['X-Next-Cursor'] = cursor
+        response.headers['Link'] = '<{}>; rel="next"'.format(
+            url_for(request.endpoint, _external=True, **args))
+    return response
+
+def stream_response(rows, ndjson=False, serialize=None):
+    """
+    Streams rows to the client as they are read from the database
+
+    Memory stays bounded by STREAM_CHUNK_SIZE rows and the first bytes go
+    out before the whole result has been read. The body is a JSON array,
+    or one JSON object per line when ndjson is True. Streamed responses
+    are not paged, so MAX_PAGE_SIZE does not apply to them.
+    """
+    if serialize is None:
+        serialize = lambda row: row.serialize()
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+    if ndjson:
+        def generate():
+            chunk = []
+            for row in rows:
+                chunk.append(dump_json(serialize(row)))
+                if len(chunk) == chunk_size:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+            if chunk:
+                yield '\n'.join(chunk) + '\n'
+        mimetype = 'application/x-ndjson'
+    else:
+        def generate():
+            yield '['
+            separator = ''
+            chunk = []
+            for row in rows:
+                chunk.append(dump_json(serialize(row)))
+                if len(chunk) == chunk_size:
+                    yield separator + ','.join(chunk)
+                    separator = ','
+                    chunk = []
+            if chunk:
+                yield separator + ','.join(chunk)
+            yield ']'
+        mimetype = 'application/json'
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=mimetype)
+
+def conditional_response(tag, last_modified, build):
+    """
+    Answers a conditional GET from a version instead of the full resource
+
+    tag identifies the version of the resource. It is combined with the
+    query string and Accept header, which change the representation, into
+    the ETag. When the client's If-None-Match shows it already has this
+    version, a 304 is returned without calling build. Otherwise build()
+    makes the full response. last_modified, when given, is only sent as
+    Last-Modified: If-Modified-Since is not answered, since a date in whole
+    seconds misses changes made in the same second.
+    """
+    etag = hashlib.md5('{}|{}|{}'.format(
+        tag, request.query_string, request.headers.get('Accept', ''))).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+
+    # compressed responses carry a weak ETag, see compression.py
+    not_modified = bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+    if not_modified:
+        response = make_response('', status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = build()
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # cached copies must be revalidated, which is cheap thanks to the ETag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
@@ -730,17 +1266,30 @@ def initialize_logging(log_level=logging.INFO):
         # Set up default logging for submodules to use STDOUT
         # datefmt='%m/%d/%Y %I:%M:%S %p'
         fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-        logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
         # Make a new log handler that uses STDOUT
         handler = logging.StreamHandler(sys.stdout)
         handler.setFormatter(logging.Formatter(fmt))
         handler.setLevel(log_level)
-        # Remove the Flask default handlers and use our own
-        handler_list = list(app.logger.handlers)
-        for log_handler in handler_list:
-            app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
-        app.logger.setLevel(log_level)
+        # Format and write the records on a background thread instead of in
+        # the request, sampling the high volume ones
+        queue_handler = QueueHandler([handler], app.config['LOG_QUEUE_SIZE'])
+        sampling = SamplingFilter(app.config['LOG_SAMPLE_RATES'])
+        queue_handler.addFilter(sampling)
+        metrics.add_counter('log_records_dropped_total',
+                            'Log records dropped because the log queue was full',
+                            lambda: queue_handler.dropped)
+        metrics.add_counter('log_records_sampled_total',
+                            'INFO log records left out by sampling',
+                            lambda: sampling.sampled)
+        # Remove the default handlers and use our own
+        root = logging.getLogger()
+        for logger in (root, app.logger):
+            for log_handler in list(logger.handlers):
+                logger.removeHandler(log_handler)
+                if isinstance(log_handler, QueueHandler):
+                    log_handler.close()
+            logger.addHandler(queue_handler)
+            logger.setLevel(log_level)
         app.logger.info('Logging handler established')
 
 
@@ -38,6 +38,33 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // Gets every page of a list call, following the X-Next-Cursor of each page
+    function list_all(url) {
+        var deferred = $.Deferred();
+        var rows = [];
+        function get_page(page_url) {
+            var ajax = $.ajax({
+                type: "GET",
+                url: page_url,
+                contentType:"application/json"
+            })
+            ajax.done(function(res, text_status, xhr){
+                rows = rows.concat(res);
+                var cursor = xhr.getResponseHeader("X-Next-Cursor");
+                if (cursor) {
+                    get_page(url + (url.indexOf("?") < 0 ? "?" : "&") + "after=" + encodeURIComponent(cursor));
+                } else {
+                    deferred.resolve(rows);
+                }
+            });
+            ajax.fail(function(res){
+                deferred.reject(res);
+            });
+        }
+        get_page(url);
+        return deferred.promise();
+    }
+
     // ****************************************
     // Create a Wishlist
     // ****************************************
@@ -199,11 +226,7 @@ $(function () {
 
     $("#list-btn").click(function () {
 
-        var ajax = $.ajax({
-            type: "GET",
-            url: "/wishlists",
-            contentType:"application/json"
-        })
+        var ajax = list_all("/wishlists")
 
         ajax.done(function(res){
             //alert(res.toSource())
@@ -242,11 +265,7 @@ $(function () {
         
         console.log(url);
 
-        var ajax = $.ajax({
-            type: "GET",
-            url: url,
-            contentType:"application/json"
-        })
+        var ajax = list_all(url)
 
         ajax.done(function(res){
             //alert(res.toSource())
@@ -445,12 +464,7 @@ $(function () {
             customer_id = 'customer_id=' + customer_id
             var url = "/wishlists?" + customer_id
         }
-        var ajax = $.ajax({
-            type: "GET",
-            url: url,
-            contentType:"application/json",
-            data: ''
-        })
+        var ajax = list_all(url)
 
         ajax.done(function(res){
             //alert(res.toSource())
@@ -0,0 +1,162 @@
+"""
+Test cases for the rate limit and concurrency limit
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+import threading
+import unittest
+from mock import patch
+from flask import Flask, jsonify
+
+from admission import Admission, ConcurrencyLimit, RateLimiter
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRateLimiter(unittest.TestCase):
+    """ Test Cases for the token buckets """
+
+    def test_take(self):
+        """ A burst goes through, then requests wait for tokens to come back """
+        limiter = RateLimiter(rate=2, burst=3)
+        with patch('time.time', return_value=100.0):
+            self.assertEqual([limiter.take('a') for _ in range(3)], [0, 0, 0])
+            self.assertAlmostEqual(limiter.take('a'), 0.5)
+            self.assertEqual(limiter.take('b'), 0)
+        with patch('time.time', return_value=100.5):
+            self.assertEqual(limiter.take('a'), 0)
+            self.assertGreater(limiter.take('a'), 0)
+
+    def test_bounded(self):
+        """ The least recently used buckets are forgotten """
+        limiter = RateLimiter(rate=1, burst=1, size=2)
+        for key in ('a', 'b', 'c'):
+            limiter.take(key)
+        self.assertEqual(limiter.take('a'), 0)
+
+
+class TestConcurrencyLimit(unittest.TestCase):
+    """ Test Cases for the concurrency limit """
+
+    def test_queue(self):
+        """ Callers over the limit wait in the queue, the rest are turned away """
+        limit = ConcurrencyLimit(1, 1, 5)
+        self.assertTrue(limit.acquire())
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(limit.acquire()))
+        waiter.start()
+        while not limit.waiting:
+            pass
+        self.assertFalse(limit.acquire())  # the queue is full
+        limit.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limit.active, 1)
+
+    def test_timeout(self):
+        """ A caller that waits too long is turned away """
+        limit = ConcurrencyLimit(1, 1, 0.01)
+        limit.acquire()
+        self.assertFalse(limit.acquire())
+        self.assertEqual(limit.waiting, 0)
+
+
+class TestAdmission(unittest.TestCase):
+    """ Test Cases for the admission control of an app """
+
+    def setUp(self):
+        app = Flask(__name__)
+        self.admission = Admission()
+        owners = {1: 7, 2: 7}
+        self.admission.init_app(app, owner=owners.get)
+        self.release = threading.Event()
+        self.entered = threading.Event()
+
+        def slow():
+            self.entered.set()
+            self.release.wait(5)
+            return jsonify(done=True)
+        app.add_url_rule('/wishlists', 'get_wishlist_list', lambda: jsonify(ok=True))
+        app.add_url_rule('/wishlists/<int:wishlist_id>/items', 'add_item_to_wishlist',
+                         lambda wishlist_id: jsonify(ok=True), methods=['POST'])
+        app.add_url_rule('/slow', 'slow', slow)
+        app.add_url_rule('/metrics', 'get_metrics', lambda: 'metrics')
+        self.app = app
+        self.client = app.test_client()
+
+    def test_off_by_default(self):
+        """ Nothing is limited unless it is configured """
+        for _ in range(100):
+            self.assertEqual(self.client.get('/wishlists?customer_id=1').status_code, 200)
+
+    def test_throttle(self):
+        """ A customer over the rate gets a 429 and the others do not notice """
+        self.app.config['RATE_LIMIT'] = 1
+        self.app.config['RATE_LIMIT_BURST'] = 2
+        self.app.config['RATE_LIMIT_CLIENT'] = 100
+        statuses = [self.client.get('/wishlists?customer_id=1').status_code
+                    for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        resp = self.client.get('/wishlists?customer_id=1')
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(resp.data)['error'], 'Too Many Requests')
+        self.assertEqual(self.client.get('/wishlists?customer_id=2').status_code, 200)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.admission.throttled, 2)
+
+    def test_throttle_owner(self):
+        """ The wishlists of a customer share the customer's bucket """
+        self.app.config['RATE_LIMIT'] = 1
+        self.app.config['RATE_LIMIT_CLIENT'] = 100
+        statuses = [self.client.post('/wishlists/{}/items'.format(wishlist_id)).status_code
+                    for wishlist_id in (1, 2, 3)]
+        self.assertEqual(statuses, [200, 429, 200])
+        # the customer_id query parameter does not pick the bucket of a wishlist route
+        statuses = [self.client.post('/wishlists/1/items?customer_id={}'.format(n)).status_code
+                    for n in (10, 11)]
+        self.assertEqual(statuses, [429, 429])
+
+    def test_throttle_rotating_customers(self):
+        """ A client naming another customer every time is held to its address' rate """
+        self.app.config['RATE_LIMIT'] = 1
+        statuses = [self.client.get('/wishlists?customer_id={}'.format(n)).status_code
+                    for n in range(1, 4)]
+        self.assertEqual(statuses, [200, 429, 429])
+
+    def test_throttle_address(self):
+        """ A client cannot get a new bucket by sending its own X-Forwarded-For """
+        self.app.config['RATE_LIMIT'] = 1
+        statuses = [self.client.get('/wishlists', headers={'X-Forwarded-For': address}).status_code
+                    for address in ('10.0.0.1', '10.0.0.2')]
+        self.assertEqual(statuses, [200, 429])
+        # behind one proxy, the address it appended is the one counted
+        self.app.config['RATE_LIMIT_TRUSTED_PROXIES'] = 1
+        statuses = [self.client.get('/wishlists', headers={
+            'X-Forwarded-For': '10.0.0.{}, 192.168.0.1'.format(n)}).status_code
+                    for n in (1, 2)]
+        self.assertEqual(statuses, [200, 429])
+        resp = self.client.get('/wishlists', headers={'X-Forwarded-For': '192.168.0.2'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_shed(self):
+        """ Requests over the concurrency limit and its queue get a 503 """
+        self.app.config['CONCURRENCY_LIMIT'] = 1
+        results = []
+        busy = threading.Thread(target=lambda: results.append(self.client.get('/slow')))
+        busy.start()
+        self.entered.wait(5)
+        resp = self.client.get('/slow')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        # other routes have their own limit
+        self.assertEqual(self.client.get('/wishlists').status_code, 200)
+        self.release.set()
+        busy.join()
+        self.assertEqual(results[0].status_code, 200)
+        self.assertEqual(self.client.get('/slow').status_code, 200)
+        stats = self.admission.stats()
+        self.assertEqual(stats['shed'], 1)
+        self.assertEqual(stats['routes']['slow'], {'active': 0, 'waiting': 0})
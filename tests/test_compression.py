@@ -0,0 +1,137 @@
+"""
+Test cases for the response compression
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import re
+import json
+import zlib
+import shutil
+import tempfile
+import unittest
+from flask import Flask, Response, jsonify
+
+import compression
+from compression import Compression, StaticAssets, compress_chunks
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def gunzip(data):
+    return zlib.decompress(data, GZIP_WBITS)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestCompression(unittest.TestCase):
+    """ Test Cases for the Compression of responses """
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config['COMPRESS_MIN_SIZE'] = 100
+        Compression().init_app(app)
+        app.add_url_rule('/big', 'big', lambda: jsonify(names=['wishlist'] * 100))
+        app.add_url_rule('/small', 'small', lambda: jsonify(name='wishlist'))
+        app.add_url_rule('/binary', 'binary', lambda: Response(
+            'x' * 1000, mimetype='application/octet-stream'))
+        app.add_url_rule('/stream', 'stream', lambda: Response(
+            ('{"id":%d}\n' % n for n in range(100)), mimetype='application/x-ndjson'))
+        self.client = app.test_client()
+
+    def test_gzip(self):
+        """ Compress large JSON for clients that accept gzip """
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(json.loads(gunzip(resp.data))['names'], ['wishlist'] * 100)
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+
+    def test_not_compressed(self):
+        """ Leave small, unlisted and unaccepted responses alone """
+        resp = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/binary', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/big')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        """ Prefer brotli when the client accepts it """
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        data = json.loads(compression.brotli.decompress(resp.data))
+        self.assertEqual(len(data['names']), 100)
+        resp = self.client.get('/big', headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_stream(self):
+        """ Compress a streamed response chunk by chunk """
+        resp = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        lines = gunzip(resp.data).splitlines()
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(json.loads(lines[-1]), {'id': 99})
+
+    def test_compress_chunks(self):
+        """ Every chunk can be decompressed as soon as it arrives """
+        decoder = zlib.decompressobj(GZIP_WBITS)
+        chunks = compress_chunks(iter(['[1,', u'2]']), 6)
+        self.assertEqual(decoder.decompress(next(chunks)), '[1,')
+        self.assertEqual(decoder.decompress(next(chunks)), '2]')
+
+
+class TestStaticAssets(unittest.TestCase):
+    """ Test Cases for the StaticAssets """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, 'css'))
+        with open(os.path.join(self.folder, 'css', 'site.css'), 'w') as css:
+            css.write('body { color: white; }\n' * 100)
+        with open(os.path.join(self.folder, 'index.html'), 'w') as html:
+            html.write('<link rel="stylesheet" href="static/css/site.css">'
+                       '<script src = "/static/js/missing.js"></script>')
+        with open(os.path.join(self.folder, 'robots.txt'), 'w') as robots:
+            robots.write('User-agent: *\n')
+        app = Flask(__name__, static_folder=self.folder, static_url_path='/static')
+        self.assets = StaticAssets()
+        self.assets.init_app(app)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_fingerprinted(self):
+        """ The page links to fingerprinted files that can be cached for good """
+        html = self.client.get('/static/index.html').data
+        url = re.search(r'href="(static/css/site\.[0-9a-f]{12}\.css)"', html).group(1)
+        self.assertIn('src = "/static/js/missing.js"', html)
+        resp = self.client.get('/' + url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(gunzip(resp.data).startswith('body {'))
+        resp = self.client.get('/' + url, headers={'Accept-Encoding': 'gzip',
+                                                   'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_plain_name(self):
+        """ The plain name of a file is served but revalidated """
+        resp = self.client.get('/static/css/site.css')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertTrue(resp.data.startswith('body {'))
+
+    def test_other_files(self):
+        """ Other files are still served by Flask """
+        resp = self.client.get('/static/robots.txt')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, 'User-agent: *\n')
+        self.assertEqual(self.client.get('/static/nothing.css').status_code, 404)
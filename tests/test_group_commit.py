@@ -0,0 +1,137 @@
+"""
+Test cases for the group commit of writes
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from sqlalchemy import create_engine, event, text
+
+from group_commit import GroupCommitter, BATCH_BUCKETS
+from models import Wishlist, Item, db, committer
+from server import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///db/test.db')
+
+
+def insert(name):
+    """ Returns a write that inserts name and returns its id """
+    def write(connection):
+        result = connection.execute(text('INSERT INTO names (name) VALUES (:name)'), name=name)
+        return result.lastrowid
+    return write
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestGroupCommitter(unittest.TestCase):
+    """ Test Cases for the GroupCommitter """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.directory, 'names.db'))
+        self.engine.execute('CREATE TABLE names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+        self.commits = []
+        event.listen(self.engine, 'commit', lambda connection: self.commits.append(1))
+        self.committer = GroupCommitter()
+        self.committer.configure(self.engine, 10, 0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def submit_all(self, names):
+        """ Submits the inserts of names from one thread each, returns their results """
+        results = {}
+
+        def run(name):
+            try:
+                results[name] = self.committer.submit(insert(name))
+            except Exception as error:
+                results[name] = error
+        threads = [threading.Thread(target=run, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_batch(self):
+        """ Concurrent writes are committed together """
+        results = self.submit_all(['name{}'.format(n) for n in range(5)])
+        self.assertEqual(sorted(results.values()), [1, 2, 3, 4, 5])
+        self.assertLess(len(self.commits), 5)
+        self.assertEqual(self.committer.writes, 5)
+        self.assertEqual(self.committer.batches, len(self.commits))
+        self.assertEqual(self.engine.execute('SELECT count(*) FROM names').scalar(), 5)
+
+    def test_max_batch(self):
+        """ A batch holds at most max_batch writes """
+        self.committer.configure(self.engine, 2, 0.05)
+        self.submit_all(['name{}'.format(n) for n in range(5)])
+        self.assertGreaterEqual(self.committer.batches, 3)
+        self.assertEqual(sum(self.committer.batch_sizes[2 + BATCH_BUCKETS.index(2) + 1:]), 0)
+
+    def test_failed_write(self):
+        """ A failing write only fails its own request """
+        self.committer.submit(insert('taken'))
+        results = self.submit_all(['taken', 'free', 'other'])
+        self.assertIsInstance(results['taken'], Exception)
+        self.assertIsInstance(results['free'], (int, long))
+        self.assertIsInstance(results['other'], (int, long))
+        self.assertEqual(self.engine.execute('SELECT count(*) FROM names').scalar(), 3)
+
+    def test_batch_sizes(self):
+        """ Count the batches by size for the histogram """
+        self.committer.submit(insert('one'))
+        self.assertEqual(self.committer.batch_sizes[:3], [1, 1, 1])
+        stats = self.committer.stats()
+        self.assertTrue(stats['enabled'])
+        self.assertEqual(stats['avg_batch_size'], 1.0)
+
+
+class TestModelGroupCommit(unittest.TestCase):
+    """ Test Cases for saving models through group commit """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        app.config['GROUP_COMMIT'] = True
+        Wishlist.init_db(app)
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config['GROUP_COMMIT'] = False
+        Wishlist.init_db(app)
+
+    def test_save(self):
+        """ New wishlists and items are saved by the committer """
+        writes = committer.writes
+        wishlist = Wishlist(customer_id=1, wishlist_name='groceries')
+        wishlist.save()
+        self.assertEqual(wishlist.version, 1)
+        item = Item(wishlist_id=wishlist.id, product_id=2, name='milk', description='whole')
+        item.save()
+        self.assertEqual(committer.writes, writes + 2)
+        self.assertEqual(Item.get(item.id).name, 'milk')
+        self.assertEqual(Item.search('milk')[0].all()[0].id, item.id)
+        self.assertEqual(Wishlist.get(wishlist.id).version, 2)
+        # updates still go through the session
+        item.name = 'oat milk'
+        item.save()
+        self.assertEqual(committer.writes, writes + 2)
+        self.assertEqual(Wishlist.get(wishlist.id).version, 3)
+
+    def test_disabled(self):
+        """ Group commit is off unless it is configured """
+        self.assertTrue(committer.enabled)
+        app.config['GROUP_COMMIT'] = False
+        Wishlist.init_db(app)
+        self.assertFalse(committer.enabled)
@@ -0,0 +1,120 @@
+"""
+Test cases for the Idempotency-Key stores
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import json
+import unittest
+from datetime import datetime, timedelta
+from mock import patch
+from flask import Flask, jsonify
+
+from idempotency import Idempotency, MemoryStore, DatabaseStore, StoredResponse, CLAIM_TIMEOUT
+from models import IdempotencyRecord, Wishlist, db
+from server import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMemoryStore(unittest.TestCase):
+    """ Test Cases for the in-process store """
+
+    def test_claim(self):
+        """ The first request claims a key, the next ones see it """
+        store = MemoryStore()
+        self.assertIsNone(store.claim('key', 'body'))
+        self.assertTrue(store.claim('key', 'body').running)
+        store.save('key', StoredResponse('body', 201, '{}'))
+        self.assertEqual(store.claim('key', 'body').status, 201)
+        store.release('key')
+        self.assertIsNone(store.claim('key', 'body'))
+
+    def test_bounded(self):
+        """ The oldest keys are evicted and expired ones are reclaimed """
+        store = MemoryStore(size=2, ttl=10)
+        for key in ('a', 'b', 'c'):
+            store.claim(key, 'body')
+        self.assertEqual(store.stats()['evictions'], 1)
+        self.assertIsNone(store.claim('a', 'body'))
+        with patch('time.time', return_value=float('inf')):
+            self.assertIsNone(store.claim('c', 'body'))
+
+
+class TestDatabaseStore(unittest.TestCase):
+    """ Test Cases for the store shared through the database """
+
+    def setUp(self):
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        Wishlist.init_db(app)
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        self.store = DatabaseStore(ttl=3600)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_claim(self):
+        """ The first request claims a key, the next ones see it """
+        self.assertIsNone(self.store.claim('key', 'body'))
+        self.assertTrue(self.store.claim('key', 'body').running)
+        self.store.save('key', StoredResponse('body', 201, '{"id": 1}', 'http://x/1'))
+        stored = self.store.claim('key', 'other')
+        self.assertEqual((stored.fingerprint, stored.status, stored.body, stored.location),
+                         ('body', 201, '{"id": 1}', 'http://x/1'))
+        self.store.release('key')
+        self.assertIsNone(self.store.claim('key', 'body'))
+
+    def test_expired(self):
+        """ Abandoned claims and expired responses are taken over """
+        table = IdempotencyRecord.__table__
+        self.store.claim('running', 'body')
+        self.store.claim('done', 'body')
+        self.store.save('done', StoredResponse('body', 201, '{}'))
+        db.engine.execute(table.update().values(
+            created_at=datetime.utcnow() - timedelta(seconds=CLAIM_TIMEOUT + 1)))
+        self.assertIsNone(self.store.claim('running', 'body'))
+        self.assertEqual(self.store.claim('done', 'body').status, 201)
+        self.store.ttl = CLAIM_TIMEOUT
+        self.assertIsNone(self.store.claim('done', 'body'))
+
+
+class TestIdempotency(unittest.TestCase):
+    """ Test Cases for the idempotent views """
+
+    def setUp(self):
+        flask_app = Flask(__name__)
+        flask_app.logger.disabled = True
+        self.idempotency = Idempotency()
+        self.idempotency.init_app(flask_app)
+        self.calls = []
+
+        def create():
+            self.calls.append(1)
+            if len(self.calls) == 1:
+                raise ValueError('the first call fails')
+            return jsonify(call=len(self.calls)), 201
+        flask_app.add_url_rule('/things', 'create', self.idempotency.idempotent(create),
+                               methods=['POST'])
+        self.client = flask_app.test_client()
+
+    def test_failure_is_not_stored(self):
+        """ A request that raised can be retried with the same key """
+        headers = {'Idempotency-Key': 'key'}
+        self.assertEqual(self.client.post('/things', headers=headers).status_code, 500)
+        resp = self.client.post('/things', headers=headers)
+        self.assertEqual(json.loads(resp.data), {'call': 2})
+        resp = self.client.post('/things', headers=headers)
+        self.assertEqual(json.loads(resp.data), {'call': 2})
+        self.assertEqual(self.idempotency.replays, 1)
+
+    def test_long_key(self):
+        """ Keys are at most 255 characters """
+        resp = self.client.post('/things', headers={'Idempotency-Key': 'k' * 256})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(self.calls, [])
@@ -7,7 +7,9 @@ Test cases can be run with:
 
 import unittest
 import os
-from models import Item, DataValidationError, db
+import time
+from models import Item, EntityCache, DataValidationError, db, upgrade_db, paginate
+from sqlalchemy import inspect, event
 from werkzeug.exceptions import NotFound
 from server import app
 
@@ -124,7 +126,155 @@ class TestItems(unittest.TestCase):
         self.assertEqual(items[0].name, "toothpaste")
         self.assertEqual(items[0].description, "toothpaste for 2")
 
+    def test_save_all(self):
+        """ Save a batch of Items in one transaction """
+        Item(wishlist_id=1, product_id=1, name="toothpaste", description="toothpaste for 2").save()
+        items = [Item(wishlist_id=2, product_id=n, name="item %d" % n, description="batch")
+                 for n in range(3)]
+        ids = Item.save_all(items)
+        self.assertEqual(ids, [2, 3, 4])
+        self.assertEqual([item.id for item in items], ids)
+        self.assertEqual(Item.get(3).name, "item 1")
+        self.assertEqual(Item.save_all([]), [])
 
+    def test_search(self):
+        """ Search items by name prefix and by words of the name or description """
+        Item.save_all([Item(wishlist_id=1, product_id=1, name='Red Shoes', description='for the party'),
+                       Item(wishlist_id=1, product_id=2, name='party hat', description=None),
+                       Item(wishlist_id=2, product_id=3, name='toothpaste', description='mint')])
+        query, order = Item.search('party')
+        self.assertEqual([item.name for item in query.order_by(order)], ['party hat', 'Red Shoes'])
+        query, order = Item.search('red sh')
+        self.assertEqual([item.name for item in query], ['Red Shoes'])
+        query, order = Item.search('MIN', Item.find_by_wishlist_id(1))
+        self.assertEqual(query.count(), 0)
+
+    def test_delete_by_wishlist_id(self):
+        """ Delete all Items of a wishlist """
+        Item(wishlist_id=1, product_id=1, name="toothpaste", description="toothpaste for 2").save()
+        Item(wishlist_id=1, product_id=2, name="toothbrush", description="I need one").save()
+        Item(wishlist_id=2, product_id=3, name="beer", description="I need a drink").save()
+        Item.delete_by_wishlist_id(1)
+        self.assertEqual(Item.find_by_wishlist_id(1).count(), 0)
+        self.assertEqual(Item.find_by_wishlist_id(2).count(), 1)
+
+    def test_paginate(self):
+        """ Page through Items by id """
+        for n in range(5):
+            Item(wishlist_id=1, product_id=n, name="item", description="item").save()
+        items, after = paginate(Item.query, Item.id, None, 2)
+        self.assertEqual([item.id for item in items], [1, 2])
+        self.assertEqual(after, 2)
+        items, after = paginate(Item.query, Item.id, after, 2)
+        self.assertEqual([item.id for item in items], [3, 4])
+        items, after = paginate(Item.query, Item.id, after, 2)
+        self.assertEqual([item.id for item in items], [5])
+        self.assertEqual(after, None)
+        items, after = paginate(Item.query, Item.id)
+        self.assertEqual(len(items), 5)
+
+    def test_paginate_fields(self):
+        """ Page through Items as plain rows of their serialized fields """
+        for n in range(3):
+            Item(wishlist_id=1, product_id=n, name="item", description="item").save()
+        rows, after = paginate(Item.find_by_wishlist_id(1), Item.id, None, 2, Item.FIELDS)
+        self.assertEqual(after, 2)
+        self.assertEqual([dict(zip(Item.FIELDS, row)) for row in rows],
+                         [item.serialize() for item in Item.query.order_by(Item.id).limit(2)])
+        self.assertFalse(any(isinstance(row, Item) for row in rows))
+        rows, after = paginate(Item.query, Item.id, after, 2, Item.FIELDS)
+        self.assertEqual([row.id for row in rows], [3])
+        self.assertEqual(after, None)
+
+    def test_get_is_cached(self):
+        """ Get a hot Item without touching the database """
+        item = Item(wishlist_id=1, product_id=1, name="toothpaste", description="toothpaste for 2")
+        item.save()
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            db.session.remove()
+            self.assertEqual(Item.get(item.id).name, "toothpaste")
+            self.assertEqual(len(statements), 1)
+            db.session.remove()
+            cached = Item.get(item.id)
+            self.assertEqual(cached.name, "toothpaste")
+            self.assertEqual(cached.wishlist_id, 1)
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(Item.cache.stats()['hits'], 1)
+
+        cached.name = "toothbrush"
+        cached.save()
+        db.session.remove()
+        self.assertEqual(Item.get(item.id).name, "toothbrush")
+        Item.get(item.id).delete()
+        db.session.remove()
+        self.assertEqual(Item.get(item.id), None)
+
+    def test_cache_invalidated_by_bulk_delete(self):
+        """ Bulk deletes invalidate cached Items """
+        item = Item(wishlist_id=1, product_id=1, name="toothpaste", description="toothpaste for 2")
+        item.save()
+        item_id = item.id
+        Item.get(item_id)
+        Item.delete_by_wishlist_id(1)
+        db.session.remove()
+        self.assertEqual(Item.get(item_id), None)
+
+    def test_entity_cache(self):
+        """ The entity cache evicts the least recently used and expired entries """
+        cache = EntityCache(size=2, ttl=60)
+        cache.put(1, 'one')
+        cache.put(2, 'two')
+        self.assertEqual(cache.get(1), 'one')
+        cache.put(3, 'three')
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(3), 'three')
+        cache.invalidate(3)
+        self.assertEqual(cache.get(3), None)
+        cache.ttl = -1
+        cache.put(4, 'four')
+        self.assertEqual(cache.get(4), None)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['evictions'], 2)
+        cache.configure(0, 60)
+        cache.put(5, 'five')
+        self.assertEqual(cache.get(5), None)
+
+    def test_entity_cache_generation(self):
+        """ A row loaded before an invalidation is not cached after it """
+        cache = EntityCache(size=2, ttl=60)
+        generation = cache.generation
+        cache.invalidate(1)  # a save committed while the row was being loaded
+        cache.put(1, 'old', generation)
+        self.assertEqual(cache.get(1), None)
+        cache.put(1, 'new', cache.generation)
+        self.assertEqual(cache.get(1), 'new')
+
+    def test_lookup_indexes(self):
+        """ Lookup columns are indexed """
+        indexes = dict((index['name'], index['column_names'])
+                       for index in inspect(db.engine).get_indexes('items'))
+        self.assertEqual(indexes['ix_items_wishlist_id'], ['wishlist_id'])
+        self.assertEqual(indexes['ix_items_name'], ['name'])
+        self.assertEqual(indexes['ix_items_wishlist_id_id'], ['wishlist_id', 'id'])
+
+    def test_upgrade_db_adds_missing_indexes(self):
+        """ Upgrade an old database that has no indexes """
+        db.engine.execute('DROP INDEX ix_items_name')
+        db.engine.execute('DROP INDEX ix_items_wishlist_id_id')
+        upgrade_db()
+        names = [index['name'] for index in inspect(db.engine).get_indexes('items')]
+        self.assertIn('ix_items_name', names)
+        self.assertIn('ix_items_wishlist_id_id', names)
+        # running it again is harmless
+        upgrade_db()
 
 
 ######################################################################
@@ -0,0 +1,135 @@
+"""
+Test cases for the queued logging
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import logging
+import threading
+import unittest
+
+from log_queue import QueueHandler, SamplingFilter, parse_rates
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the records it handles, waiting for the gate to open first """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = set()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def emit(self, record):
+        self.gate.wait()
+        self.threads.add(threading.current_thread().name)
+        self.records.append(record)
+
+
+def make_record(name='models', level=logging.INFO, msg='Processing lookup for id %s ...',
+                args=(1,), exc_info=None):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, exc_info)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueueHandler(unittest.TestCase):
+    """ Test Cases for the QueueHandler """
+
+    def setUp(self):
+        self.target = ListHandler()
+        self.handler = QueueHandler([self.target], maxsize=2)
+
+    def tearDown(self):
+        self.target.gate.set()
+        self.handler.close()
+
+    def test_background_thread(self):
+        """ Records are written by the background thread """
+        self.handler.handle(make_record())
+        self.handler.stop()
+        self.assertEqual(len(self.target.records), 1)
+        self.assertEqual(self.target.threads, set(['log-queue']))
+        self.assertEqual(self.target.records[0].getMessage(), 'Processing lookup for id 1 ...')
+
+    def test_prepare(self):
+        """ Arguments and exceptions are rendered before queueing """
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            import sys
+            record = make_record(level=logging.ERROR, exc_info=sys.exc_info())
+        args = [1]
+        record.args = (args,)
+        self.handler.handle(record)
+        args.append(2)
+        self.handler.stop()
+        record = self.target.records[0]
+        self.assertEqual(record.getMessage(), 'Processing lookup for id [1] ...')
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ValueError: boom', record.exc_text)
+
+    def test_drop_when_full(self):
+        """ Records that don't fit in the queue are dropped and counted """
+        self.target.gate.clear()
+        for _ in range(10):
+            self.handler.handle(make_record())
+        # one record is being written, two wait in the queue
+        self.assertTrue(self.handler.dropped >= 7)
+        self.target.gate.set()
+        self.handler.stop()
+        self.assertEqual(len(self.target.records) + self.handler.dropped, 10)
+
+    def test_restart_after_fork(self):
+        """ A new thread is started in a forked process """
+        self.handler.handle(make_record())
+        parent_thread = self.handler._thread
+        self.handler._pid = -1    # as seen from a child process
+        self.handler.handle(make_record(msg='In the child', args=()))
+        self.assertIsNot(self.handler._thread, parent_thread)
+        self.handler.stop()
+        self.assertIn('In the child', [record.msg for record in self.target.records])
+
+    def test_level(self):
+        """ Records under a handler's level are not passed to it """
+        self.target.setLevel(logging.WARNING)
+        self.handler.handle(make_record())
+        self.handler.handle(make_record(level=logging.WARNING))
+        self.handler.stop()
+        self.assertEqual([r.levelno for r in self.target.records], [logging.WARNING])
+
+
+class TestSamplingFilter(unittest.TestCase):
+    """ Test Cases for the SamplingFilter """
+
+    def test_sampling(self):
+        """ Keep one in every n INFO records of a sampled logger """
+        sampling = SamplingFilter({'models': 0.1})
+        kept = [sampling.filter(make_record(args=(n,))) for n in range(100)]
+        self.assertEqual(kept.count(True), 10)
+        self.assertTrue(kept[0])
+        self.assertEqual(sampling.sampled, 90)
+        # a child logger is sampled too, per message
+        self.assertTrue(sampling.filter(make_record(name='models.item', msg='Other')))
+        self.assertFalse(sampling.filter(make_record(name='models.item', msg='Other')))
+
+    def test_not_sampled(self):
+        """ Warnings and other loggers are always kept """
+        sampling = SamplingFilter({'models': 0.1, 'server': 1.0})
+        for _ in range(5):
+            self.assertTrue(sampling.filter(make_record(level=logging.WARNING)))
+            self.assertTrue(sampling.filter(make_record(name='server')))
+            self.assertTrue(sampling.filter(make_record(name='modelsx')))
+
+    def test_drop_all(self):
+        """ A rate of 0 drops every INFO record """
+        sampling = SamplingFilter({'models': 0})
+        self.assertFalse(sampling.filter(make_record()))
+
+    def test_parse_rates(self):
+        """ Parse rates from the environment """
+        self.assertEqual(parse_rates('models=0.01, server=0.5'),
+                         {'models': 0.01, 'server': 0.5})
+        self.assertEqual(parse_rates(''), {})
@@ -0,0 +1,119 @@
+"""
+Test cases for the request metrics
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from metrics import Metrics, BUCKETS, estimate_quantile
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the request metrics """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_observe(self):
+        """ Count requests by status and time them in buckets """
+        metrics = Metrics()
+        metrics.observe('get_wishlist', 'GET', 200, 0.02, 0.005, 0.001)
+        metrics.observe('get_wishlist', 'GET', 404, 0.003, 0.001, 0.0)
+        statuses, histograms, _ = metrics.collect()
+        self.assertEqual(statuses, {('get_wishlist', 'GET', '200'): 1,
+                                    ('get_wishlist', 'GET', '404'): 1})
+        duration = histograms[('get_wishlist', 'GET')][0]
+        self.assertEqual(duration[0], 2)
+        self.assertAlmostEqual(duration[1], 0.023)
+        self.assertEqual(duration[2 + BUCKETS.index(0.025)], 1)
+        self.assertEqual(duration[2 + BUCKETS.index(0.005)], 1)
+
+    def test_render(self):
+        """ Render the counters in the Prometheus text format """
+        metrics = Metrics()
+        metrics.observe('delete_wishlist', 'DELETE', 204, 20.0, 0.5, 0.0)
+        text = metrics.render()
+        self.assertIn('# TYPE wishlists_requests_total counter', text)
+        self.assertIn('# TYPE wishlists_request_db_seconds histogram', text)
+        self.assertIn('wishlists_request_duration_seconds_bucket{endpoint="delete_wishlist",'
+                      'method="DELETE",le="10.0"} 0', text)
+        self.assertIn('wishlists_request_duration_seconds_bucket{endpoint="delete_wishlist",'
+                      'method="DELETE",le="+Inf"} 1', text)
+        self.assertIn('wishlists_request_serialization_seconds_sum{endpoint="delete_wishlist",'
+                      'method="DELETE"} 0.0', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_render_histogram(self):
+        """ Render a histogram kept elsewhere with cumulative buckets """
+        metrics = Metrics()
+        metrics.add_histogram('batch_size', 'Writes per batch', (1, 10), lambda: [3, 12, 1, 1, 1])
+        text = metrics.render()
+        self.assertIn('# TYPE wishlists_batch_size histogram', text)
+        self.assertIn('wishlists_batch_size_bucket{le="1"} 1', text)
+        self.assertIn('wishlists_batch_size_bucket{le="10"} 2', text)
+        self.assertIn('wishlists_batch_size_bucket{le="+Inf"} 3', text)
+        self.assertIn('wishlists_batch_size_sum 12', text)
+        self.assertIn('wishlists_batch_size_count 3', text)
+
+    def test_estimate_quantile(self):
+        """ Estimate quantiles from bucket counts """
+        buckets = [0] * (len(BUCKETS) + 1)
+        self.assertEqual(estimate_quantile(buckets, 0.5), 0.0)
+        buckets[0] = 10    # all under 1ms
+        self.assertAlmostEqual(estimate_quantile(buckets, 0.5), 0.0005)
+        buckets[-1] = 90   # and most over the largest bound
+        self.assertEqual(estimate_quantile(buckets, 0.99), BUCKETS[-1])
+
+    def test_processes_add_up(self):
+        """ Add up the metrics every process wrote to the directory """
+        other = Metrics(self.directory)
+        other.observe('get_item', 'GET', 200, 0.01, 0.0, 0.0)
+        with patch('os.getpid', return_value=-1):
+            other.dump()
+        metrics = Metrics(self.directory)
+        metrics.observe('get_item', 'GET', 200, 0.01, 0.0, 0.0)
+        statuses, histograms, _ = metrics.collect()
+        self.assertEqual(statuses[('get_item', 'GET', '200')], 2)
+        self.assertEqual(histograms[('get_item', 'GET')][0][0], 2)
+        # a file being written is skipped
+        with open(os.path.join(self.directory, 'broken.json'), 'w') as broken:
+            broken.write('{')
+        statuses, _, _ = metrics.collect()
+        self.assertEqual(statuses[('get_item', 'GET', '200')], 2)
+
+    def test_earlier_run_ignored(self):
+        """ Leave out the snapshots written before this run started """
+        other = Metrics(self.directory)
+        other.observe('get_item', 'GET', 200, 0.01, 0.0, 0.0)
+        with patch('os.getpid', return_value=-1):
+            other.dump()
+        path = os.path.join(self.directory, '-1.json')
+        os.utime(path, (1000.0, 1000.0))
+        metrics = Metrics(self.directory, started=2000.0)
+        statuses, _, _ = metrics.collect()
+        self.assertEqual(statuses, {})
+        os.utime(path, (3000.0, 3000.0))
+        statuses, _, _ = metrics.collect()
+        self.assertEqual(statuses[('get_item', 'GET', '200')], 1)
+
+    def test_dump_once_a_second(self):
+        """ Write a snapshot at most once a second """
+        metrics = Metrics(self.directory)
+        metrics.observe('get_item', 'GET', 200, 0.01, 0.0, 0.0)
+        metrics.observe('get_item', 'GET', 200, 0.01, 0.0, 0.0)
+        self.assertEqual(os.listdir(self.directory), ['{}.json'.format(os.getpid())])
+        reader = Metrics(self.directory)
+        with patch('os.getpid', return_value=-1):
+            statuses, _, _ = reader.collect()
+        self.assertEqual(statuses[('get_item', 'GET', '200')], 1)
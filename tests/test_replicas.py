@@ -0,0 +1,138 @@
+"""
+Test cases for the read replica routing
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+from mock import patch
+from sqlalchemy import exc
+from flask_api import status    # HTTP Status Codes
+
+from models import Item, Wishlist, db
+import server
+from replicas import replicas, COOKIE
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicas(unittest.TestCase):
+    """ Test Cases for reading from a replica, with the primary and the replica in two SQLite files """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        server.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        server.app.config['REPLICA_URIS'] = [
+            'sqlite:///' + os.path.join(self.directory, 'replica.db')]
+        server.init_db()
+        db.create_all()
+        self.replica = replicas.engines[0]
+        db.metadata.create_all(self.replica)
+        # the replica has caught up with the first wishlist only
+        Wishlist(customer_id=1, wishlist_name='grocery').save()
+        self.replica.execute(Wishlist.__table__.insert(), customer_id=1, wishlist_name='grocery')
+        Wishlist.cache.clear()
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        server.app.config['REPLICA_URIS'] = []
+        server.init_db()
+        shutil.rmtree(self.directory)
+
+    def get_wishlist_names(self, client):
+        resp = client.get('/wishlists', query_string='customer_id=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return [wishlist['wishlist_name'] for wishlist in json.loads(resp.data)]
+
+    def test_read_from_replica(self):
+        """ Reads go to the replica and writes to the primary """
+        reads = replicas.reads
+        Wishlist(customer_id=1, wishlist_name='beverage').save()
+        self.assertEqual(self.get_wishlist_names(self.app), ['grocery'])
+        self.assertEqual(replicas.reads, reads + 1)
+        resp = self.app.put('/wishlists/1', data=json.dumps(
+            {'customer_id': 1, 'wishlist_name': 'groceries'}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(Wishlist.query.get(1).wishlist_name, 'groceries')
+        name = self.replica.execute('SELECT wishlist_name FROM wishlists').scalar()
+        self.assertEqual(name, 'grocery')
+
+    def test_read_your_writes(self):
+        """ A client that wrote reads from the primary for a while """
+        resp = self.app.post('/wishlists', data=json.dumps(
+            {'customer_id': 1, 'wishlist_name': 'beverage'}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn(COOKIE, resp.headers['Set-Cookie'])
+        self.assertEqual(self.get_wishlist_names(self.app), ['grocery', 'beverage'])
+        # other clients still read from the replica
+        self.assertEqual(self.get_wishlist_names(server.app.test_client()), ['grocery'])
+        # and so does this one once the window is over
+        self.app.set_cookie('localhost', COOKIE, '0')
+        self.assertEqual(self.get_wishlist_names(self.app), ['grocery'])
+
+    def test_read_your_writes_cached(self):
+        """ Replica reads of other clients do not fill the cache with stale rows """
+        item = {'wishlist_id': 1, 'product_id': 1, 'name': 'milk', 'description': 'a gallon'}
+        Item(**item).save()
+        self.replica.execute(Item.__table__.insert(), **item)
+        self.assertEqual(json.loads(self.app.get('/items/1').data)['name'], 'milk')
+        resp = self.app.put('/wishlists/1/items/1', data=json.dumps(
+            dict(item, name='oat milk')), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        db.session.remove()    # as at the end of every request under gunicorn
+        self.assertEqual(json.loads(server.app.test_client().get('/items/1').data)['name'], 'milk')
+        db.session.remove()
+        self.assertEqual(json.loads(self.app.get('/items/1').data)['name'], 'oat milk')
+
+    def test_unavailable_replica(self):
+        """ A read that fails on the replica is run again on the primary """
+        server.app.config['REPLICA_URIS'] = ['sqlite:///' + os.path.join(
+            self.directory, 'missing', 'replica.db')]
+        server.init_db()
+        Wishlist(customer_id=1, wishlist_name='beverage').save()
+        fallbacks = replicas.fallbacks
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.get_wishlist_names(self.app), ['grocery', 'beverage'])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(replicas.fallbacks, fallbacks + 1)
+        # it is not tried again until the retry interval is over
+        reads = replicas.reads
+        self.assertEqual(self.get_wishlist_names(self.app), ['grocery', 'beverage'])
+        self.assertEqual(replicas.fallbacks, fallbacks + 2)
+        self.assertEqual(replicas.reads, reads)
+        # a failed read on the primary is not retried
+        logging.disable(logging.CRITICAL)
+        try:
+            with patch('models.Wishlist.find_by_customer_id',
+                       side_effect=exc.OperationalError('SELECT', {}, Exception('down'))):
+                resp = self.app.get('/wishlists', query_string='customer_id=1')
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(replicas.fallbacks, fallbacks + 3)
+
+    def test_replica_lost_mid_request(self):
+        """ A replica that fails during a read is marked down, the read is not lost """
+        self.replica.execute('DROP TABLE wishlists')
+        Wishlist(customer_id=1, wishlist_name='beverage').save()
+        fallbacks = replicas.fallbacks
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.get_wishlist_names(self.app), ['grocery', 'beverage'])
+            resp = self.app.get('/wishlists/1')
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(replicas.fallbacks, fallbacks + 2)
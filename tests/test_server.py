@@ -9,8 +9,10 @@ import unittest
 import os
 import json
 import logging
+from contextlib import contextmanager
 from flask_api import status    # HTTP Status Codes
 from mock import MagicMock, patch
+from sqlalchemy import event
 
 from models import Item, Wishlist, DataValidationError, db
 import server
@@ -21,6 +23,7 @@ DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///db/test.db')
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_405_METHOD_NOT_ALLOWED = 405
@@ -61,6 +64,23 @@ class TestServer(unittest.TestCase):
         db.session.remove()
         db.drop_all()
 
+    @contextmanager
+    def assertMaxQueries(self, count):
+        """ Fails when the block runs more than count SQL statements """
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.session.remove()
+        Wishlist.cache.clear()
+        Item.cache.clear()
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertTrue(len(statements) <= count, '{} queries, at most {} expected:\n{}'.format(
+            len(statements), count, '\n'.join(statements)))
+
     def test_index(self):
         """ Test the Index """
         resp = self.app.get('/') 
@@ -94,6 +114,83 @@ class TestServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(len(data), 3)
 
+    def test_get_item_list_pages(self):
+        """ Page through the Items with a cursor """
+        resp = self.app.get('/items', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['toothpaste', 'toilet paper'])
+        cursor = resp.headers['X-Next-Cursor']
+        self.assertIn('rel="next"', resp.headers['Link'])
+        self.assertIn('after=' + cursor, resp.headers['Link'])
+
+        resp = self.app.get('/items', query_string={'limit': 2, 'after': cursor})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['beer'])
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+        self.assertNotIn('Link', resp.headers)
+
+    def test_get_wishlist_list_pages(self):
+        """ Page through a customer's Wishlists keeping the query """
+        Wishlist(customer_id=1, wishlist_name='party').save()
+        resp = self.app.get('/wishlists', query_string='customer_id=1&limit=1')
+        self.assertEqual(json.loads(resp.data)[0]['wishlist_name'], 'grocery')
+        self.assertIn('customer_id=1', resp.headers['Link'])
+        resp = self.app.get('/wishlists', query_string={
+            'customer_id': 1, 'limit': 1, 'after': resp.headers['X-Next-Cursor']})
+        self.assertEqual(json.loads(resp.data)[0]['wishlist_name'], 'party')
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+    def test_get_list_max_page_size(self):
+        """ The server caps the page size """
+        server.app.config['MAX_PAGE_SIZE'] = 2
+        try:
+            resp = self.app.get('/items', query_string='limit=100')
+        finally:
+            server.app.config['MAX_PAGE_SIZE'] = 1000
+        self.assertEqual(len(json.loads(resp.data)), 2)
+        self.assertIn('X-Next-Cursor', resp.headers)
+
+    def test_get_item_list_stream(self):
+        """ Stream all Items as a JSON array """
+        server.app.config['STREAM_CHUNK_SIZE'] = 2
+        try:
+            resp = self.app.get('/items', query_string='stream=true')
+        finally:
+            server.app.config['STREAM_CHUNK_SIZE'] = 500
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([item['name'] for item in data], ['toothpaste', 'toilet paper', 'beer'])
+
+    def test_get_wishlist_list_ndjson(self):
+        """ Stream Wishlists as newline delimited JSON """
+        resp = self.app.get('/wishlists', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        data = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([wishlist['wishlist_name'] for wishlist in data], ['grocery', 'beverage'])
+
+        resp = self.app.get('/wishlists', query_string='customer_id=2',
+                            headers={'Accept': 'application/x-ndjson'})
+        data = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([wishlist['wishlist_name'] for wishlist in data], ['beverage'])
+
+    def test_get_list_stream_empty(self):
+        """ Stream an empty list """
+        resp = self.app.get('/wishlists/5/items', query_string='stream=true')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/wishlists/5/items', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.data, '')
+
+    def test_get_list_bad_page_args(self):
+        """ Bad limits and cursors are rejected """
+        resp = self.app.get('/items', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/items', query_string='after=not-a-cursor')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_wishlist_item_list(self):
         """ Test getting a list of Items from one specific Wishlist """
         wishlist = Wishlist.find_by_customer_id(1)[0]
@@ -146,6 +243,132 @@ class TestServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(json.loads(resp.data)['wishlist_name'], 'beverage')
 
+    def test_get_wishlist_not_modified(self):
+        """ Get a Wishlist that hasn't changed since the last GET """
+        resp = self.app.get('/wishlists/1')
+        etag = resp.headers['ETag']
+        self.assertTrue(resp.headers.get('Last-Modified', None) != None)
+        resp = self.app.get('/wishlists/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        new_wishlist = {'customer_id': 1, 'wishlist_name': "alex's wishlist"}
+        resp = self.app.put('/wishlists/1', data=json.dumps(new_wishlist), content_type='application/json')
+        resp = self.app.get('/wishlists/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(json.loads(resp.data)['wishlist_name'], "alex's wishlist")
+
+    def test_get_wishlist_item_list_not_modified(self):
+        """ The Items ETag changes whenever an Item of the Wishlist changes """
+        resp = self.app.get('/wishlists/1/items')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/wishlists/1/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # another representation of the same items has another ETag
+        resp = self.app.get('/wishlists/1/items', query_string='limit=1',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        new_item = {"product_id": 3, "name": "soda", "description": "I need some soft drinks"}
+        self.app.post('/wishlists/1/items', data=json.dumps(new_item), content_type='application/json')
+        resp = self.app.get('/wishlists/1/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 3)
+        etag = resp.headers['ETag']
+
+        item = Item.find_by_name('soda')[0]
+        self.app.delete('/wishlists/1/items/{}'.format(item.id))
+        resp = self.app.get('/wishlists/1/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers['ETag']
+        self.app.put('/wishlists/1/clear', content_type='application/json')
+        resp = self.app.get('/wishlists/1/items', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_get_wishlist_id_reused(self):
+        """ A new Wishlist that gets the id of a deleted one has another ETag """
+        resp = self.app.post('/wishlists', data=json.dumps(
+            {'customer_id': 5, 'wishlist_name': 'old'}), content_type='application/json')
+        wishlist_id = json.loads(resp.data)['id']
+        etag = self.app.get('/wishlists/{}'.format(wishlist_id)).headers['ETag']
+        customer_etag = self.app.get('/wishlists', query_string='customer_id=5').headers['ETag']
+        self.app.delete('/wishlists/{}'.format(wishlist_id))
+        resp = self.app.post('/wishlists', data=json.dumps(
+            {'customer_id': 5, 'wishlist_name': 'new'}), content_type='application/json')
+        self.assertEqual(json.loads(resp.data)['id'], wishlist_id)
+        resp = self.app.get('/wishlists/{}'.format(wishlist_id), headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['wishlist_name'], 'new')
+        resp = self.app.get('/wishlists', query_string='customer_id=5',
+                            headers={'If-None-Match': customer_etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_query_customerid_wishlist_not_modified(self):
+        """ The customer's Wishlists ETag changes when one is added or deleted """
+        resp = self.app.get('/wishlists', query_string='customer_id=1')
+        etag = resp.headers['ETag']
+        self.assertNotIn('Last-Modified', resp.headers)
+        resp = self.app.get('/wishlists', query_string='customer_id=1',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        new_wishlist = {'customer_id': 1, 'wishlist_name': "alex's wishlist"}
+        self.app.post('/wishlists', data=json.dumps(new_wishlist), content_type='application/json')
+        resp = self.app.get('/wishlists', query_string='customer_id=1',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+        # a date cannot tell that a Wishlist was deleted, so only the ETag is answered
+        etag = resp.headers['ETag']
+        self.app.delete('/wishlists/1')
+        resp = self.app.get('/wishlists', query_string='customer_id=1',
+                            headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/wishlists', query_string='customer_id=1',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 1)
+
+    def test_get_wishlist_expand_items(self):
+        """ Get a Wishlist together with its Items """
+        resp = self.app.get('/wishlists/1', query_string='expand=items')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['wishlist_name'], 'grocery')
+        self.assertEqual([item['name'] for item in data['items']], ['toothpaste', 'toilet paper'])
+        resp = self.app.get('/wishlists/1', query_string='expand=customer')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_wishlist_list_expand_items(self):
+        """ List a customer's Wishlists and Items in a fixed number of queries """
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        for n in range(5):
+            wishlist = Wishlist(customer_id=1, wishlist_name='list %d' % n)
+            wishlist.save()
+            Item(wishlist_id=wishlist.id, product_id=n, name='item', description='item').save()
+        db.session.remove()
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            resp = self.app.get('/wishlists', query_string='customer_id=1&expand=items')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 6)
+        self.assertEqual(len(data[0]['items']), 2)
+        self.assertEqual([len(wishlist['items']) for wishlist in data[1:]], [1] * 5)
+        # version lookup, wishlists, items
+        self.assertEqual(len(statements), 3)
+
+        resp = self.app.get('/wishlists', query_string='expand=items&stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_wishlist_not_found(self):
         """Test getting a wishlist thats not found """
         resp = self.app.get('/wishlists/0')
@@ -196,6 +419,7 @@ class TestServer(unittest.TestCase):
         self.assertEqual(len(resp.data), 0)
         new_count = self.get_wishlist_count()
         self.assertEqual(new_count, wishlist_count - 1)
+        self.assertEqual(Item.find_by_wishlist_id(wishlist.id).count(), 0)
 
     def test_clear_wishlist(self):
         """ Test clearing a Wishlist """
@@ -227,6 +451,22 @@ class TestServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['name'], 'diet coke')
 
+    def test_update_item_with_stale_cache(self):
+        """ An update is not lost when another worker changed the cached Item """
+        item = Item.find_by_name('toilet paper')[0]
+        item_id = item.id
+        Item.get(item_id)  # cached with the name 'toilet paper'
+        db.session.execute(Item.__table__.update().where(Item.id == item_id).values(name='tissues'))
+        db.session.commit()  # as another worker would, without touching this cache
+        db.session.remove()
+        new_item = {'product_id': 2, 'name': 'toilet paper', 'description': 'I need a toilet paper'}
+        resp = self.app.put('/wishlists/1/items/{}'.format(item_id), data=json.dumps(new_item),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['name'], 'toilet paper')
+        db.session.remove()
+        self.assertEqual(Item.find(item_id).name, 'toilet paper')
+
     def test_update_item_not_found(self):
         """Test Updating an item doesn't exist"""
         new_item = {'wishlist_id': 0, 'product_id': 2, 'name': "diet coke", 'description': 'I need a coke'}
@@ -296,6 +536,153 @@ class TestServer(unittest.TestCase):
         resp =self.app.post('/wishlists', data=data, content_type="text/plain")
         self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_add_items_batch(self):
+        """ Add a batch of Items to a Wishlist """
+        item_count = self.get_item_count()
+        new_items = [{"product_id": n, "name": "soda %d" % n, "description": "I need some soft drinks"}
+                     for n in range(5)]
+        resp = self.app.post('/wishlists/2/items/batch', data=json.dumps(new_items),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(resp.headers.get('Location', None) != None)
+        ids = json.loads(resp.data)['ids']
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(self.get_item_count(), item_count + 5)
+        for n, item_id in enumerate(ids):
+            item = Item.get(item_id)
+            self.assertEqual(item.wishlist_id, 2)
+            self.assertEqual(item.name, "soda %d" % n)
+
+    def test_add_items_batch_ndjson(self):
+        """ Add a batch of Items sent as newline delimited JSON """
+        lines = [json.dumps({"product_id": n, "name": "beer", "description": "I need a drink"})
+                 for n in range(3)]
+        resp = self.app.post('/wishlists/1/items/batch', data='\n'.join(lines) + '\n',
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(json.loads(resp.data)['ids']), 3)
+        self.assertEqual(Item.find_by_wishlist_id(1).count(), 5)
+
+    def test_add_items_batch_bad_data(self):
+        """ Add a batch with an invalid Item adds nothing """
+        item_count = self.get_item_count()
+        new_items = [{"product_id": 1, "name": "soda", "description": "I need some soft drinks"},
+                     {"product_id": 2, "description": "no name"}]
+        resp = self.app.post('/wishlists/1/items/batch', data=json.dumps(new_items),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/wishlists/1/items/batch', data=json.dumps({"product_id": 1}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/wishlists/1/items/batch', data='{"product_id": 1\n',
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_item_count(), item_count)
+
+    def test_add_items_batch_wishlist_not_found(self):
+        """ Add a batch of Items to a Wishlist that doesn't exist """
+        resp = self.app.post('/wishlists/0/items/batch', data=json.dumps([]),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_pool_stats(self):
+        """ Get the connection pool statistics """
+        resp = self.app.get('/pool')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(len(json.loads(resp.data)) > 0)
+
+    def test_query_counts(self):
+        """ Every endpoint stays within its query budget """
+        item = {'product_id': 9, 'name': 'soap', 'description': 'I need soap'}
+        budgets = [
+            ('get', '/wishlists/1', None, 2),
+            ('get', '/wishlists/1?expand=items', None, 2),
+            ('get', '/wishlists', None, 1),
+            ('get', '/wishlists?customer_id=1', None, 2),
+            ('get', '/wishlists?keyword=grocery', None, 1),
+            ('get', '/wishlists?q=groc', None, 1),
+            ('get', '/items?q=need', None, 1),
+            ('get', '/customers/1/summary', None, 2),
+            ('get', '/wishlists/1/items', None, 2),
+            ('get', '/items', None, 1),
+            ('get', '/items/1', None, 1),
+            ('get', '/wishlists/1/items/1/description', None, 1),
+            ('post', '/wishlists', {'customer_id': 3, 'wishlist_name': 'gifts'}, 2),
+            ('post', '/wishlists/1/items', item, 4),
+            ('post', '/wishlists/1/items/batch', [item] * 10, 4),
+            ('put', '/wishlists/1/items/1', dict(item, wishlist_id=1), 4),
+            ('put', '/wishlists/1', {'customer_id': 1, 'wishlist_name': 'food'}, 3),
+            ('delete', '/wishlists/1/items/2', None, 3),
+            ('put', '/wishlists/1/clear', None, 2),
+            ('delete', '/wishlists/1', None, 3),
+        ]
+        for method, url, body, count in budgets:
+            kwargs = {}
+            if body is not None:
+                kwargs = dict(data=json.dumps(body), content_type='application/json')
+            with self.assertMaxQueries(count):
+                resp = getattr(self.app, method)(url, **kwargs)
+            self.assertTrue(resp.status_code < 300, '{} {}'.format(method, url))
+
+    def test_query_headers(self):
+        """ Debug mode reports the queries of a request in headers """
+        resp = self.app.get('/wishlists/1')
+        self.assertNotIn('X-DB-Queries', resp.headers)
+        server.app.debug = True
+        try:
+            with self.assertMaxQueries(2) as statements:
+                resp = self.app.get('/wishlists/1')
+        finally:
+            server.app.debug = False
+        self.assertEqual(resp.headers['X-DB-Queries'], str(len(statements)))
+        self.assertTrue(float(resp.headers['X-DB-Time']) > 0)
+
+    def test_slow_query_log(self):
+        """ Statements over the threshold are logged with their route """
+        with patch.dict(server.app.config, {'SLOW_QUERY_THRESHOLD': 0}), \
+                patch('metrics.slow_query_log') as slow_query_log:
+            self.app.get('/items/1')
+        self.assertTrue(slow_query_log.warning.called)
+        args = slow_query_log.warning.call_args[0]
+        self.assertIn('/items/1', args)
+        self.assertIn('get_item', args)
+        with patch('metrics.slow_query_log') as slow_query_log:
+            self.app.get('/items/1')
+        self.assertFalse(slow_query_log.warning.called)
+
+    def test_list_is_compact(self):
+        """ List responses are minified and have the same fields as serialize() """
+        resp = self.app.get('/items')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn('\n ', resp.data)
+        self.assertNotIn(', ', resp.data)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], Item.get(data[0]['id']).serialize())
+        resp = self.app.get('/wishlists')
+        self.assertNotIn('\n ', resp.data)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], Wishlist.get(data[0]['id']).serialize())
+
+    def test_get_metrics(self):
+        """ Get the request metrics in the Prometheus text format """
+        server.metrics.reset()
+        self.app.get('/wishlists/1')
+        self.app.get('/wishlists/1000')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('wishlists_requests_total{endpoint="get_wishlist",method="GET",'
+                      'status="200"} 1', resp.data)
+        self.assertIn('wishlists_requests_total{endpoint="get_wishlist",method="GET",'
+                      'status="404"} 1', resp.data)
+        self.assertIn('wishlists_request_duration_seconds_count{endpoint="get_wishlist",'
+                      'method="GET"} 2', resp.data)
+        self.assertIn('wishlists_request_db_seconds_bucket{endpoint="get_wishlist",'
+                      'method="GET",le="+Inf"} 2', resp.data)
+        self.assertIn('wishlists_request_latency_seconds{endpoint="get_wishlist",'
+                      'method="GET",quantile="0.99"}', resp.data)
+        self.assertIn('wishlists_log_records_dropped_total', resp.data)
+
     def test_query_wishlist(self):
         """ Get wishlists with keywords """
         resp = self.app.get('/wishlists', query_string='keyword=beverage')
@@ -307,6 +694,139 @@ class TestServer(unittest.TestCase):
         query_wishlists = data[0]
         self.assertEqual(query_wishlists['wishlist_name'], 'beverage')
 
+    def test_search_wishlists(self):
+        """ Search wishlists by name, best matches first, a page at a time """
+        Wishlist(customer_id=1, wishlist_name='Grocery run').save()
+        Wishlist(customer_id=2, wishlist_name='Weekly GROCERY').save()
+        resp = self.app.get('/wishlists', query_string='q=grocery&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        names = [wishlist['wishlist_name'] for wishlist in json.loads(resp.data)]
+        self.assertEqual(names, ['grocery', 'Grocery run'])
+        resp = self.app.get('/wishlists', query_string={
+            'q': 'grocery', 'limit': 2, 'after': resp.headers['X-Next-Cursor']})
+        names = [wishlist['wishlist_name'] for wishlist in json.loads(resp.data)]
+        self.assertEqual(names, ['Weekly GROCERY'])
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+        resp = self.app.get('/wishlists', query_string='q=grocery&customer_id=2')
+        names = [wishlist['wishlist_name'] for wishlist in json.loads(resp.data)]
+        self.assertEqual(names, ['Weekly GROCERY'])
+        resp = self.app.get('/wishlists', query_string='q=%20')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_items(self):
+        """ Search items by name and description """
+        resp = self.app.get('/items', query_string='q=toil')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['toilet paper'])
+        resp = self.app.get('/items', query_string='q=Drink')
+        self.assertEqual([item['name'] for item in json.loads(resp.data)], ['beer'])
+
+    def test_get_customer_summary(self):
+        """ Summarize a customer's wishlists """
+        resp = self.app.get('/customers/1/summary')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['wishlist_count'], 1)
+        self.assertEqual(data['item_count'], 2)
+        self.assertEqual(data['product_count'], 2)
+        self.assertEqual(data['wishlists'], [{'id': 1, 'wishlist_name': 'grocery', 'item_count': 2}])
+        resp = self.app.get('/customers/1/summary',
+                            headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, HTTP_304_NOT_MODIFIED)
+
+    def test_customer_summary_after_delete(self):
+        """ Deleting a Wishlist changes the summary, whatever the client revalidates with """
+        resp = self.app.get('/customers/1/summary')
+        etag = resp.headers['ETag']
+        self.assertNotIn('Last-Modified', resp.headers)
+        self.app.delete('/wishlists/1')
+        resp = self.app.get('/customers/1/summary',
+                            headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/customers/1/summary', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['wishlist_count'], 0)
+
+    def test_idempotent_create_wishlist(self):
+        """ A retried POST with the same Idempotency-Key creates one wishlist """
+        wishlist_count = self.get_wishlist_count()
+        data = json.dumps({'customer_id': 1, 'wishlist_name': 'retried'})
+        headers = {'Idempotency-Key': 'create-1'}
+        first = self.app.post('/wishlists', data=data, content_type='application/json',
+                              headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        second = self.app.post('/wishlists', data=data, content_type='application/json',
+                               headers=headers)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.headers['Location'], first.headers['Location'])
+        self.assertEqual(json.loads(second.data), json.loads(first.data))
+        self.assertEqual(self.get_wishlist_count(), wishlist_count + 1)
+        # the same key with another body is a client error
+        resp = self.app.post('/wishlists', data=json.dumps({'customer_id': 2,
+                                                            'wishlist_name': 'other'}),
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, 422)
+
+    def test_idempotent_add_item(self):
+        """ A replayed item add does not save the item again """
+        data = json.dumps({'product_id': 9, 'name': 'soap', 'description': 'I need soap'})
+        headers = {'Idempotency-Key': 'item-1'}
+        first = self.app.post('/wishlists/1/items', data=data,
+                              content_type='application/json', headers=headers)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with patch.object(Item, 'save') as save:
+            second = self.app.post('/wishlists/1/items', data=data,
+                                   content_type='application/json', headers=headers)
+            self.assertFalse(save.called)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(second.data)['id'], json.loads(first.data)['id'])
+        # the key is scoped to the path, and a failed request can be retried
+        resp = self.app.post('/wishlists/99/items', data=data,
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post('/wishlists/2/items', data=data,
+                             content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', resp.headers)
+
+    def test_idempotent_database_store(self):
+        """ Keys kept in the database are seen by every worker """
+        server.app.config['IDEMPOTENCY_STORE'] = 'database'
+        try:
+            server.idempotency.configure(server.app)
+            data = json.dumps({'customer_id': 3, 'wishlist_name': 'shared'})
+            headers = {'Idempotency-Key': 'shared-1'}
+            first = self.app.post('/wishlists', data=data, content_type='application/json',
+                                  headers=headers)
+            server.idempotency.configure(server.app)  # as if another worker answered
+            second = self.app.post('/wishlists', data=data, content_type='application/json',
+                                   headers=headers)
+            self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+            self.assertEqual(second.data, first.data)
+            self.assertEqual(len(Wishlist.find_by_customer_id(3).all()), 1)
+        finally:
+            server.app.config['IDEMPOTENCY_STORE'] = 'memory'
+            server.idempotency.configure(server.app)
+
+    def test_rate_limit(self):
+        """ A customer over the rate limit gets a 429 with Retry-After """
+        server.app.config['RATE_LIMIT'] = 1
+        server.app.config['RATE_LIMIT_CLIENT'] = 100    # every request comes from one address
+        server.admission.reset()
+        try:
+            resp = self.app.get('/wishlists', query_string='customer_id=1')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.app.get('/wishlists', query_string='customer_id=1')
+            self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            resp = self.app.get('/wishlists', query_string='customer_id=2')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertIn('wishlists_throttled_requests_total 1', self.app.get('/metrics').data)
+        finally:
+            server.app.config['RATE_LIMIT'] = 0
+            server.app.config['RATE_LIMIT_CLIENT'] = 0
+            server.admission.reset()
+
     def test_query_customerid_wishlist(self):
         """ Get wishlists with customer_id """
         resp = self.app.get('/wishlists', query_string='customer_id=1')
@@ -9,7 +9,8 @@ import unittest
 import os
 from datetime import datetime
 
-from models import Wishlist, DataValidationError, db
+from models import Wishlist, Item, DataValidationError, db, upgrade_db
+from sqlalchemy import inspect, event
 from werkzeug.exceptions import NotFound
 from server import app
 
@@ -71,6 +72,37 @@ class TestWishlists(unittest.TestCase):
         wishlist.delete()
         self.assertEqual(len(Wishlist.all()), 0)
 
+    def test_delete_a_wishlist_with_items(self):
+        """ Delete a Wishlist and its Items with a constant number of statements """
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        for item_count in (1, 50):
+            wishlist = Wishlist(customer_id=1, wishlist_name = "subscription")
+            wishlist.save()
+            for product_id in range(item_count):
+                Item(wishlist_id=wishlist.id, product_id=product_id,
+                     name="item", description="item").save()
+            self.assertEqual(len(wishlist.items), item_count)
+            del statements[:]
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                wishlist.delete()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            self.assertEqual(len(statements), 2)
+            self.assertEqual(Item.find_by_wishlist_id(wishlist.id).count(), 0)
+        self.assertEqual(len(Wishlist.all()), 0)
+
+    def test_clear_db(self):
+        """ Clear all Wishlists and Items """
+        wishlist = Wishlist(customer_id=1, wishlist_name = "subscription")
+        wishlist.save()
+        Item(wishlist_id=wishlist.id, product_id=1, name="item", description="item").save()
+        Wishlist.clear_db()
+        self.assertEqual(len(Wishlist.all()), 0)
+        self.assertEqual(len(Item.all()), 0)
+
     def test_serialize_a_wishlist(self):
         """ Test serialization of a Wishlist """
         wishlist = Wishlist(customer_id=1, wishlist_name = "subscription")
@@ -148,6 +180,134 @@ class TestWishlists(unittest.TestCase):
         wishlist1 = Wishlist.find_by_wishlist_name(wishlist.wishlist_name)
         self.assertEqual(wishlist1[0].wishlist_name, wishlist.wishlist_name)
 
+    def test_search(self):
+        """ Search wishlist names by prefix and by word, in any case """
+        for name in ['Summer Garden', 'summer', 'Garden party', 'Winter  SUMMER trip', 'summit']:
+            Wishlist(customer_id=1, wishlist_name=name).save()
+        query, order = Wishlist.search('SUMMER')
+        # the exact match, the prefix match, then the word match
+        self.assertEqual([wishlist.wishlist_name for wishlist in query.order_by(order)],
+                         ['summer', 'Summer Garden', 'Winter  SUMMER trip'])
+        query, order = Wishlist.search('gar')
+        self.assertEqual([wishlist.wishlist_name for wishlist in query.order_by(order)],
+                         ['Garden party', 'Summer Garden'])
+        query, order = Wishlist.search('winter summer')
+        self.assertEqual([wishlist.id for wishlist in query], [4])
+        with self.assertRaises(DataValidationError):
+            Wishlist.search('  ')
+
+    def test_search_follows_changes(self):
+        """ Renamed and deleted wishlists are found under their new name only """
+        wishlist = Wishlist(customer_id=1, wishlist_name='old name')
+        wishlist.save()
+        wishlist.wishlist_name = 'New Name'
+        wishlist.save()
+        self.assertEqual(wishlist.wishlist_name_key, 'new name')
+        self.assertEqual(Wishlist.search('old')[0].count(), 0)
+        self.assertEqual(Wishlist.search('name')[0].count(), 1)
+        wishlist.delete()
+        self.assertEqual(Wishlist.search('name')[0].count(), 0)
+
+    def test_get_summary(self):
+        """ Count the items of every wishlist of a customer """
+        books = Wishlist(customer_id=1, wishlist_name='books')
+        books.save()
+        empty = Wishlist(customer_id=1, wishlist_name='empty')
+        empty.save()
+        Wishlist(customer_id=2, wishlist_name='other').save()
+        Item.save_all([Item(wishlist_id=books.id, product_id=1, name='novel', description=''),
+                       Item(wishlist_id=books.id, product_id=2, name='atlas', description=''),
+                       Item(wishlist_id=3, product_id=3, name='pen', description='')])
+        summary = Wishlist.get_summary(1)
+        self.assertEqual(summary['wishlist_count'], 2)
+        self.assertEqual(summary['item_count'], 2)
+        self.assertEqual(summary['product_count'], 2)
+        self.assertEqual(summary['wishlists'], [
+            {'id': books.id, 'wishlist_name': 'books', 'item_count': 2},
+            {'id': empty.id, 'wishlist_name': 'empty', 'item_count': 0}])
+        self.assertEqual(Wishlist.get_summary(9)['wishlists'], [])
+
+    def test_version(self):
+        """ Changes to a Wishlist or its Items bump its version """
+        wishlist = Wishlist(customer_id=1, wishlist_name = "subscription")
+        wishlist.save()
+        self.assertEqual(Wishlist.get_version(wishlist.id)[0], 1)
+        wishlist.wishlist_name = "liked"
+        wishlist.save()
+        self.assertEqual(Wishlist.get_version(wishlist.id)[0], 2)
+        item = Item(wishlist_id=wishlist.id, product_id=1, name="item", description="item")
+        item.save()
+        self.assertEqual(Wishlist.get_version(wishlist.id)[0], 3)
+        Item.save_all([Item(wishlist_id=wishlist.id, product_id=2, name="item", description="item")])
+        self.assertEqual(Wishlist.get_version(wishlist.id)[0], 4)
+        item.delete()
+        self.assertEqual(Wishlist.get_version(wishlist.id)[0], 5)
+        Item.delete_by_wishlist_id(wishlist.id)
+        self.assertEqual(Wishlist.get_version(wishlist.id)[0], 6)
+        self.assertEqual(Wishlist.get_version(0), None)
+
+    def test_get_owner(self):
+        """ Look up the customer of a Wishlist """
+        wishlist = Wishlist(customer_id=4, wishlist_name="gifts")
+        wishlist.save()
+        self.assertEqual(Wishlist.get_owner(wishlist.id), 4)
+        self.assertEqual(Wishlist.get_owner(0), None)
+
+    def test_moving_an_item_bumps_both_versions(self):
+        """ Moving an Item bumps the version of both Wishlists """
+        first = Wishlist(customer_id=1, wishlist_name = "first")
+        first.save()
+        second = Wishlist(customer_id=1, wishlist_name = "second")
+        second.save()
+        item = Item(wishlist_id=first.id, product_id=1, name="item", description="item")
+        item.save()
+        item.wishlist_id = second.id
+        item.save()
+        self.assertEqual(Wishlist.get_version(first.id)[0], 3)
+        self.assertEqual(Wishlist.get_version(second.id)[0], 2)
+
+    def test_customer_version(self):
+        """ Creating or deleting a customer's Wishlist changes the fingerprint """
+        self.assertEqual(Wishlist.get_customer_version(1), '0.0.0.')
+        wishlist = Wishlist(customer_id=1, wishlist_name = "subscription")
+        wishlist.save()
+        version = Wishlist.get_customer_version(1)
+        Wishlist(customer_id=2, wishlist_name = "other").save()
+        self.assertEqual(Wishlist.get_customer_version(1), version)
+        wishlist.delete()
+        self.assertNotEqual(Wishlist.get_customer_version(1), version)
+        # the same id, name and version again, but another Wishlist
+        Wishlist(id=wishlist.id, customer_id=1, wishlist_name="subscription").save()
+        self.assertNotEqual(Wishlist.get_customer_version(1), version)
+
+    def test_upgrade_db_adds_missing_columns(self):
+        """ Upgrade a wishlists table created before versions existed """
+        db.drop_all()
+        db.engine.execute('CREATE TABLE wishlists (id INTEGER PRIMARY KEY, '
+                          'customer_id INTEGER NOT NULL, wishlist_name VARCHAR(40))')
+        db.engine.execute("INSERT INTO wishlists VALUES (1, 1, 'old')")
+        upgrade_db()
+        columns = [column['name'] for column in inspect(db.engine).get_columns('wishlists')]
+        self.assertIn('version', columns)
+        self.assertIn('updated_at', columns)
+        self.assertEqual(Wishlist.get_version(1)[0], 1)
+        db.create_all()
+        # old rows can be searched
+        self.assertEqual([wishlist.id for wishlist in Wishlist.search('OL')[0]], [1])
+
+    def test_init_db_without_tables(self):
+        """ Connect without creating or upgrading the tables """
+        db.drop_all()
+        Wishlist.init_db(app, create_tables=False)
+        self.assertEqual(inspect(db.engine).get_table_names(), [])
+
+    def test_lookup_indexes(self):
+        """ Lookup columns are indexed """
+        indexes = dict((index['name'], index['column_names'])
+                       for index in inspect(db.engine).get_indexes('wishlists'))
+        self.assertEqual(indexes['ix_wishlists_customer_id'], ['customer_id'])
+        self.assertEqual(indexes['ix_wishlists_wishlist_name'], ['wishlist_name'])
+
 
 
 
@@ -7,8 +7,11 @@ def get_database_uri():
     """
     Initialized PostgreSQL db connection
     """
+    # An explicit DATABASE_URI wins, e.g. for benchmarks against a scratch database
+    if 'DATABASE_URI' in os.environ:
+        uri = os.environ['DATABASE_URI']
     # Get the credentials from the Bluemix environment
-    if 'VCAP_SERVICES' in os.environ:
+    elif 'VCAP_SERVICES' in os.environ:
         logging.info("Using VCAP_SERVICES...")
         vcap_services = os.environ['VCAP_SERVICES']
         services = json.loads(vcap_services)
@@ -27,4 +30,58 @@ def get_database_uri():
     # connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
     # return connect_string.format(username, password, hostname, port, name)
     connect_string = uri
-    return connect_string
\ No newline at end of file
+    return connect_string
+
+
+def get_replica_uris():
+    """
+    Read replica connections
+
+    A comma separated DATABASE_REPLICA_URIS wins over the replica_uris list
+    in the service credentials. Returns an empty list when there are none.
+    """
+    if 'DATABASE_REPLICA_URIS' in os.environ:
+        return [uri.strip() for uri in os.environ['DATABASE_REPLICA_URIS'].split(',')
+                if uri.strip()]
+    if 'VCAP_SERVICES' in os.environ:
+        services = json.loads(os.environ['VCAP_SERVICES'])
+        return list(services['elephantsql'][0]['credentials'].get('replica_uris', []))
+    return []
+
+
+def get_database_pool_options():
+    """
+    Connection pool settings for the PostgreSQL database
+
+    Each setting can be given in the service credentials from VCAP_SERVICES
+    and overridden by an environment variable:
+      pool_size        DB_POOL_SIZE        connections kept open per worker
+      max_overflow     DB_MAX_OVERFLOW     extra connections under load
+      pool_timeout     DB_POOL_TIMEOUT     seconds to wait for a connection
+      pool_recycle     DB_POOL_RECYCLE     seconds before a connection is replaced
+      pool_pre_ping    DB_POOL_PRE_PING    test connections on checkout
+      connect_timeout  DB_CONNECT_TIMEOUT  seconds to wait for the server
+
+    Returns a dictionary of keyword arguments for create_engine.
+    """
+    creds = {}
+    if 'VCAP_SERVICES' in os.environ:
+        services = json.loads(os.environ['VCAP_SERVICES'])
+        creds = services['elephantsql'][0]['credentials']
+
+    def setting(name, env, default, convert=int):
+        value = os.getenv(env, creds.get(name, default))
+        if convert is bool and not isinstance(value, bool):
+            return str(value).lower() in ('1', 'true', 'yes')
+        return convert(value)
+
+    return {
+        'pool_size': setting('pool_size', 'DB_POOL_SIZE', 5),
+        'max_overflow': setting('max_overflow', 'DB_MAX_OVERFLOW', 10),
+        'pool_timeout': setting('pool_timeout', 'DB_POOL_TIMEOUT', 10, float),
+        'pool_recycle': setting('pool_recycle', 'DB_POOL_RECYCLE', 1800),
+        'pre_ping': setting('pool_pre_ping', 'DB_POOL_PRE_PING', True, bool),
+        'connect_args': {
+            'connect_timeout': setting('connect_timeout', 'DB_CONNECT_TIMEOUT', 10)
+            }
+        }
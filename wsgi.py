@@ -0,0 +1,21 @@
+"""
+WSGI entry point for production servers
+
+Creates the tables and sets up logging once, when the module is imported.
+With gunicorn's preload_app that happens in the master process, before the
+workers are forked. gevent workers import it after the fork instead, so
+gunicorn_config.py creates the tables before starting them and sets
+DB_SCHEMA_READY=true for the workers to only connect.
+
+  gunicorn -c gunicorn_config.py wsgi:app
+"""
+import os
+import logging
+
+import server
+
+server.initialize_logging(logging.INFO)
+# make our sqlalchemy tables
+server.init_db(create_tables=os.getenv('DB_SCHEMA_READY') != 'true')
+
+app = server.app